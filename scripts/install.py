@@ -31,12 +31,12 @@ import syslog
 import time
 
 import apt_pkg
-from apt.cache import Cache
 import debconf
 
 sys.path.insert(0, '/usr/lib/ubiquity')
 
-from ubiquity import install_misc, misc, osextras
+from ubiquity import (
+    copy_manifest, install_misc, misc, osextras, removal_cache)
 
 
 class Install(install_misc.InstallBase):
@@ -61,7 +61,7 @@ class Install(install_misc.InstallBase):
         else:
             self.source = '/var/lib/ubiquity/source'
         self.db = debconf.Debconf()
-        self.blacklist = {}
+        self.blacklist = install_misc.PathIndex()
 
         if 'UBIQUITY_OEM_USER_CONFIG' in os.environ:
             self.source = None
@@ -209,52 +209,15 @@ class Install(install_misc.InstallBase):
 
         return None
 
-    def generate_blacklist(self):
-        manifest_remove = os.path.join(self.casper_path,
-                                       'filesystem.manifest-remove')
-        manifest_desktop = os.path.join(self.casper_path,
-                                        'filesystem.manifest-desktop')
-        manifest = os.path.join(self.casper_path, 'filesystem.manifest')
-        if os.path.exists(manifest_remove) and os.path.exists(manifest):
-            difference = set()
-            with open(manifest_remove) as manifest_file:
-                for line in manifest_file:
-                    if line.strip() != '' and not line.startswith('#'):
-                        pkg = line.split(':')[0]
-                        difference.add(pkg.split()[0])
-            live_packages = set()
-            with open(manifest) as manifest_file:
-                for line in manifest_file:
-                    if line.strip() != '' and not line.startswith('#'):
-                        pkg = line.split(':')[0]
-                        live_packages.add(pkg.split()[0])
-            desktop_packages = live_packages - difference
-        elif os.path.exists(manifest_desktop) and os.path.exists(manifest):
-            desktop_packages = set()
-            with open(manifest_desktop) as manifest_file:
-                for line in manifest_file:
-                    if line.strip() != '' and not line.startswith('#'):
-                        pkg = line.split(':')[0]
-                        desktop_packages.add(pkg.split()[0])
-            live_packages = set()
-            with open(manifest) as manifest_file:
-                for line in manifest_file:
-                    if line.strip() != '' and not line.startswith('#'):
-                        pkg = line.split(':')[0]
-                        live_packages.add(pkg.split()[0])
-            difference = live_packages - desktop_packages
-        else:
-            difference = set()
+    def blacklist_inputs(self):
+        """Gather everything other than the image that the blacklist needs.
 
-        # Add minimal installation package list if selected
-        if self.db.get('ubiquity/minimal_install') == 'true':
-            if os.path.exists(install_misc.minimal_install_rlist_path):
-                pkgs = set()
-                with open(install_misc.minimal_install_rlist_path) as m_file:
-                    pkgs = {line.strip().split(':')[0] for line in m_file}
-                difference |= pkgs
-
-        cache = Cache()
+        The result keys the removal cache, so anything that affects
+        removal_cache.compute_removals must go in here.
+        """
+        inputs = {}
+        inputs['minimal_install'] = (
+            self.db.get('ubiquity/minimal_install') == 'true')
 
         use_restricted = True
         try:
@@ -262,96 +225,67 @@ class Install(install_misc.InstallBase):
                 use_restricted = False
         except debconf.DebconfError:
             pass
-        if not use_restricted:
-            for pkg in cache.keys():
-                if (cache[pkg].is_installed and
-                        cache[pkg].candidate.section.startswith(
-                            'restricted/')):
-                    difference.add(pkg)
+        inputs['restricted'] = use_restricted
 
         # Keep packages we explicitly installed.
-        keep = install_misc.query_recorded_installed()
+        inputs['keep'] = sorted(install_misc.query_recorded_installed())
         arch, subarch = install_misc.archdetect()
+        inputs['arch'] = arch
+        inputs['subarch'] = subarch
 
-        # Less than ideal.  Since we cannot know which bootloader we'll need
-        # at file copy time, we should figure out why grub still fails when
-        # apt-install-direct is present during configure_bootloader (code
-        # removed).
-        if arch in ('amd64', 'arm64', 'i386'):
-            # We now want grub-pc to be left installed for both EFI and legacy
-            # since it makes sure that the right maintainer scripts are run.
-            keep.add('grub-pc')
-            if subarch == 'efi':
-                keep.add('grub-efi')
-                keep.add('grub-efi-amd64')
-                keep.add('grub-efi-arm64')
-                keep.add('grub-efi-amd64-signed')
-                keep.add('grub-efi-arm64-signed')
-                keep.add('flash-kernel')
-                keep.add('aarch64-laptops-support')
-                keep.add('shim-signed')
-                keep.add('mokutil')
-                try:
-                    altmeta = self.db.get(
-                        'base-installer/kernel/altmeta')
-                    if altmeta:
-                        altmeta = '-%s' % altmeta
-                except debconf.DebconfError:
-                    altmeta = ''
-                keep.add('linux-signed-generic%s' % altmeta)
-            else:
-                keep.add('grub')
-
-        # Even adding ubiquity as a depends to oem-config-{gtk,kde} doesn't
-        # appear to force ubiquity and libdebian-installer4 to copy all of
-        # their files, so this does the trick.
+        altmeta = ''
+        if arch in ('amd64', 'arm64', 'i386') and subarch == 'efi':
+            try:
+                altmeta = self.db.get(
+                    'base-installer/kernel/altmeta')
+                if altmeta:
+                    altmeta = '-%s' % altmeta
+            except debconf.DebconfError:
+                altmeta = ''
+        inputs['altmeta'] = altmeta
+
+        oem_config = False
         try:
             if self.db.get('oem-config/enable') == 'true':
-                keep.add('ubiquity')
+                oem_config = True
         except (debconf.DebconfError, IOError):
             pass
+        inputs['oem_config'] = oem_config
+        return inputs
 
-        difference -= install_misc.expand_dependencies_simple(
-            cache, keep, difference)
-
-        # Consider only packages that don't have a prerm, and which can
-        # therefore have their files removed without any preliminary work.
-        difference = {
-            x for x in difference
-            if not os.path.exists('/var/lib/dpkg/info/%s.prerm' % x)}
-
-        confirmed_remove = set()
-        with cache.actiongroup():
-            for pkg in sorted(difference):
-                if pkg in confirmed_remove:
-                    continue
-                would_remove = install_misc.get_remove_list(
-                    cache, [pkg], recursive=True)
-                if would_remove <= difference:
-                    confirmed_remove |= would_remove
-                    # Leave these marked for removal in the apt cache to
-                    # speed up further calculations.
-                else:
-                    for removedpkg in would_remove:
-                        cachedpkg = install_misc.get_cache_pkg(
-                            cache, removedpkg)
-                        cachedpkg.mark_keep()
-        difference = confirmed_remove
+    def generate_blacklist(self):
+        inputs = self.blacklist_inputs()
+        key = removal_cache.cache_key(self.casper_path, inputs)
+        cache_dirs = [
+            os.path.join(self.casper_path, removal_cache.CACHE_NAME),
+            removal_cache.RUNTIME_CACHE]
+        start = time.time()
+        cached = removal_cache.lookup(cache_dirs, key)
+        if cached is not None:
+            difference, res = cached
+            syslog.syslog('Using cached removal set %s (%d packages)' %
+                          (key, len(difference)))
+        else:
+            difference = removal_cache.compute_removals(
+                self.casper_path, inputs)
+            res = removal_cache.list_files(difference)
+            try:
+                removal_cache.store(removal_cache.RUNTIME_CACHE, key,
+                                    difference, res)
+            except OSError as e:
+                syslog.syslog(syslog.LOG_WARNING,
+                              'Failed to save removal set: %s' % e)
+            syslog.syslog('Computed removal set %s (%d packages) in %.1fs' %
+                          (key, len(difference), time.time() - start))
 
         if len(difference) == 0:
-            del cache
-            self.blacklist = {}
+            self.blacklist = install_misc.PathIndex()
             return
 
-        cmd = ['dpkg', '-L']
-        cmd.extend(difference)
-        subp = subprocess.Popen(
-            cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-            universal_newlines=True)
-        res = subp.communicate()[0].splitlines()
-        u = {}
-        for x in res:
-            u[x] = 1
+        u = install_misc.PathIndex(res)
+        pruned = u.find_prunable(self.source)
+        syslog.syslog('Blacklisted %d paths; %d directories need not be '
+                      'walked' % (len(u), pruned))
         self.blacklist = u
 
     def copy_all(self):
@@ -362,10 +296,14 @@ class Install(install_misc.InstallBase):
         self.db.progress('START', 0, 100, 'ubiquity/install/title')
         self.db.progress('INFO', 'ubiquity/install/copying')
 
+        manifest = self.read_copy_manifest()
+
         fs_size = os.path.join(self.casper_path, 'filesystem.size')
         if os.path.exists(fs_size):
             with open(fs_size) as total_size_fp:
                 total_size = int(total_size_fp.readline())
+        elif manifest is not None:
+            total_size = manifest.total_size
         else:
             # Fallback in case an Ubuntu derivative forgets to put
             # /casper/filesystem.size on the CD, or to account for things
@@ -378,10 +316,8 @@ class Install(install_misc.InstallBase):
             # that the kernel's dentry cache will avoid most of the slowness
             # anyway.
             total_size = 0
-            for dirpath, dirnames, filenames in os.walk(self.source):
-                for name in dirnames + filenames:
-                    fqpath = os.path.join(dirpath, name)
-                    total_size += os.lstat(fqpath).st_size
+            for _, st in self.walk_source():
+                total_size += st.st_size
 
         # Progress bar handling:
         # We sample progress every half-second (assuming time.time() gives
@@ -398,7 +334,6 @@ class Install(install_misc.InstallBase):
         times = [(time_start, copied_size)]
         long_enough = False
         time_last_update = time_start
-        debug = 'UBIQUITY_DEBUG' in os.environ
         if self.db.get('ubiquity/install/md5_check') == 'false':
             md5_check = False
         else:
@@ -420,11 +355,45 @@ class Install(install_misc.InstallBase):
             with open('/proc/sys/vm/dirty_expire_centisecs', 'w') as dec:
                 print('6000\n', file=dec)
 
+        def report_progress():
+            nonlocal copy_progress, long_enough, time_last_update
+
+            # Regular files are only counted once a worker has finished
+            # copying them.
+            done_size = copied_size + copier.copied_size
+            if int((done_size * 90) / total_size) != copy_progress:
+                copy_progress = int((done_size * 90) / total_size)
+                progress.set(10 + copy_progress)
+
+            time_now = time.time()
+            if (time_now - times[-1][0]) >= 0.5:
+                times.append((time_now, done_size))
+                if not long_enough and time_now - times[0][0] >= 10:
+                    long_enough = True
+                if long_enough and time_now - time_last_update >= 2:
+                    time_last_update = time_now
+                    while (time_now - times[0][0] > 60 and
+                           time_now - times[1][0] >= 60):
+                        times.pop(0)
+                    speed = ((times[-1][1] - times[0][1]) /
+                             (times[-1][0] - times[0][0]))
+                    if speed != 0:
+                        time_remaining = (
+                            int((total_size - done_size) / speed))
+                        if time_remaining < 60:
+                            progress.info('ubiquity/install/copying_minute')
+
+        progress = install_misc.ProgressChannel(self.db)
+        verify_mode, md5sums = self.copy_verify_mode(md5_check)
+
+        workers = self.copy_workers()
+        syslog.syslog('Copying files using %d worker(s)' % workers)
+        copier = install_misc.FileCopier(
+            self.db, md5_check, workers, verify_mode, md5sums)
+
         old_umask = os.umask(0)
-        for dirpath, dirnames, filenames in os.walk(self.source):
-            sp = dirpath[len(self.source) + 1:]
-            for name in dirnames + filenames:
-                relpath = os.path.join(sp, name)
+        try:
+            for relpath, st in self.walk_source(manifest, self.blacklist):
                 # /etc/fstab was legitimately created by partman, and
                 # shouldn't be copied again.  Similarly, /etc/crypttab may
                 # have been legitimately created by the user-setup plugin.
@@ -432,24 +401,24 @@ class Install(install_misc.InstallBase):
                     continue
                 sourcepath = os.path.join(self.source, relpath)
                 targetpath = os.path.join(self.target, relpath)
-                st = os.lstat(sourcepath)
-
-                # Is the path blacklisted?
-                if (not stat.S_ISDIR(st.st_mode) and
-                        '/' in relpath and
-                        '/%s' % relpath in self.blacklist):
-                    if debug:
-                        syslog.syslog('Not copying %s' % relpath)
-                    continue
 
                 # Remove the target if necessary and if we can.
                 install_misc.remove_target(
                     self.source, self.target, relpath, st)
 
+                # Regular files are handed off to the copy workers,
+                # which also take care of their metadata.
+                if stat.S_ISREG(st.st_mode):
+                    copier.submit(sourcepath, targetpath, st)
+                    report_progress()
+                    continue
+
                 # Now actually copy source to target.
                 mode = stat.S_IMODE(st.st_mode)
                 if stat.S_ISLNK(st.st_mode):
-                    linkto = os.readlink(sourcepath)
+                    linkto = getattr(st, 'linkto', None)
+                    if linkto is None:
+                        linkto = os.readlink(sourcepath)
                     os.symlink(linkto, targetpath)
                 elif stat.S_ISDIR(st.st_mode):
                     if not os.path.isdir(targetpath):
@@ -471,64 +440,26 @@ class Install(install_misc.InstallBase):
                     os.mknod(targetpath, stat.S_IFIFO | mode)
                 elif stat.S_ISSOCK(st.st_mode):
                     os.mknod(targetpath, stat.S_IFSOCK | mode)
-                elif stat.S_ISREG(st.st_mode):
-                    install_misc.copy_file(
-                        self.db, sourcepath, targetpath, md5_check)
 
                 # Copy metadata.
                 copied_size += st.st_size
-                os.lchown(targetpath, st.st_uid, st.st_gid)
-                if not stat.S_ISLNK(st.st_mode):
-                    os.chmod(targetpath, mode)
+                install_misc.copy_metadata(sourcepath, targetpath, st)
                 if stat.S_ISDIR(st.st_mode):
                     directory_times.append(
                         (targetpath, st.st_atime, st.st_mtime))
-                # os.utime() sets timestamp of target, not link
-                elif not stat.S_ISLNK(st.st_mode):
-                    try:
-                        os.utime(targetpath, (st.st_atime, st.st_mtime))
-                    except Exception:
-                        # We can live with timestamps being wrong.
-                        pass
-                if (hasattr(os, "listxattr") and
-                        hasattr(os, "supports_follow_symlinks") and
-                        os.supports_follow_symlinks):
-                    try:
-                        attrnames = os.listxattr(
-                            sourcepath, follow_symlinks=False)
-                        for attrname in attrnames:
-                            attrvalue = os.getxattr(
-                                sourcepath, attrname, follow_symlinks=False)
-                            os.setxattr(
-                                targetpath, attrname, attrvalue,
-                                follow_symlinks=False)
-                    except OSError as e:
-                        if e.errno not in (
-                                errno.EPERM, errno.ENOTSUP, errno.ENODATA):
-                            raise
-
-                if int((copied_size * 90) / total_size) != copy_progress:
-                    copy_progress = int((copied_size * 90) / total_size)
-                    self.db.progress('SET', 10 + copy_progress)
-
-                time_now = time.time()
-                if (time_now - times[-1][0]) >= 0.5:
-                    times.append((time_now, copied_size))
-                    if not long_enough and time_now - times[0][0] >= 10:
-                        long_enough = True
-                    if long_enough and time_now - time_last_update >= 2:
-                        time_last_update = time_now
-                        while (time_now - times[0][0] > 60 and
-                               time_now - times[1][0] >= 60):
-                            times.pop(0)
-                        speed = ((times[-1][1] - times[0][1]) /
-                                 (times[-1][0] - times[0][0]))
-                        if speed != 0:
-                            time_remaining = (
-                                int((total_size - copied_size) / speed))
-                            if time_remaining < 60:
-                                self.db.progress(
-                                    'INFO', 'ubiquity/install/copying_minute')
+
+                report_progress()
+
+            # Wait for the workers to finish before touching directory
+            # timestamps.
+            while copier.pending:
+                copier.wait()
+                report_progress()
+            progress.flush()
+            copier.log_statistics()
+            progress.log_statistics('copy_all')
+        finally:
+            copier.shutdown()
 
         # Apply timestamps to all directories now that the items within them
         # have been copied.
@@ -599,6 +530,68 @@ class Install(install_misc.InstallBase):
         self.db.progress('SET', 100)
         self.db.progress('STOP')
 
+    def read_copy_manifest(self):
+        """Read the precomputed listing of the source tree, if any."""
+        path = os.path.join(self.casper_path, copy_manifest.MANIFEST_NAME)
+        try:
+            manifest = copy_manifest.read_manifest(path)
+        except (copy_manifest.ManifestError, OSError) as e:
+            syslog.syslog(syslog.LOG_WARNING,
+                          'Ignoring unreadable copy manifest: %s' % e)
+            return None
+        if manifest is None:
+            return None
+        squashfs = os.path.join(self.casper_path, 'filesystem.squashfs')
+        if not manifest.matches(squashfs):
+            syslog.syslog(syslog.LOG_WARNING,
+                          'Ignoring copy manifest %s, which was not built '
+                          'for %s' % (path, squashfs))
+            return None
+        syslog.syslog('Copying %d entries listed in %s' %
+                      (len(manifest), path))
+        return manifest
+
+    def walk_source(self, manifest=None, blacklist=None):
+        """Yield (relpath, stat) for each path in the source tree.
+
+        See install_misc.walk_tree.
+        """
+        return install_misc.walk_tree(self.source, manifest, blacklist)
+
+    def copy_verify_mode(self, md5_check):
+        """Return how to verify copied files, and any precomputed hashes."""
+        if not md5_check:
+            return 'full', None
+        try:
+            mode = self.db.get('ubiquity/install/verify_mode')
+        except debconf.DebconfError:
+            mode = 'full'
+        if mode not in install_misc.VERIFY_MODES:
+            mode = 'full'
+        md5sums = None
+        if mode == 'manifest':
+            md5sums_path = os.path.join(self.casper_path,
+                                        'filesystem.md5sums')
+            if os.path.exists(md5sums_path):
+                md5sums = install_misc.load_md5sums(md5sums_path, self.source)
+            else:
+                syslog.syslog('%s not found; verifying copied files in full' %
+                              md5sums_path)
+                mode = 'full'
+        return mode, md5sums
+
+    def copy_workers(self):
+        """Return the number of threads to use for copying files."""
+        try:
+            workers = int(self.db.get('ubiquity/install/copy_workers'))
+        except (debconf.DebconfError, ValueError):
+            workers = 0
+        if workers <= 0:
+            # Beyond a handful of threads we just end up seeking the source
+            # medium back and forth.
+            workers = min(os.cpu_count() or 1, 4)
+        return workers
+
     def mount_one_image(self, fsfile, mountpoint=None):
         if os.path.splitext(fsfile)[1] == '.cloop':
             blockdev_prefix = 'cloop'
@@ -618,20 +611,9 @@ class Install(install_misc.InstallBase):
                                        'size')) as sysloopf:
                     sysloopsize = sysloopf.readline().strip()
                 if sysloopsize == '0':
-                    if osextras.find_on_path('udevadm'):
-                        udevinfo_cmd = ['udevadm', 'info']
-                    else:
-                        udevinfo_cmd = ['udevinfo']
-                    udevinfo_cmd.extend(
-                        ['-q', 'name', '-p', os.path.join('/block', sysloop)])
-                    with open('/dev/null') as devnull:
-                        udevinfo = subprocess.Popen(
-                            udevinfo_cmd, stdout=subprocess.PIPE,
-                            stderr=devnull, universal_newlines=True)
-                    devbase = udevinfo.communicate()[0]
-                    if udevinfo.returncode != 0:
-                        devbase = sysloop
-                    dev = '/dev/%s' % devbase
+                    udevadm = misc.udevadm_info(
+                        ['-p', os.path.join('/block', sysloop)])
+                    dev = udevadm.get('DEVNAME', '/dev/%s' % sysloop)
                     break
             except Exception:
                 continue
@@ -34,10 +34,10 @@ import subprocess
 import sys
 import syslog
 import textwrap
+import time
 import traceback
 
 import apt_pkg
-from apt.cache import Cache
 import debconf
 
 sys.path.insert(0, '/usr/lib/ubiquity')
@@ -155,7 +155,13 @@ class Install(install_misc.InstallBase):
         except debconf.DebconfError:
             pass
         if not use_restricted:
-            self.restricted_cache = Cache()
+            # Note which installed packages come from restricted now, since
+            # the sources in the target change before remove_extras runs.
+            cache = self.apt_cache()
+            self.restricted_packages = {
+                pkg for pkg in cache.keys()
+                if cache[pkg].is_installed and
+                cache[pkg].candidate.section.startswith('restricted/')}
 
     # TODO can we really pick up where install.py left off?  They're using two
     # separate databases, which means two progress states.  Might need to
@@ -176,27 +182,30 @@ class Install(install_misc.InstallBase):
         self.db.progress(
             'START', self.start, self.end, 'ubiquity/install/title')
 
-        self.configure_python()
+        self.stages = install_misc.StageScheduler(self.db)
+        run_stage = self.stages.run
+
+        run_stage('configure_python', self.configure_python)
 
         self.next_region()
         self.db.progress('INFO', 'ubiquity/install/network')
-        self.configure_network()
+        run_stage('configure_network', self.configure_network)
 
-        self.configure_locale()
+        run_stage('configure_locale', self.configure_locale)
 
         self.next_region()
         self.db.progress('INFO', 'ubiquity/install/apt')
-        self.configure_apt()
+        run_stage('configure_apt', self.configure_apt)
 
         self.configure_plugins()
 
         self.next_region()
-        self.run_target_config_hooks()
+        run_stage('run_target_config_hooks', self.run_target_config_hooks)
 
         self.next_region(size=5)
         # Ignore failures from language pack installation.
         try:
-            self.install_language_packs()
+            run_stage('install_language_packs', self.install_language_packs)
         except install_misc.InstallStepError:
             pass
         except IOError:
@@ -205,11 +214,11 @@ class Install(install_misc.InstallBase):
             pass
 
         self.next_region()
-        self.remove_unusable_kernels()
+        run_stage('remove_unusable_kernels', self.remove_unusable_kernels)
 
         self.next_region(size=4)
         self.db.progress('INFO', 'ubiquity/install/hardware')
-        self.configure_hardware()
+        run_stage('configure_hardware', self.configure_hardware)
 
         # Tell apt-install to install packages directly from now on.
         with open('/var/lib/ubiquity/apt-install-direct', 'w'):
@@ -219,86 +228,96 @@ class Install(install_misc.InstallBase):
         self.db.progress('INFO', 'ubiquity/install/installing')
 
         if 'UBIQUITY_OEM_USER_CONFIG' in os.environ:
-            self.install_oem_extras()
+            run_stage('install_oem_extras', self.install_oem_extras)
         else:
-            self.install_extras()
+            run_stage('install_extras', self.install_extras)
 
         # Configure zsys
-        self.configure_zsys()
+        run_stage('configure_zsys', self.configure_zsys)
 
         self.next_region()
         self.db.progress('INFO', 'ubiquity/install/bootloader')
-        self.copy_mok()
-        self.configure_bootloader()
+        run_stage('copy_mok', self.copy_mok)
+        run_stage('configure_bootloader', self.configure_bootloader)
 
         self.next_region(size=4)
         self.db.progress('INFO', 'ubiquity/install/removing')
         if 'UBIQUITY_OEM_USER_CONFIG' in os.environ:
             try:
                 if misc.create_bool(self.db.get('oem-config/remove_extras')):
-                    self.remove_oem_extras()
+                    run_stage('remove_oem_extras', self.remove_oem_extras)
             except debconf.DebconfError:
                 pass
         else:
-            self.remove_extras()
+            run_stage('remove_extras', self.remove_extras)
 
         self.next_region()
         if 'UBIQUITY_OEM_USER_CONFIG' not in os.environ:
-            self.install_restricted_extras()
+            run_stage('install_restricted_extras',
+                      self.install_restricted_extras)
 
         self.db.progress('INFO', 'ubiquity/install/apt_clone_restore')
-        try:
-            self.apt_clone_restore()
-        except Exception:
-            syslog.syslog(
-                syslog.LOG_WARNING,
-                'Could not restore packages from the previous install:')
-            for line in traceback.format_exc().split('\n'):
-                syslog.syslog(syslog.LOG_WARNING, line)
-            self.db.input('critical', 'ubiquity/install/broken_apt_clone')
-            self.db.go()
-        try:
-            self.copy_network_config()
-        except Exception:
-            syslog.syslog(
-                syslog.LOG_WARNING,
-                'Could not copy the network configuration:')
-            for line in traceback.format_exc().split('\n'):
-                syslog.syslog(syslog.LOG_WARNING, line)
-            self.db.input('critical', 'ubiquity/install/broken_network_copy')
-            self.db.go()
-        try:
-            self.copy_bluetooth_config()
-        except Exception:
-            syslog.syslog(
-                syslog.LOG_WARNING,
-                'Could not copy the bluetooth configuration:')
-            for line in traceback.format_exc().split('\n'):
-                syslog.syslog(syslog.LOG_WARNING, line)
-            self.db.input('critical', 'ubiquity/install/broken_bluetooth_copy')
-            self.db.go()
-        try:
-            self.recache_apparmor()
-        except Exception:
-            syslog.syslog(
-                syslog.LOG_WARNING, 'Could not create an Apparmor cache:')
-            for line in traceback.format_exc().split('\n'):
-                syslog.syslog(syslog.LOG_WARNING, line)
-        try:
-            self.copy_wallpaper_cache()
-        except Exception:
-            syslog.syslog(
-                syslog.LOG_WARNING, 'Could not copy wallpaper cache:')
-            for line in traceback.format_exc().split('\n'):
-                syslog.syslog(syslog.LOG_WARNING, line)
-        self.copy_dcd()
-
-        self.db.progress('SET', self.count)
-        self.db.progress('INFO', 'ubiquity/install/log_files')
-        self.copy_logs()
-        self.save_random_seed()
+        self.stages.run_group(self.final_stages())
 
         self.db.progress('SET', self.end)
+        self.stages.write_report(
+            self.target_file('var/log/installer/stage-timings'))
+
+    def final_stages(self):
+        """Return the stages that finish off the installation.
+
+        Most of these copy things into disjoint parts of the target, so
+        they can run at the same time.  Anything that might be affected by
+        packages restored by apt-clone waits for that, anything that runs
+        commands in the target waits for the Apparmor cache to be rebuilt,
+        and the logs are copied last so that they cover everything else.
+        """
+        Stage = install_misc.Stage
+
+        def broken(template):
+            def on_error():
+                self.db.input('critical', template)
+                self.db.go()
+            return on_error
+
+        def copy_logs():
+            self.db.progress('SET', self.count)
+            self.db.progress('INFO', 'ubiquity/install/log_files')
+            self.copy_logs()
+
+        stages = [
+            # apt-clone is run with a preexec_fn, which isn't safe while any
+            # other thread is running, so it runs before everything else in
+            # this group and nothing starts until it is done.
+            Stage('apt_clone_restore', self.apt_clone_restore, main=True,
+                  error_message=(
+                      'Could not restore packages from the previous '
+                      'install:'),
+                  on_error=broken('ubiquity/install/broken_apt_clone')),
+            Stage('copy_network_config', self.copy_network_config,
+                  after=['apt_clone_restore'],
+                  error_message='Could not copy the network configuration:',
+                  on_error=broken('ubiquity/install/broken_network_copy')),
+            Stage('copy_bluetooth_config', self.copy_bluetooth_config,
+                  after=['apt_clone_restore'],
+                  error_message='Could not copy the bluetooth configuration:',
+                  on_error=broken('ubiquity/install/broken_bluetooth_copy')),
+            # Mounts and unmounts /proc and /sys in the target, which
+            # apt-clone also needs, and which any other stage that runs
+            # commands in the target must not see half done.
+            Stage('recache_apparmor', self.recache_apparmor,
+                  after=['apt_clone_restore'],
+                  error_message='Could not create an Apparmor cache:'),
+            Stage('copy_wallpaper_cache', self.copy_wallpaper_cache,
+                  after=['apt_clone_restore', 'recache_apparmor'],
+                  error_message='Could not copy wallpaper cache:'),
+            Stage('copy_dcd', self.copy_dcd, after=['apt_clone_restore']),
+            Stage('save_random_seed', self.save_random_seed,
+                  after=['apt_clone_restore']),
+        ]
+        stages.append(Stage('copy_logs', copy_logs,
+                            after=[stage.name for stage in stages]))
+        return stages
 
     def _get_uid_gid_on_target(self, target_user):
         """Helper that gets the uid/gid of the username in the target chroot"""
@@ -324,39 +343,21 @@ class Install(install_misc.InstallBase):
         Recreate them now to restore the appearance of a system installed
         from .debs.
         """
-        cache = Cache()
+        cache = self.apt_cache()
 
         # Python standard library.
         re_minimal = re.compile(r'^python\d+\.\d+-minimal$')
         python_installed = sorted([
             pkg[:-8] for pkg in cache.keys()
             if re_minimal.match(pkg) and cache[pkg].is_installed])
+        modules = {}
         for python in python_installed:
             re_file = re.compile(r'^/usr/lib/%s/.*\.py$' % python)
-            files = [
-                f for f in cache['%s-minimal' % python].installed_files
-                if (re_file.match(f) and
-                    not os.path.exists(self.target_file('%sc' % f[1:])))]
-            install_misc.chrex(self.target, python,
-                               '/usr/lib/%s/py_compile.py' % python, *files)
-            files = [
-                f for f in cache[python].installed_files
-                if (re_file.match(f) and
-                    not os.path.exists(self.target_file('%sc' % f[1:])))]
-            install_misc.chrex(self.target, python,
-                               '/usr/lib/%s/py_compile.py' % python, *files)
-
-        # Modules provided by the core Debian Python packages.
-        default = subprocess.Popen(
-            ['chroot', self.target, 'pyversions', '-d'],
-            stdout=subprocess.PIPE,
-            universal_newlines=True).communicate()[0].rstrip('\n')
-        if default:
-            install_misc.chrex(self.target, default, '-m', 'compileall',
-                               '/usr/share/python/')
-        if osextras.find_on_path_root(self.target, 'py3compile'):
-            install_misc.chrex(self.target, 'py3compile', '-p', 'python3',
-                               '/usr/share/python3/')
+            files = []
+            for pkg in ('%s-minimal' % python, python):
+                files.extend(f for f in cache[pkg].installed_files
+                             if re_file.match(f))
+            modules[python] = files
 
         def run_hooks(path, *args):
             for hook in osextras.glob_root(self.target, path):
@@ -364,9 +365,13 @@ class Install(install_misc.InstallBase):
                     continue
                 install_misc.chrex(self.target, hook, *args)
 
-        # Public and private modules provided by other packages.
+        # Do all the rest in a single chroot session.
         install_misc.chroot_setup(self.target)
         try:
+            self.compile_python_modules(modules)
+
+            # Public and private modules provided by other packages.
+            start = time.time()
             if osextras.find_on_path_root(self.target, 'pyversions'):
                 supported = subprocess.Popen(
                     ['chroot', self.target, 'pyversions', '-s'],
@@ -410,9 +415,51 @@ class Install(install_misc.InstallBase):
                               'rtupdate', python, python)
                     run_hooks('/usr/share/python3/runtime.d/*.rtupdate',
                               'post-rtupdate', python, python)
+            syslog.syslog('Ran Python runtime hooks in %.1fs' %
+                          (time.time() - start))
         finally:
             install_misc.chroot_cleanup(self.target)
 
+    def compile_python_modules(self, modules):
+        """Byte-compile Python modules in parallel.
+
+        modules maps each interpreter to the standard library modules it
+        should compile.  These are split across as many compileall processes
+        as we have CPUs, which run alongside compiling the modules provided
+        by the core Debian Python packages.  compileall skips anything that
+        is already up to date.  The target must already be set up with
+        install_misc.chroot_setup.
+        """
+        start = time.time()
+        jobs = os.cpu_count() or 1
+        commands = []
+        for python, files in sorted(modules.items()):
+            for i in range(min(jobs, len(files))):
+                commands.append(
+                    ([python, '-m', 'compileall', '-q', '-i', '-'],
+                     '\n'.join(files[i::jobs]) + '\n'))
+
+        # Modules provided by the core Debian Python packages.
+        default = subprocess.Popen(
+            ['chroot', self.target, 'pyversions', '-d'],
+            stdout=subprocess.PIPE,
+            universal_newlines=True).communicate()[0].rstrip('\n')
+        if default:
+            commands.append(
+                ([default, '-m', 'compileall', '/usr/share/python/'], None))
+        if osextras.find_on_path_root(self.target, 'py3compile'):
+            commands.append(
+                (['py3compile', '-p', 'python3', '/usr/share/python3/'],
+                 None))
+
+        install_misc.chrex_parallel(self.target, commands)
+        syslog.syslog(
+            'Byte-compiled %d standard library modules for %s, plus '
+            'public modules, using %d processes in %.1fs' %
+            (sum(len(files) for files in modules.values()),
+             ', '.join(sorted(modules)) or 'no interpreters', len(commands),
+             time.time() - start))
+
     def configure_network(self):
         """Automatically configure the network.
 
@@ -507,8 +554,10 @@ class Install(install_misc.InstallBase):
 
     def configure_plugins(self):
         """Apply plugin settings to installed system."""
+        # Plugins talk to debconf through filtered commands, so they have to
+        # run one at a time.
         for plugin in self.plugins:
-            self.run_plugin(plugin)
+            self.stages.run('plugin %s' % plugin.NAME, self.run_plugin, plugin)
 
     def configure_apt(self):
         """Configure /etc/apt/sources.list."""
@@ -638,7 +687,7 @@ class Install(install_misc.InstallBase):
         if self.db.get('pkgsel/ignore-incomplete-language-support') == 'true':
             return
 
-        cache = Cache()
+        cache = self.apt_cache()
         incomplete = False
         for pkg in self.langpacks:
             if pkg.startswith('gimp-help-'):
@@ -716,7 +765,7 @@ class Install(install_misc.InstallBase):
                         new_kernel_version = kernel[12:]
                     elif kernel.startswith('linux-generic-'):
                         # Traverse dependencies to find the real kernel image.
-                        cache = Cache()
+                        cache = self.apt_cache()
                         kernel = self.traverse_for_kernel(cache, kernel)
                         if kernel:
                             new_kernel_pkg = kernel
@@ -742,7 +791,7 @@ class Install(install_misc.InstallBase):
             self.do_install(install_kernels)
             install_misc.record_installed(install_kernels)
             if new_kernel_pkg:
-                cache = Cache()
+                cache = self.apt_cache()
                 cached_pkg = install_misc.get_cache_pkg(cache, new_kernel_pkg)
                 if cached_pkg is not None and cached_pkg.is_installed:
                     self.kernel_version = new_kernel_version
@@ -995,7 +1044,7 @@ class Install(install_misc.InstallBase):
             self.db, 'ubiquity/install/title',
             'ubiquity/install/apt_indices_starting',
             'ubiquity/install/apt_indices')
-        cache = Cache()
+        cache = self.apt_cache()
 
         if cache._depcache.broken_count > 0:
             syslog.syslog(
@@ -1034,7 +1083,7 @@ class Install(install_misc.InstallBase):
             install_misc.chroot_cleanup(self.target)
         self.db.progress('SET', 5)
 
-        cache.open(None)
+        cache = self.reopen_apt_cache()
         if commit_error or cache._depcache.broken_count > 0:
             if commit_error is None:
                 commit_error = ''
@@ -1122,7 +1171,7 @@ class Install(install_misc.InstallBase):
                 subprocess.check_call(cmd)
             except subprocess.CalledProcessError as e:
                 if e.returncode != 30:
-                    cache = Cache()
+                    cache = self.apt_cache()
                     brokenpkgs = install_misc.broken_packages(cache)
                     self.warn_broken_packages(brokenpkgs, str(e))
         finally:
@@ -1168,7 +1217,7 @@ class Install(install_misc.InstallBase):
         # will be installed by install_restricted_extras() later
         # because this function runs before i386 foreign arch is
         # enabled
-        cache = Cache()
+        cache = self.apt_cache()
         filtered_extra_packages = install_misc.query_recorded_installed()
         for package in filtered_extra_packages.copy():
             pkg = cache.get(package)
@@ -1272,7 +1321,7 @@ class Install(install_misc.InstallBase):
         keep.add('ubiquity')
         keep.add('oem-config')
 
-        cache = Cache()
+        cache = self.apt_cache()
         # TODO cjwatson 2012-05-04: It would be nice to use a set
         # comprehension here, but that causes:
         #   SyntaxError: can not delete variable 'cache' referenced in nested
@@ -1424,7 +1473,7 @@ class Install(install_misc.InstallBase):
                 if pkg not in keep:
                     difference.add(pkg)
 
-        cache = Cache()
+        cache = self.apt_cache()
         difference -= install_misc.expand_dependencies_simple(
             cache, keep, difference)
         del cache
@@ -1439,13 +1488,7 @@ class Install(install_misc.InstallBase):
         except debconf.DebconfError:
             pass
         if not use_restricted:
-            cache = self.restricted_cache
-            for pkg in cache.keys():
-                if (cache[pkg].is_installed and
-                        cache[pkg].candidate.section.startswith(
-                            'restricted/')):
-                    difference.add(pkg)
-            del cache
+            difference |= self.restricted_packages
 
         install_misc.record_removed(difference)
 
@@ -1702,16 +1745,16 @@ class Install(install_misc.InstallBase):
         except IOError:
             pass
 
-        old_umask = os.umask(0o077)
+        # The umask is process-wide and other stages run alongside this
+        # one, so set the seed's mode when creating it instead.
         try:
             with open("/dev/urandom", "rb") as urandom:
-                with open(self.target_file("var/lib/systemd/random-seed"),
-                          "wb") as seed:
+                fd = os.open(self.target_file("var/lib/systemd/random-seed"),
+                             os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+                with os.fdopen(fd, "wb") as seed:
                     seed.write(urandom.read(poolbytes))
         except IOError:
             pass
-        finally:
-            os.umask(old_umask)
 
     def cleanup(self):
         """Miscellaneous cleanup tasks."""
@@ -0,0 +1,131 @@
+#!/usr/bin/python3
+
+"""Compare install_misc.PathIndex with the old dictionary blacklist.
+
+This builds both from the dpkg -L output for a set of packages, and then
+checks every path under a root directory against each of them, as copy_all
+does.  By default the packages come from the live filesystem's
+manifest-remove file; run it on a live session, e.g.:
+
+  tests/bench_blacklist.py --root /rofs
+
+If there is no manifest-remove file, use --manifest-remove with any list
+of installed packages, or --dpkg-list with saved dpkg -L output.
+"""
+
+import optparse
+import os
+import subprocess
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from ubiquity import install_misc
+
+
+def read_packages(path):
+    packages = set()
+    with open(path) as manifest:
+        for line in manifest:
+            if line.strip() != '' and not line.startswith('#'):
+                packages.add(line.split(':')[0].split()[0])
+    return packages
+
+
+def dpkg_list(packages):
+    installed = subprocess.run(
+        ['dpkg-query', '-W', '-f', '${Package}\\n'] + sorted(packages),
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+        universal_newlines=True).stdout.split()
+    return subprocess.run(
+        ['dpkg', '-L'] + installed, stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL, universal_newlines=True).stdout
+
+
+def build_dict(lines):
+    u = {}
+    for x in lines:
+        u[x] = 1
+    return u
+
+
+def measure(build, text):
+    # Split the text inside the measurement, as generate_blacklist gets it
+    # from dpkg, so that we count what each structure keeps alive.
+    tracemalloc.start()
+    start = time.time()
+    result = build(text.splitlines())
+    elapsed = time.time() - start
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, elapsed, size
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--manifest-remove',
+                      default='/cdrom/casper/filesystem.manifest-remove',
+                      help='packages to blacklist (default: %default)')
+    parser.add_option('--dpkg-list',
+                      help='read dpkg -L output from this file instead')
+    parser.add_option('--root', default='/',
+                      help='tree to check against the blacklist '
+                           '(default: %default)')
+    parser.add_option('--runs', type='int', default=3,
+                      help='number of lookup passes to time')
+    options, _ = parser.parse_args()
+
+    if options.dpkg_list:
+        with open(options.dpkg_list) as f:
+            text = f.read()
+    else:
+        text = dpkg_list(read_packages(options.manifest_remove))
+    print('%d lines of dpkg -L output' % text.count('\n'))
+
+    blacklist, dict_build, dict_size = measure(build_dict, text)
+    index, index_build, index_size = measure(install_misc.PathIndex, text)
+    start = time.time()
+    prunable = index.find_prunable(options.root)
+    prune_time = time.time() - start
+    print('dict:      %8.1f KiB, built in %.3fs' %
+          (dict_size / 1024.0, dict_build))
+    print('PathIndex: %8.1f KiB, built in %.3fs, %d prunable directories '
+          'found in %.3fs' %
+          (index_size / 1024.0, index_build, prunable, prune_time))
+
+    # Collect the walk up front so that only the lookups are timed.
+    entries = []
+    for dirpath, dirnames, filenames in os.walk(options.root):
+        sp = os.path.relpath(dirpath, options.root)
+        if sp == '.':
+            sp = ''
+        for name in filenames:
+            entries.append((sp, name, os.path.join(sp, name)))
+
+    dict_best = index_best = None
+    for _ in range(options.runs):
+        start = time.time()
+        dict_hits = 0
+        for sp, name, relpath in entries:
+            if '/' in relpath and '/%s' % relpath in blacklist:
+                dict_hits += 1
+        elapsed = time.time() - start
+        if dict_best is None or elapsed < dict_best:
+            dict_best = elapsed
+        start = time.time()
+        index_hits = 0
+        for sp, name, relpath in entries:
+            if index.contains(sp, name):
+                index_hits += 1
+        elapsed = time.time() - start
+        if index_best is None or elapsed < index_best:
+            index_best = elapsed
+    print('%d files checked: dict %.3fs (%d hits), PathIndex %.3fs '
+          '(%d hits)' %
+          (len(entries), dict_best, dict_hits, index_best, index_hits))
+
+
+if __name__ == '__main__':
+    main()
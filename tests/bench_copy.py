@@ -0,0 +1,130 @@
+#!/usr/bin/python3
+
+"""Benchmark install_misc.FileCopier with one worker against several.
+
+This builds a synthetic tree that looks roughly like a live filesystem
+(lots of small files, a few large ones) and copies it the same way
+copy_all does.  Run it from the top of the source tree, e.g.:
+
+  tests/bench_copy.py --workers 4
+"""
+
+import optparse
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from ubiquity import install_misc
+
+
+def make_tree(root, dirs, files_per_dir, small_size, large_files, large_size):
+    small = b'x' * small_size
+    for d in range(dirs):
+        dirpath = os.path.join(root, 'usr/share/dir%d' % d)
+        os.makedirs(dirpath)
+        for f in range(files_per_dir):
+            with open(os.path.join(dirpath, 'file%d' % f), 'wb') as fp:
+                fp.write(small)
+    large = os.urandom(1024 * 1024)
+    os.makedirs(os.path.join(root, 'usr/lib'))
+    for f in range(large_files):
+        with open(os.path.join(root, 'usr/lib/large%d' % f), 'wb') as fp:
+            for _ in range(large_size):
+                fp.write(large)
+
+
+def copy_tree(source, target, workers, md5_check, verify_mode):
+    copier = install_misc.FileCopier(None, md5_check, workers, verify_mode)
+    count = 0
+    size = 0
+    try:
+        for dirpath, dirnames, filenames in os.walk(source):
+            sp = dirpath[len(source) + 1:]
+            for name in dirnames + filenames:
+                relpath = os.path.join(sp, name)
+                sourcepath = os.path.join(source, relpath)
+                targetpath = os.path.join(target, relpath)
+                st = os.lstat(sourcepath)
+                if stat.S_ISREG(st.st_mode):
+                    copier.submit(sourcepath, targetpath, st)
+                    count += 1
+                    size += st.st_size
+                elif stat.S_ISDIR(st.st_mode):
+                    os.mkdir(targetpath, stat.S_IMODE(st.st_mode))
+        while copier.pending:
+            copier.wait()
+    finally:
+        copier.shutdown()
+    return count, size, sorted(copier.backends), copier.size_classes
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--workers', type='int', default=os.cpu_count() or 1,
+                      help='number of workers to compare against one')
+    parser.add_option('--dirs', type='int', default=200,
+                      help='number of directories of small files')
+    parser.add_option('--files', type='int', default=100,
+                      help='small files per directory')
+    parser.add_option('--small-size', type='int', default=4096,
+                      help='size of each small file in bytes')
+    parser.add_option('--large', type='int', default=8,
+                      help='number of large files')
+    parser.add_option('--large-size', type='int', default=32,
+                      help='size of each large file in MiB')
+    parser.add_option('--md5', default=False, action='store_true',
+                      help='verify copied files as copy_all does by default')
+    parser.add_option('--verify-mode', default='full',
+                      choices=install_misc.VERIFY_MODES,
+                      help='how to verify copied files with --md5 '
+                           '(full, sampled; default: %default)')
+    parser.add_option('--runs', type='int', default=3,
+                      help='number of runs for each worker count')
+    options, _ = parser.parse_args()
+
+    scratch = tempfile.mkdtemp(prefix='ubiquity-bench-copy-')
+    try:
+        source = os.path.join(scratch, 'source')
+        os.mkdir(source)
+        make_tree(source, options.dirs, options.files, options.small_size,
+                  options.large, options.large_size)
+
+        results = {}
+        for workers in sorted({1, options.workers}):
+            best = None
+            for _ in range(options.runs):
+                target = os.path.join(scratch, 'target')
+                os.mkdir(target)
+                start = time.time()
+                count, size, backends, size_classes = copy_tree(
+                    source, target, workers, options.md5,
+                    options.verify_mode)
+                elapsed = time.time() - start
+                shutil.rmtree(target)
+                if best is None or elapsed < best:
+                    best = elapsed
+            results[workers] = best
+            print('%2d worker(s): %d files, %.1f MiB in %.2fs '
+                  '(%.0f files/s, %.1f MiB/s) using %s' %
+                  (workers, count, size / 1048576.0, best, count / best,
+                   size / 1048576.0 / best, ', '.join(backends)))
+            for size_class in ('small', 'medium', 'large'):
+                if size_class in size_classes:
+                    files, size, elapsed = size_classes[size_class]
+                    print('    %-6s %6d files, %.1f MiB: %.0f files/s, '
+                          '%.1f MiB/s per worker' %
+                          (size_class, files, size / 1048576.0,
+                           files / elapsed, size / 1048576.0 / elapsed))
+        if options.workers != 1:
+            print('speedup: %.2fx' % (results[1] / results[options.workers]))
+    finally:
+        shutil.rmtree(scratch)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,416 @@
+#!/usr/bin/python3
+
+"""Replay a debconf protocol trace through DebconfFilter.process_line.
+
+To record traces, run the installer with UBIQUITY_DEBCONF_TRACE set to a
+directory; each filtered command then writes the lines its confmodule sent,
+the replies it got and when, and the question patterns it watched.  This
+feeds the received lines through process_line with the same patterns
+registered, against a fake debconf.Debconf that gives back the recorded
+replies, and reports lines per second, time spent in widget callbacks and,
+with --histogram, per-command latency.  It does so both with the compiled
+dispatch table and with the old loop over every pattern.  It also times
+reading the trace with tryreadline alone, with the old 512-byte reads and
+with the read buffer (see --read-size).  Without --trace
+it makes up a trace resembling a partman run with a long progress bar,
+using the partman plugin's patterns, e.g.:
+
+  tests/bench_debconffilter.py --histogram \\
+      --trace /var/log/installer/debconf-trace/partman.1234.5678.trace
+"""
+
+import errno
+import json
+import optparse
+import os
+import re
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import debconf
+
+from ubiquity import debconffilter
+
+
+# As registered by ubi-partman.Page.prepare.
+PARTMAN_PATTERNS = [
+    '^partman-auto/.*automatically_partition$',
+    '^partman-auto/select_disk$',
+    '^partman-partitioning/confirm_resize$',
+    '^partman-partitioning/confirm_new_label$',
+    '^partman-partitioning/new_size$',
+    '^partman/choose_partition$',
+    '^partman/confirm.*',
+    '^partman/free_space$',
+    '^partman/active_partition$',
+    '^partman-crypto/passphrase.*',
+    '^partman-crypto/weak_passphrase$',
+    '^partman-crypto/confirm.*',
+    '^partman-crypto/mainmenu$',
+    '^partman-lvm/confirm.*',
+    '^partman-lvm/device_remove_lvm',
+    '^partman-partitioning/new_partition_(size|type|place)$',
+    '^partman-target/choose_method$',
+    ('^partman-basicfilesystems/'
+     '(fat_mountpoint|mountpoint|mountpoint_manual)$'),
+    '^partman-basicfilesystems/no_swap$',
+    '^partman-uboot/mountpoint$',
+    '^partman/exception_handler$',
+    '^partman/exception_handler_note$',
+    '^partman/unmount_active$',
+    '^partman/installation_medium_mounted$',
+    'type:boolean',
+    'ERROR',
+    'PROGRESS',
+]
+
+
+class FakeDebconf(debconf.Debconf):
+    """A debconf.Debconf that answers from a trace instead of a frontend.
+
+    replies holds, for each line fed to the filter, the reply the filter
+    sent back when the trace was recorded (or None).  Commands the filter
+    passes through get the text of that reply; anything else the filter or
+    its widgets ask gets an empty answer.
+    """
+
+    def __init__(self, replies):
+        self.replies = replies
+        self.position = 0
+        self.commands = 0
+
+    def command(self, command, *params):
+        self.commands += 1
+        reply = None
+        if self.position < len(self.replies):
+            reply = self.replies[self.position]
+        if reply is None:
+            return ''
+        code, _, text = reply.partition(' ')
+        if code == '0':
+            return text
+        raise debconf.DebconfError(int(code), text)
+
+    def capb(self, *capabilities):
+        return self.command('CAPB', *capabilities)
+
+    def fget(self, question, flag):
+        return self.command('FGET', question, flag)
+
+    def metaget(self, question, field):
+        return self.command('METAGET', question, field)
+
+
+class CallbackTimer:
+    def __init__(self):
+        self.calls = 0
+        self.elapsed = 0.0
+
+    def timed(self, func):
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.elapsed += time.perf_counter() - start
+                self.calls += 1
+        return wrapper
+
+
+class Widget:
+    """Accepts every question and progress update, timing each callback."""
+
+    def __init__(self, timer):
+        for method in ('run', 'error', 'capb', 'set', 'subst', 'metaget',
+                       'progress_start', 'progress_set', 'progress_step',
+                       'progress_info', 'progress_stop',
+                       'progress_region'):
+            setattr(self, method, timer.timed(self.accept))
+
+    def accept(self, *args):
+        return True
+
+
+class LegacyDebconfFilter(debconffilter.DebconfFilter):
+    """find_widgets as it was before the dispatch table."""
+
+    def find_widgets(self, questions, method=None):
+        found = set()
+        for pattern in self.widgets.keys():
+            widget = self.widgets[pattern]
+            if widget not in found:
+                for question in questions:
+                    matches = False
+                    if pattern.startswith('type:') and '/' in question:
+                        try:
+                            qtype = self.question_type(question)
+                            if qtype == pattern[5:]:
+                                matches = True
+                        except debconf.DebconfError:
+                            pass
+                    elif re.search(pattern, question):
+                        matches = True
+                    if matches:
+                        if method is None or hasattr(widget, method):
+                            found.add(widget)
+                            break
+        return list(found)
+
+
+class LegacyReader(debconffilter.DebconfFilter):
+    """tryreadline as it was before the read buffer."""
+
+    toread = b''
+    toreadpos = 0
+
+    def tryreadline(self):
+        ret = b''
+        while True:
+            newlinepos = self.toread.find(b'\n', self.toreadpos)
+            if newlinepos != -1:
+                ret = self.toread[self.toreadpos:newlinepos + 1]
+                self.toreadpos = newlinepos + 1
+                if self.toreadpos >= len(self.toread):
+                    self.toread = b''
+                    self.toreadpos = 0
+                break
+
+            try:
+                text = os.read(self.subout_fd, 512)
+                if text == b'':
+                    ret = self.toread
+                    self.toread = b''
+                    self.toreadpos = 0
+                    break
+                self.toread += text
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return None
+                else:
+                    raise
+
+        return ret.decode()
+
+
+def time_reader(filter_class, trace_path, read_size, runs):
+    best = None
+    for _ in range(runs):
+        dbfilter = filter_class(FakeDebconf([]), read_size=read_size)
+        with open(trace_path, 'rb') as trace:
+            dbfilter.subout_fd = trace.fileno()
+            start = time.perf_counter()
+            lines = 0
+            while dbfilter.tryreadline():
+                lines += 1
+            elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return lines, best
+
+
+def make_trace(steps):
+    lines = ['CAPB backup progresscancel']
+    for disk in range(4):
+        lines.append('SUBST partman/choose_partition DISK /dev/sd%s' %
+                     'abcd'[disk])
+        lines.append('METAGET partman/choose_partition Description')
+        lines.append('PROGRESS START 0 %d partman/progress/init/title' %
+                     steps)
+        for step in range(steps):
+            lines.append('PROGRESS SET %d' % step)
+            lines.append('PROGRESS INFO partman/progress/init/parted')
+            lines.append('SET partman-partitioning/new_size %d' % step)
+            lines.append('GET partman/filter_mounted')
+            lines.append('SUBST partman-basicfilesystems/mountpoint '
+                         'PARTITION %d' % step)
+        lines.append('PROGRESS STOP')
+        lines.append('INPUT critical partman/choose_partition')
+        lines.append('GO')
+    return lines
+
+
+def read_trace(path):
+    """Read a trace written by DebconfFilter.open_trace.
+
+    Returns the header (or None), the received lines, the reply recorded
+    for each of them (or None), and the recorded latency of each reply.
+    A file of bare protocol lines is also accepted.
+    """
+    header = None
+    lines = []
+    replies = []
+    recorded = []
+    received_at = None
+    with open(path) as trace:
+        for line in trace:
+            line = line.rstrip('\n')
+            if line.startswith('# '):
+                header = json.loads(line[2:])
+                continue
+            fields = line.split(' ', 2)
+            if len(fields) < 2 or fields[1] not in ('<', '>'):
+                lines.append(line)
+                replies.append(None)
+                continue
+            when = float(fields[0])
+            text = fields[2] if len(fields) > 2 else ''
+            if fields[1] == '<':
+                lines.append(text)
+                replies.append(None)
+                received_at = when
+            elif lines and replies[-1] is None:
+                replies[-1] = text
+                if received_at is not None:
+                    recorded.append((command_name(lines[-1]),
+                                     when - received_at))
+    return header, lines, replies, recorded
+
+
+def command_name(line):
+    words = line.split(None, 1)
+    return words[0].upper() if words else ''
+
+
+# Upper bounds of the latency histogram buckets, in microseconds.
+BUCKETS = [10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, None]
+
+
+def print_histogram(title, latencies):
+    by_command = {}
+    for command, elapsed in latencies:
+        by_command.setdefault(command, []).append(elapsed)
+    print(title)
+    print('  %-12s %7s %9s %9s  %s' % (
+        'command', 'count', 'p50 us', 'p99 us',
+        ' '.join('%6s' % ('<%d' % bound if bound else 'more')
+                 for bound in BUCKETS)))
+    for command, times in sorted(by_command.items()):
+        times.sort()
+        counts = [0] * len(BUCKETS)
+        for elapsed in times:
+            for i, bound in enumerate(BUCKETS):
+                if bound is None or elapsed * 1e6 < bound:
+                    counts[i] += 1
+                    break
+        print('  %-12s %7d %9.1f %9.1f  %s' % (
+            command, len(times), times[len(times) // 2] * 1e6,
+            times[min(len(times) - 1, len(times) * 99 // 100)] * 1e6,
+            ' '.join('%6d' % count for count in counts)))
+
+
+def replay(filter_class, trace_path, patterns, automatic, replies,
+           read_size, runs):
+    """Replay a trace, returning the best run's statistics."""
+    best = None
+    for _ in range(runs):
+        timer = CallbackTimer()
+        widget = Widget(timer)
+        db = FakeDebconf(replies)
+        dbfilter = filter_class(
+            db, dict((pattern, widget) for pattern in patterns), automatic,
+            read_size=read_size)
+        dbfilter.escaping = False
+        dbfilter.progress_cancel = False
+        dbfilter.next_go_backup = False
+        dbfilter.subin = open(os.devnull, 'w')
+        latencies = []
+        with open(trace_path, 'rb') as trace:
+            dbfilter.subout_fd = trace.fileno()
+            start = time.perf_counter()
+            while True:
+                line_start = time.perf_counter()
+                if not dbfilter.process_line():
+                    break
+                latencies.append(time.perf_counter() - line_start)
+                db.position += 1
+            elapsed = time.perf_counter() - start
+        dbfilter.subin.close()
+        if best is None or elapsed < best['elapsed']:
+            best = {
+                'elapsed': elapsed,
+                'latencies': latencies,
+                'callbacks': timer.calls,
+                'callback_time': timer.elapsed,
+                'commands': db.commands,
+            }
+    return best
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--trace',
+                      help='trace written by DebconfFilter (see %s), or '
+                           'bare debconf protocol lines' %
+                           debconffilter.TRACE_DIR_ENV)
+    parser.add_option('--steps', type='int', default=2000,
+                      help='progress steps per disk in the made-up trace '
+                           '(default: %default)')
+    parser.add_option('--runs', type='int', default=3,
+                      help='number of replays to time (default: %default)')
+    parser.add_option('--read-size', type='int',
+                      default=debconffilter.READ_SIZE,
+                      help='DebconfFilter read buffer size '
+                           '(default: %default)')
+    parser.add_option('--histogram', default=False, action='store_true',
+                      help='print per-command latency histograms')
+    options, _ = parser.parse_args()
+
+    os.environ.pop('DEBCONF_DEBUG', None)
+    os.environ.pop('UBIQUITY_DEBUG_CORE', None)
+    os.environ.pop(debconffilter.TRACE_DIR_ENV, None)
+    if options.trace is None:
+        header, replies, recorded = None, [], []
+        lines = make_trace(options.steps)
+    else:
+        header, lines, replies, recorded = read_trace(options.trace)
+    patterns = PARTMAN_PATTERNS
+    automatic = False
+    if header is not None:
+        print('trace of %s' % header['command'])
+        patterns = header['widgets']
+        automatic = header['automatic']
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        # process_line reads from a file descriptor, so feed it the
+        # received lines alone.
+        trace_path = os.path.join(tmpdir, 'trace')
+        with open(trace_path, 'w') as trace:
+            for line in lines:
+                print(line, file=trace)
+        for label, filter_class, read_size in (
+                ('512-byte reads', LegacyReader, 512),
+                ('read buffer', debconffilter.DebconfFilter,
+                 options.read_size)):
+            count, elapsed = time_reader(
+                filter_class, trace_path, read_size, options.runs)
+            print('tryreadline, %-15s %d lines in %.3fs, %.0f lines/s' %
+                  (label + ':', count, elapsed, count / elapsed))
+        results = []
+        for label, filter_class in (
+                ('pattern loop', LegacyDebconfFilter),
+                ('dispatch table', debconffilter.DebconfFilter)):
+            result = replay(filter_class, trace_path, patterns, automatic,
+                            replies, options.read_size, options.runs)
+            count = len(result['latencies'])
+            print('%-15s %d lines in %.3fs, %.0f lines/s; %d widget '
+                  'callbacks took %.3fs; %d debconf commands' %
+                  (label, count, result['elapsed'],
+                   count / result['elapsed'], result['callbacks'],
+                   result['callback_time'], result['commands']))
+            results.append(result)
+    if results[1]['elapsed'] > 0:
+        print('speedup: %.1fx' %
+              (results[0]['elapsed'] / results[1]['elapsed']))
+    if options.histogram:
+        if recorded:
+            print_histogram('recorded reply latency', recorded)
+        print_histogram('replayed process_line latency',
+                        [(command_name(line), elapsed) for line, elapsed in
+                         zip(lines, results[1]['latencies'])])
+
+
+if __name__ == '__main__':
+    main()
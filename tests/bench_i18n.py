@@ -0,0 +1,111 @@
+#!/usr/bin/python3
+
+"""Time the first paint after a language switch, with and without the
+compiled translation catalogue.
+
+This writes a template database shaped like a live CD's (many
+ubiquity questions, many more from other packages, each translated into
+many languages) and a debconf.conf pointing at it.  A language switch
+is timed as the frontends do it: one get_translations call for the new
+language, followed by get_string for every widget on the page.
+debconf-copydb must be installed for the old path.
+"""
+
+import optparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from ubiquity import i18n
+
+SWITCHES = ['de_DE.UTF-8', 'fr_FR.UTF-8', 'pt_BR.UTF-8', 'ja_JP.UTF-8',
+            'l10', 'l20']
+
+
+def make_templates(path, questions, others, languages):
+    langs = ['de', 'fr', 'pt_br', 'ja'] + [
+        'l%d' % i for i in range(languages - 4)]
+    with open(path, 'w', encoding='UTF-8') as templates:
+        for prefix, count in (('ubiquity/text/q', questions),
+                              ('otherpackage/q', others)):
+            for i in range(count):
+                print('Name: %s%d' % (prefix, i), file=templates)
+                print('Description: Question %d' % i, file=templates)
+                for lang in langs:
+                    print('Description-%s.UTF-8: %s question %d ünïcode' %
+                          (lang, lang, i), file=templates)
+                print('Extended_description: Longer text for %d' % i,
+                      file=templates)
+                print('Type: text\nOwners: ubiquity\n', file=templates)
+
+
+def switch(lang, widgets):
+    start = time.time()
+    i18n.get_translations(languages=[lang],
+                          core_names=['ubiquity/text/q0', 'ubiquity/text/q1'],
+                          extra_prefixes=['ubiquity/text'])
+    for widget in widgets:
+        i18n.get_string(widget, lang)
+    return time.time() - start
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--questions', type='int', default=1500,
+                      help='number of ubiquity templates (default: %default)')
+    parser.add_option('--others', type='int', default=4000,
+                      help='number of other templates (default: %default)')
+    parser.add_option('--languages', type='int', default=60,
+                      help='number of translations (default: %default)')
+    parser.add_option('--widgets', type='int', default=300,
+                      help='strings per page (default: %default)')
+    options, _ = parser.parse_args()
+
+    root = tempfile.mkdtemp()
+    try:
+        templates = os.path.join(root, 'templates.dat')
+        make_templates(templates, options.questions, options.others,
+                       options.languages)
+        config = os.path.join(root, 'debconf.conf')
+        with open(config, 'w') as f:
+            f.write('Config: configdb\nTemplates: templatedb\n\n'
+                    'Name: configdb\nDriver: File\n'
+                    'Filename: %s/config.dat\n\n'
+                    'Name: templatedb\nDriver: File\nFilename: %s\n' %
+                    (root, templates))
+        os.environ['DEBCONF_SYSTEMRC'] = config
+        i18n.CATALOGUE_FILE = os.path.join(root, 'translations.cat')
+        widgets = ['q%d' % i for i in range(options.widgets)]
+        print('%d templates, %d bytes, %d languages' %
+              (options.questions + options.others,
+               os.path.getsize(templates), options.languages))
+
+        with mock.patch('ubiquity.i18n.debconf_template_files',
+                        return_value=None):
+            copydb = [switch(lang, widgets) for lang in SWITCHES]
+        print('debconf-copydb: %s' %
+              ' '.join('%.3fs' % elapsed for elapsed in copydb))
+
+        build = switch(SWITCHES[0], widgets)
+        print('catalogue: first switch %.3fs, including compiling '
+              '%d bytes' % (build, os.path.getsize(i18n.CATALOGUE_FILE)))
+        i18n._catalogue = None
+        i18n._translations = None
+        mapped = [switch(lang, widgets) for lang in SWITCHES]
+        print('catalogue: %s' %
+              ' '.join('%.4fs' % elapsed for elapsed in mapped))
+        print('median speedup: %.0fx' %
+              (sorted(copydb)[len(copydb) // 2] /
+               sorted(mapped)[len(mapped) // 2]))
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+#!/usr/bin/python3
+
+"""Time cycling the language page through every keyboard names language.
+
+Each switch asks for the new language's layouts and then C's, as the
+console-setup page does.  The old loader gunzipped and parsed the whole
+of kbdnames.gz whenever the language differed from the last one asked
+for; it is reproduced here for comparison.  Without --filename, a file
+shaped like kbdnames-maker's output is generated.
+"""
+
+import gzip
+import io
+import optparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from ubiquity import keyboard_names
+
+
+def make_kbdnames(path, languages, layouts, variants):
+    with gzip.open(path, 'wt', encoding='UTF-8') as kbdnames:
+        for lang in ['C'] + ['l%d' % i for i in range(languages - 1)]:
+            for layout in range(layouts):
+                print('%s*layout*k%d*Layout %d ëxample' %
+                      (lang, layout, layout), file=kbdnames)
+                for variant in range(variants):
+                    print('%s*variant*k%d*v%d*Layout %d, variant %d' %
+                          (lang, layout, variant, layout, variant),
+                          file=kbdnames)
+
+
+def languages_in(path):
+    with gzip.open(path, 'rt', encoding='UTF-8') as kbdnames:
+        return sorted(set(line.split('*', 1)[0] for line in kbdnames))
+
+
+class OldKeyboardNames(keyboard_names.KeyboardNames):
+    """The single-language loader that re-reads the whole file."""
+
+    def __init__(self, filename):
+        super().__init__(filename=filename)
+        self._current = (None, None)
+
+    def _tables(self, lang):
+        if lang == self._current[0]:
+            return self._current[1]
+        tables = keyboard_names._Tables()
+        raw = gzip.open(self._filename)
+        try:
+            with io.TextIOWrapper(raw) as kbdnames:
+                self._load_file(lang, kbdnames, tables)
+        finally:
+            raw.close()
+        self.loads += 1
+        self._current = (lang, tables)
+        return tables
+
+
+def cycle(kn, languages, runs):
+    start = time.time()
+    for _ in range(runs):
+        for lang in languages:
+            kn.has_language(lang)
+            kn.layout_id('C', 'Layout 1 ëxample')
+    return time.time() - start
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--filename', help='a real kbdnames.gz to use')
+    parser.add_option('--languages', type='int', default=100,
+                      help='number of generated languages (default: %default)')
+    parser.add_option('--runs', type='int', default=2,
+                      help='passes through all languages (default: %default)')
+    options, _ = parser.parse_args()
+
+    root = tempfile.mkdtemp()
+    try:
+        filename = options.filename
+        if filename is None:
+            filename = os.path.join(root, 'kbdnames.gz')
+            make_kbdnames(filename, options.languages, 90, 4)
+        languages = languages_in(filename)
+        print('%d languages, %d bytes compressed' %
+              (len(languages), os.path.getsize(filename)))
+
+        old = OldKeyboardNames(filename)
+        elapsed = cycle(old, languages, options.runs)
+        print('gunzip per switch: %.3fs, %d loads' % (elapsed, old.loads))
+
+        index_filename = os.path.join(root, 'kbdnames-index')
+        for label in ('building index', 'existing index'):
+            kn = keyboard_names.KeyboardNames(
+                filename=filename, index_filename=index_filename)
+            elapsed = cycle(kn, languages, options.runs)
+            print('%s: %.3fs, %d loads' % (label, elapsed, kn.loads))
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+#!/usr/bin/python3
+
+"""Time parted_server queries with and without a session.
+
+This runs the fake parted_server from test_parted_server over FIFOs in a
+temporary directory, with 8 disks of 100 partitions by default, and asks
+for each disk's label, its partitions and then every partition's details,
+as ubi-partman does when it rebuilds its cache or looks at reusable
+partitions.  It does this once with a dialog per query and once inside a
+PartedServer session, and reports the number of dialogs and time taken,
+and how long writing the partman log took compared with opening it for
+every line.
+"""
+
+import optparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from ubiquity import parted_server
+
+from test_parted_server import FakePartedServer, make_partitions
+
+
+def query_all(parted):
+    for disk in parted.disks():
+        parted.select_disk(disk)
+        parted.label_type()
+        for partition in parted.partitions():
+            parted.partition_info(partition[1])
+
+
+def time_log_per_line(path, lines):
+    """Log lines the old way, opening the log once for each."""
+    start = time.time()
+    for _ in range(lines):
+        with open(path, 'a') as f:
+            print('ubiquity: IN: PARTITION_INFO =dev=sda 32256-1032255',
+                  file=f)
+    return time.time() - start
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--disks', type='int', default=8,
+                      help='number of disks (default: %default)')
+    parser.add_option('--partitions', type='int', default=100,
+                      help='partitions per disk (default: %default)')
+    options, _ = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        disks = {}
+        for i in range(options.disks):
+            name = 'sd%s' % chr(ord('a') + i)
+            disks['=dev=%s' % name] = (
+                'gpt', '128', make_partitions(name, options.partitions))
+        server = FakePartedServer(directory, disks)
+        with server.patch():
+            server.start()
+            try:
+                results = []
+                for label, use_session in (('dialog per query', False),
+                                           ('session', True)):
+                    parted = parted_server.PartedServer()
+                    start = time.time()
+                    if use_session:
+                        with parted.session():
+                            query_all(parted)
+                    else:
+                        query_all(parted)
+                    elapsed = time.time() - start
+                    print('%-17s %5d dialogs in %.3fs' %
+                          (label + ':', parted.dialogs, elapsed))
+                    results.append(elapsed)
+            finally:
+                server.stop()
+        if results[1] > 0:
+            print('speedup: %.1fx' % (results[0] / results[1]))
+
+        log = parted_server.log_buffer
+        print('log: %d lines in %d writes taking %.3fs; one open per line '
+              'would take %.3fs' %
+              (log.calls, log.flushes, log.elapsed,
+               time_log_per_line(os.path.join(directory, 'oldlog'),
+                                 log.calls)))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
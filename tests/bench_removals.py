@@ -0,0 +1,84 @@
+#!/usr/bin/python3
+
+"""Compare install_misc.RemovalPlanner with asking apt package by package.
+
+This replays the removal sets the installer works out on a live session:
+the per-package loop that generate_blacklist runs over the live-only
+packages, and the non-recursive and recursive removals that remove_extras
+passes to do_remove.  Each replay runs in a fresh apt cache and nothing is
+committed.  Run it as root on a live session, e.g.:
+
+  tests/bench_removals.py --casper /cdrom/casper
+"""
+
+import optparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from apt.cache import Cache
+
+from ubiquity import install_misc, removal_cache
+
+
+def replay(label, func, *args):
+    cache = Cache()
+    start = time.time()
+    with cache.actiongroup():
+        result = func(cache, *args)
+    elapsed = time.time() - start
+    print('  %-8s %8.2fs, %d packages' % (label, elapsed, len(result)))
+    return result, elapsed
+
+
+def compare(title, old, new, *args):
+    print(title)
+    old_result, old_elapsed = replay('apt', old, *args)
+    new_result, new_elapsed = replay('planner', new, *args)
+    if old_result != new_result:
+        print('  results differ: only apt %s; only planner %s' %
+              (' '.join(sorted(old_result - new_result)),
+               ' '.join(sorted(new_result - old_result))))
+    if new_elapsed > 0:
+        print('  speedup: %.1fx' % (old_elapsed / new_elapsed))
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--casper', default='/cdrom/casper',
+                      help='directory containing filesystem.manifest '
+                           '(default: %default)')
+    parser.add_option('--minimal-install', default=False,
+                      action='store_true',
+                      help='include the minimal installation removals')
+    parser.add_option('--no-restricted', dest='restricted', default=True,
+                      action='store_false',
+                      help='also remove packages from restricted')
+    options, _ = parser.parse_args()
+
+    arch, subarch = install_misc.archdetect()
+    inputs = {
+        'minimal_install': options.minimal_install,
+        'restricted': options.restricted,
+        'keep': sorted(install_misc.query_recorded_installed()),
+        'arch': arch,
+        'subarch': subarch,
+        'altmeta': '',
+        'oem_config': False,
+    }
+    difference = removal_cache.removal_candidates(
+        options.casper, inputs, Cache())
+    print('%d candidate packages' % len(difference))
+
+    compare('generate_blacklist', removal_cache.plan_removals_apt,
+            removal_cache.plan_removals, difference)
+    compare('remove_extras (regular)', install_misc.get_remove_list_apt,
+            install_misc.get_remove_list, difference, False)
+    compare('remove_extras (recursive)', install_misc.get_remove_list_apt,
+            install_misc.get_remove_list, difference, True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+#!/usr/bin/python3
+
+"""Compare building tz._Database with and without the zoneinfo index.
+
+Each construction runs in a fresh process, so that nothing is shared
+between runs.  The first indexed run has to build the index, which is
+reported separately.  The index is written to a temporary file rather
+than to tz.INDEX_FILE.
+"""
+
+import json
+import optparse
+import os
+import subprocess
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+CHILD = '''
+import json, sys, time
+sys.path.insert(0, %(path)r)
+from ubiquity import tz
+tz.INDEX_FILE = %(index)r
+start = time.time()
+database = tz._Database(use_index=%(use_index)r)
+elapsed = time.time() - start
+start = time.time()
+for name in %(aliases)r:
+    database.get_loc(name)
+print(json.dumps([elapsed, time.time() - start, len(database.locations)]))
+'''
+
+ALIASES = ['US/Eastern', 'US/Pacific', 'Europe/Belfast', 'Asia/Calcutta',
+           'Canada/Atlantic', 'Mexico/General', 'Brazil/East', 'Australia/NSW']
+
+
+def run(index, use_index):
+    code = CHILD % {
+        'path': os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir),
+        'index': index, 'use_index': use_index, 'aliases': ALIASES}
+    output = subprocess.run([sys.executable, '-c', code],
+                            stdout=subprocess.PIPE, check=True,
+                            universal_newlines=True).stdout
+    return json.loads(output)
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--runs', type='int', default=5,
+                      help='number of constructions to time')
+    options, _ = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        index = os.path.join(directory, 'zoneinfo-index.json')
+        build, _, count = run(index, True)
+        print('%d locations; building the index took %.3fs (%d bytes)' %
+              (count, build, os.path.getsize(index)))
+        for label, use_index in (('without index', False),
+                                 ('with index', True)):
+            results = [run(index, use_index) for _ in range(options.runs)]
+            print('%-14s construction %.3fs, %d alias lookups %.4fs '
+                  '(best of %d)' %
+                  (label, min(r[0] for r in results), len(ALIASES),
+                   min(r[1] for r in results), options.runs))
+
+
+if __name__ == '__main__':
+    main()
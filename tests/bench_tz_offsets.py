@@ -0,0 +1,60 @@
+#!/usr/bin/python3
+
+"""Time SystemTzInfo offset lookups with and without parsing TZif files.
+
+Each pass asks for the UTC offset of a spread of dates in a handful of
+zones, once through the TZif tables and once through the old tzset path.
+"""
+
+import datetime
+import optparse
+import os
+import sys
+import time
+
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from ubiquity import tz
+
+ZONES = ['Europe/London', 'America/New_York', 'Australia/Sydney',
+         'Asia/Kolkata', 'America/Santiago', 'Pacific/Chatham']
+
+
+def lookups(infos, dates, runs):
+    best = None
+    for _ in range(runs):
+        start = time.time()
+        for info in infos:
+            for dt in dates:
+                info.utcoffset(dt)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return len(infos) * len(dates) / best
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--runs', type='int', default=5,
+                      help='number of lookup passes to time')
+    options, _ = parser.parse_args()
+
+    infos = [tz.SystemTzInfo(zone) for zone in ZONES]
+    dates = [datetime.datetime(year, month, 15, 12)
+             for year in range(1980, 2040) for month in range(1, 13)]
+    start = time.time()
+    for info in infos:
+        info._tzfile()
+    print('parsed %d TZif files in %.4fs' % (len(infos), time.time() - start))
+    parsed = lookups(infos, dates, options.runs)
+    with mock.patch('ubiquity.tz._load_tzfile', return_value=None):
+        tzset = lookups(infos, dates, options.runs)
+    print('TZif tables: %.0f lookups/s' % parsed)
+    print('tzset:       %.0f lookups/s' % tzset)
+    print('speedup: %.1fx' % (parsed / tzset))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+#!/usr/bin/python3
+
+"""Compare udevdb.DeviceTable with forking a process per udev lookup.
+
+This builds a fake sysfs tree and udev database holding many disks and
+partitions, and then asks for the disk of every partition, as
+partition_to_disk does.  udevadm can't be pointed at a fake tree, so the
+forking side runs cat over the same files for each lookup, which is a
+lower bound on what forking udevadm costs.  With --live, it also times
+real udevadm calls against the table for this machine's block devices.
+"""
+
+import optparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from ubiquity import udevdb
+
+
+def make_tree(root, disks, partitions):
+    sys_root = os.path.join(root, 'sys')
+    udev_data = os.path.join(root, 'data')
+    os.makedirs(os.path.join(sys_root, 'class', 'block'))
+    os.makedirs(udev_data)
+    names = []
+    for disk in range(disks):
+        major, first_minor = 8 + disk // 16, (disk % 16) * 16
+        devpath = 'devices/pci0000:00/host%d/block/sd%d' % (disk, disk)
+        entries = [('sd%d' % disk, devpath, 'disk', first_minor)]
+        for part in range(1, partitions + 1):
+            entries.append(('sd%dp%d' % (disk, part),
+                            '%s/sd%dp%d' % (devpath, disk, part),
+                            'partition', first_minor + part))
+        for name, path, devtype, minor in entries:
+            syspath = os.path.join(sys_root, path)
+            os.makedirs(syspath)
+            with open(os.path.join(syspath, 'uevent'), 'w') as f:
+                f.write('MAJOR=%d\nMINOR=%d\nDEVNAME=%s\nDEVTYPE=%s\n' %
+                        (major, minor, name, devtype))
+            os.symlink(syspath,
+                       os.path.join(sys_root, 'class', 'block', name))
+            with open(os.path.join(udev_data,
+                                   'b%d:%d' % (major, minor)), 'w') as f:
+                f.write('S:disk/by-id/ata-%s\nE:ID_BUS=ata\n'
+                        'E:ID_SERIAL=DISK%d\n' % (name, disk))
+            if devtype == 'partition':
+                names.append(name)
+    return sys_root, udev_data, names
+
+
+def disk_from_table(table, name):
+    props = table.lookup_name('/dev/%s' % name)
+    return table.lookup_path(props['DEVPATH'].rsplit('/', 1)[0])['DEVNAME']
+
+
+def disk_by_forking(sys_root, udev_data, name):
+    syspath = os.path.realpath(os.path.join(sys_root, 'class', 'block', name))
+    for path in (syspath, os.path.dirname(syspath)):
+        subprocess.run(
+            ['cat', os.path.join(path, 'uevent'), udev_data],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+
+def live(runs):
+    table = udevdb.DeviceTable()
+    names = sorted(os.listdir(os.path.join(udevdb.SYS, 'class', 'block')))
+    start = time.time()
+    for _ in range(runs):
+        for name in names:
+            subprocess.run(
+                ['udevadm', 'info', '-q', 'property', '-n', '/dev/%s' % name],
+                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    forked = (time.time() - start) / runs
+    start = time.time()
+    for _ in range(runs):
+        for name in names:
+            table.lookup_name('/dev/%s' % name)
+    cached = (time.time() - start) / runs
+    print('live: %d devices, udevadm %.3fs, table %.4fs (%d loads)' %
+          (len(names), forked, cached, table.loads))
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--disks', type='int', default=16,
+                      help='number of fake disks (default: %default)')
+    parser.add_option('--partitions', type='int', default=15,
+                      help='partitions per disk (default: %default)')
+    parser.add_option('--runs', type='int', default=3,
+                      help='number of lookup passes to time')
+    parser.add_option('--live', default=False, action='store_true',
+                      help="also time this machine's block devices")
+    options, _ = parser.parse_args()
+
+    root = tempfile.mkdtemp()
+    try:
+        sys_root, udev_data, names = make_tree(
+            root, options.disks, options.partitions)
+        print('%d partitions on %d disks' % (len(names), options.disks))
+
+        start = time.time()
+        for name in names:
+            disk_by_forking(sys_root, udev_data, name)
+        forked = time.time() - start
+        print('fork per lookup: %.3fs' % forked)
+
+        table = udevdb.DeviceTable(sys_root=sys_root, udev_data=udev_data)
+        start = time.time()
+        table.refresh()
+        load = time.time() - start
+        best = None
+        for _ in range(options.runs):
+            start = time.time()
+            for name in names:
+                disk_from_table(table, name)
+            elapsed = time.time() - start
+            if best is None or elapsed < best:
+                best = elapsed
+        print('DeviceTable: loaded in %.3fs, lookups %.4fs (%d loads)' %
+              (load, best, table.loads))
+        if best + load > 0:
+            print('speedup: %.1fx' % (forked / (best + load)))
+    finally:
+        shutil.rmtree(root)
+
+    if options.live:
+        live(options.runs)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+#! /usr/bin/python3
+
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+import zlib
+
+from ubiquity import copy_manifest
+
+
+class CopyManifestTests(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.manifest = os.path.join(tempfile.mkdtemp(), 'manifest')
+        self.addCleanup(shutil.rmtree, os.path.dirname(self.manifest))
+        self.squashfs = os.path.join(
+            os.path.dirname(self.manifest), 'filesystem.squashfs')
+        with open(self.squashfs, 'wb') as f:
+            f.write(b'hsqs')
+
+        os.makedirs(os.path.join(self.root, 'usr/share/doc'))
+        with open(os.path.join(self.root, 'usr/share/doc/README'), 'w') as f:
+            f.write('hello\n')
+        os.chmod(os.path.join(self.root, 'usr/share/doc/README'), 0o640)
+        os.symlink('share/doc', os.path.join(self.root, 'usr/doc'))
+        os.mkfifo(os.path.join(self.root, 'fifo'))
+
+    def test_round_trip(self):
+        scanned = list(copy_manifest.scan(self.root))
+        copy_manifest.write_manifest(scanned, self.manifest, self.squashfs)
+        manifest = copy_manifest.read_manifest(self.manifest)
+        self.assertEqual(len(scanned), len(manifest))
+        self.assertEqual(
+            sum(entry.st_size for entry in scanned), manifest.total_size)
+        self.assertEqual(scanned, list(manifest))
+
+    def test_walk_order_and_contents(self):
+        copy_manifest.write_manifest(
+            copy_manifest.scan(self.root), self.manifest, self.squashfs)
+        entries = {entry.relpath: entry
+                   for entry in copy_manifest.read_manifest(self.manifest)}
+        relpaths = [entry.relpath
+                    for entry in copy_manifest.read_manifest(self.manifest)]
+        self.assertLess(relpaths.index('usr'),
+                        relpaths.index('usr/share'))
+        self.assertLess(relpaths.index('usr/share/doc'),
+                        relpaths.index('usr/share/doc/README'))
+        readme = entries['usr/share/doc/README']
+        self.assertTrue(stat.S_ISREG(readme.st_mode))
+        self.assertEqual(0o640, stat.S_IMODE(readme.st_mode))
+        self.assertEqual(6, readme.st_size)
+        self.assertIsNone(readme.linkto)
+        self.assertEqual('share/doc', entries['usr/doc'].linkto)
+        self.assertTrue(stat.S_ISFIFO(entries['fifo'].st_mode))
+
+    def test_missing_manifest(self):
+        self.assertIsNone(copy_manifest.read_manifest(self.manifest))
+
+    def test_corrupt_manifest(self):
+        copy_manifest.write_manifest(
+            copy_manifest.scan(self.root), self.manifest, self.squashfs)
+        with open(self.manifest, 'r+b') as f:
+            f.seek(-4, os.SEEK_END)
+            f.write(b'junk')
+        self.assertRaises(copy_manifest.ManifestError,
+                          copy_manifest.read_manifest, self.manifest)
+        with open(self.manifest, 'wb') as f:
+            f.write(b'not a manifest at all')
+        self.assertRaises(copy_manifest.ManifestError,
+                          copy_manifest.read_manifest, self.manifest)
+
+    def test_corrupt_entries(self):
+        # Errors in the entries are found when the manifest is read, not
+        # part of the way through copying.
+        copy_manifest.write_manifest(
+            copy_manifest.scan(self.root), self.manifest, self.squashfs)
+        with open(self.manifest, 'rb') as f:
+            header = f.read(copy_manifest._header.size)
+            body = zlib.decompress(f.read())
+        record = list(copy_manifest._record.unpack_from(body))
+        record[8] = 0xffff
+        for bad in (body[:-1], body + b'x',
+                    copy_manifest._record.pack(*record) +
+                    body[copy_manifest._record.size:]):
+            with open(self.manifest, 'wb') as f:
+                f.write(header)
+                f.write(zlib.compress(bad))
+            self.assertRaises(copy_manifest.ManifestError,
+                              copy_manifest.read_manifest, self.manifest)
+        fields = list(copy_manifest._header.unpack(header))
+        fields[2] += 1
+        with open(self.manifest, 'wb') as f:
+            f.write(copy_manifest._header.pack(*fields))
+            f.write(zlib.compress(body))
+        self.assertRaises(copy_manifest.ManifestError,
+                          copy_manifest.read_manifest, self.manifest)
+
+    def test_matches_squashfs(self):
+        copy_manifest.write_manifest(
+            copy_manifest.scan(self.root), self.manifest, self.squashfs)
+        manifest = copy_manifest.read_manifest(self.manifest)
+        self.assertTrue(manifest.matches(self.squashfs))
+        self.assertFalse(manifest.matches(self.squashfs + '.missing'))
+        st = os.stat(self.squashfs)
+        os.utime(self.squashfs, (st.st_atime, st.st_mtime + 10))
+        self.assertFalse(manifest.matches(self.squashfs))
+        os.utime(self.squashfs, (st.st_atime, st.st_mtime))
+        with open(self.squashfs, 'ab') as f:
+            f.write(b'more')
+        self.assertFalse(manifest.matches(self.squashfs))
@@ -0,0 +1,170 @@
+#! /usr/bin/python3
+# -*- coding: utf-8; -*-
+
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import debconf
+import mock
+
+from ubiquity import debconffilter
+
+
+class Widget:
+    def run(self, priority, question):
+        return True
+
+
+class SetWidget(Widget):
+    def set(self, question, value):
+        pass
+
+
+class DebconfFilterTests(unittest.TestCase):
+    def setUp(self):
+        self.db = mock.Mock()
+        self.db.metaget.side_effect = self.metaget
+
+    def metaget(self, question, field):
+        if question == 'foo/broken':
+            raise debconf.DebconfError(10, 'no such question')
+        elif question == 'partman-base/confirm':
+            return 'boolean'
+        else:
+            return 'select'
+
+    def test_find_widgets(self):
+        plain = Widget()
+        setter = SetWidget()
+        typed = SetWidget()
+        dbfilter = debconffilter.DebconfFilter(self.db, {
+            '^partman/choose_partition$': plain,
+            '^partman-(base|lvm)/confirm.*': setter,
+            'type:boolean': typed,
+            'PROGRESS': plain,
+        })
+        self.assertEqual(
+            [plain], dbfilter.find_widgets(['partman/choose_partition']))
+        self.assertEqual(
+            [setter, typed],
+            dbfilter.find_widgets(['partman-base/confirm'], 'set'))
+        self.assertEqual(
+            [], dbfilter.find_widgets(['partman/choose_partition'], 'set'))
+        self.assertEqual(
+            [plain], dbfilter.find_widgets(['some title', 'PROGRESS']))
+        self.assertEqual([], dbfilter.find_widgets(['CAPB'], 'capb'))
+        self.assertEqual([], dbfilter.find_widgets(['foo/broken']))
+
+    def test_find_widgets_cached(self):
+        widget = SetWidget()
+        dbfilter = debconffilter.DebconfFilter(
+            self.db, {'^partman': widget, 'type:boolean': widget})
+        for _ in range(3):
+            self.assertEqual(
+                [widget],
+                dbfilter.find_widgets(['partman-base/confirm'], 'set'))
+        self.db.metaget.assert_called_once_with(
+            'partman-base/confirm', 'Type')
+
+    def test_find_widgets_uncombinable(self):
+        widget = Widget()
+        dbfilter = debconffilter.DebconfFilter(
+            self.db, {r'^(a+)/\1$': widget, '^b/': widget})
+        self.assertEqual([widget], dbfilter.find_widgets(['aa/aa']))
+        self.assertEqual([], dbfilter.find_widgets(['aa/a']))
+        self.assertEqual([widget], dbfilter.find_widgets(['b/c']))
+
+    def test_find_widgets_backreference(self):
+        # Combining these would make \1 refer to the group around '^foo'.
+        first = Widget()
+        second = Widget()
+        third = Widget()
+        dbfilter = debconffilter.DebconfFilter(self.db, {
+            '^foo': first,
+            r'(a)\1': second,
+            r'(?P<b>b)(?P=b)': third,
+        })
+        self.assertIsNotNone(dbfilter.widget_matcher)
+        self.assertEqual([second], dbfilter.match_widgets('xaa'))
+        self.assertEqual([first, third], dbfilter.match_widgets('foobb'))
+        self.assertEqual([], dbfilter.match_widgets('xab'))
+
+    def test_find_widgets_uncombinable_names(self):
+        widget = Widget()
+        dbfilter = debconffilter.DebconfFilter(
+            self.db, {'(?P<x>a)/': widget, '(?P<x>b)/': widget})
+        self.assertIsNone(dbfilter.widget_matcher)
+        self.assertEqual([widget], dbfilter.find_widgets(['b/c']))
+
+    def test_replace_widgets(self):
+        widget = Widget()
+        dbfilter = debconffilter.DebconfFilter(self.db, {'^a/': widget})
+        self.assertEqual([widget], dbfilter.find_widgets(['a/b']))
+        dbfilter.widgets = {'^b/': widget}
+        self.assertEqual([], dbfilter.find_widgets(['a/b']))
+
+    def test_trace(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        commands = os.path.join(tmpdir, 'commands')
+        with open(commands, 'w') as f:
+            f.write('INPUT critical partman/choose_partition\n')
+            f.write('GET partman/filter_mounted\n')
+        self.db.command.return_value = 'true'
+        widget = Widget()
+        dbfilter = debconffilter.DebconfFilter(
+            self.db, {'^partman/choose_partition$': widget})
+        dbfilter.subin = io.StringIO()
+        dbfilter.subout = None
+        dbfilter.next_go_backup = False
+        with mock.patch.dict(
+                'os.environ', {debconffilter.TRACE_DIR_ENV: tmpdir}):
+            dbfilter.open_trace(['log-output', '/bin/partman'])
+        with open(commands, 'rb') as f:
+            dbfilter.subout_fd = f.fileno()
+            while dbfilter.process_line():
+                pass
+        dbfilter.wait()
+
+        traces = [name for name in os.listdir(tmpdir)
+                  if name.endswith('.trace')]
+        self.assertEqual(1, len(traces))
+        self.assertTrue(traces[0].startswith('partman.'))
+        with open(os.path.join(tmpdir, traces[0])) as f:
+            lines = f.read().splitlines()
+        self.assertEqual({
+            'command': ['log-output', '/bin/partman'],
+            'widgets': ['^partman/choose_partition$'],
+            'automatic': False,
+        }, json.loads(lines[0][2:]))
+        self.assertEqual([
+            ('<', 'INPUT critical partman/choose_partition'),
+            ('>', '0 question will be asked'),
+            ('<', 'GET partman/filter_mounted'),
+            ('>', '0 true'),
+        ], [tuple(line.split(' ', 2)[1:]) for line in lines[1:]])
+
+    def test_tryreadline(self):
+        read_fd, write_fd = os.pipe()
+        self.addCleanup(os.close, read_fd)
+        os.set_blocking(read_fd, False)
+        dbfilter = debconffilter.DebconfFilter(self.db, read_size=8)
+        dbfilter.subout_fd = read_fd
+        self.assertIsNone(dbfilter.tryreadline())
+        self.assertTrue(dbfilter.read_blocked)
+        os.write(write_fd, b'GO\nSET a/b \xc3\xa9\nINPUT high some/long-qu')
+        self.assertEqual('GO\n', dbfilter.tryreadline())
+        self.assertFalse(dbfilter.read_blocked)
+        self.assertEqual('SET a/b é\n', dbfilter.tryreadline())
+        self.assertIsNone(dbfilter.tryreadline())
+        os.write(write_fd, b'estion\nSTOP')
+        self.assertEqual('INPUT high some/long-question\n',
+                         dbfilter.tryreadline())
+        self.assertIsNone(dbfilter.tryreadline())
+        os.close(write_fd)
+        self.assertEqual('STOP', dbfilter.tryreadline())
+        self.assertEqual('', dbfilter.tryreadline())
@@ -41,3 +41,29 @@ class FilteredCommandTests(unittest.TestCase):
         variant = b"English"
         filteredcommand.UntrustedBase.debug(
             "Unknown keyboard variant %s", variant)
+
+    def test_process_input_drains_lines(self):
+        command = filteredcommand.FilteredCommand(mock.Mock())
+        command.dbfilter = mock.Mock(subout_fd=3)
+        blocked = iter([False, False, True])
+
+        def process_line():
+            command.dbfilter.read_blocked = next(blocked)
+            return True
+
+        command.dbfilter.process_line.side_effect = process_line
+        self.assertTrue(command.process_input(
+            3, filteredcommand.DEBCONF_IO_IN))
+        self.assertEqual(3, command.dbfilter.process_line.call_count)
+        command.frontend.debconffilter_done.assert_not_called()
+
+    def test_process_input_eof(self):
+        command = filteredcommand.FilteredCommand(mock.Mock())
+        command.command = ['true']
+        command.dbfilter = mock.Mock(subout_fd=3, read_blocked=False)
+        command.dbfilter.process_line.return_value = False
+        command.dbfilter.wait.return_value = 0
+        self.assertFalse(command.process_input(
+            3, filteredcommand.DEBCONF_IO_IN))
+        self.assertEqual(1, command.dbfilter.process_line.call_count)
+        command.frontend.debconffilter_done.assert_called_once_with(command)
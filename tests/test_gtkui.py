@@ -58,6 +58,7 @@ class TestFrontend(unittest.TestCase):
         from ubiquity.frontend import gtk_ui
 
         ui = gtk_ui.Wizard('test-ubiquity')
+        ui.build_all_pages()
         ui.translate_pages()
         for page in ui.pages:
             ui.set_page(page.module.NAME)
@@ -85,6 +86,7 @@ class TestFrontend(unittest.TestCase):
         from ubiquity.frontend import gtk_ui
 
         ui = gtk_ui.Wizard('test-ubiquity')
+        ui.build_all_pages()
         missing_translations = []
         with mock.patch.object(ui, 'translate_widget') as translate_widget:
             def side_effect(widget, lang=None, prefix=None):
@@ -0,0 +1,136 @@
+#! /usr/bin/python3
+
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+# These tests require Mock 0.7.0
+import mock
+
+from ubiquity import i18n
+
+
+TEMPLATES = '''\
+Name: ubiquity/text/step_name
+Description: Who are you?
+Description-de.UTF-8: Wer sind Sie?
+Description-pt_br.UTF-8: Quem é você?
+Type: text
+
+Name: ubiquity/text/error_updating_installer
+Description: Update failed
+Description-fr.UTF-8: La mise à jour a échoué
+Extended_description: It didn't work.
+Extended_description-fr.UTF-8: Ça n'a pas marché.
+Type: note
+
+Name: partman-crypto/text/specify_cipher
+Description: Encryption: [ context ]
+Description-de.UTF-8: Verschlüsselung:
+Type: text
+
+Name: other/question
+Description: Not ours
+Type: text
+'''
+
+OVERRIDE = '''\
+Name: ubiquity/text/step_name
+Description: Who are you, really?
+Type: text
+'''
+
+
+class CatalogueTests(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.templates = os.path.join(self.root, 'templates.dat')
+        self.override = os.path.join(self.root, 'override.dat')
+        self.write(self.templates, TEMPLATES)
+        config = os.path.join(self.root, 'debconf.conf')
+        self.write(config, (
+            'Config: configdb\nTemplates: templatedb\n\n'
+            'Name: configdb\nDriver: File\nFilename: %s/config.dat\n\n'
+            'Name: override\nDriver: File\nFilename: %s\n\n'
+            'Name: system\nDriver: File\nFilename: %s\n\n'
+            '# Comments are ignored.\n'
+            'Name: templatedb\nDriver: Stack\nStack: override, system\n' %
+            (self.root, self.override, self.templates)))
+        for target, value in (
+                ('os.environ', {'DEBCONF_SYSTEMRC': config}),
+                ('ubiquity.i18n.CATALOGUE_FILE',
+                 os.path.join(self.root, 'translations.cat')),
+                ('ubiquity.i18n._catalogue', None),
+                ('ubiquity.i18n._translations', None)):
+            patcher = mock.patch(target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def write(self, path, text):
+        with open(path, 'w') as f:
+            f.write(text)
+
+    def test_template_files(self):
+        self.assertEqual(i18n.debconf_template_files(),
+                         [self.override, self.templates])
+
+    def test_matches_templates(self):
+        with open(self.templates, 'rb') as lines:
+            expected = dict(i18n._read_templates(lines, lambda *args: True))
+        translations = i18n.get_translations(extra_prefixes=['other'])
+        self.assertEqual(
+            {question: dict(translations[question])
+             for question in translations}, expected)
+        self.assertEqual(
+            translations['partman-crypto/text/specify_cipher']['c'],
+            'Encryption: ')
+        error = translations['ubiquity/text/error_updating_installer']
+        self.assertEqual(error['extended:fr'], 'Ça n\'a pas marché.')
+
+    def test_lazy_languages(self):
+        i18n.get_translations(languages=['de_DE.UTF-8'])
+        self.assertEqual(i18n.get_string('step_name', 'de_DE.UTF-8'),
+                         'Wer sind Sie?')
+        self.assertEqual(i18n.get_string('step_name', 'fr_FR'),
+                         'Who are you?')
+        self.assertIsNone(i18n.get_string('question', 'de', 'other'))
+        self.assertNotIn('pt_br', i18n._catalogue.loaded)
+        self.assertNotIn('fr', i18n._catalogue.loaded)
+
+    def test_filters(self):
+        i18n.get_translations(languages=['de'],
+                              core_names=['ubiquity/text/step_name'])
+        self.assertEqual(i18n.get_string('step_name', 'pt_BR'),
+                         'Quem é você?')
+        self.assertEqual(i18n.get_string('specify_cipher', 'fr',
+                                         'partman-crypto/text'),
+                         'Encryption: ')
+
+    def test_rebuild(self):
+        with mock.patch('ubiquity.i18n.build_catalogue',
+                        side_effect=i18n.build_catalogue) as mock_build:
+            i18n.get_translations(languages=['c'])
+            i18n._catalogue = None
+            i18n.get_translations(languages=['c'])
+            self.assertEqual(1, mock_build.call_count)
+            self.assertTrue(os.path.exists(i18n.CATALOGUE_FILE))
+            self.write(self.override, OVERRIDE)
+            i18n.get_translations(languages=['c'])
+            self.assertEqual(2, mock_build.call_count)
+        self.assertEqual(i18n.get_string('step_name', None),
+                         'Who are you, really?')
+        self.assertEqual(i18n.get_string('step_name', 'de'),
+                         'Who are you, really?')
+
+    def test_copydb_fallback(self):
+        with mock.patch('ubiquity.i18n.debconf_template_files',
+                        return_value=None):
+            with mock.patch('subprocess.Popen') as mock_popen:
+                mock_popen.return_value.stdout = io.BytesIO(
+                    TEMPLATES.encode())
+                translations = i18n.get_translations(languages=['de'])
+        self.assertEqual(translations['ubiquity/text/step_name'],
+                         {'c': 'Who are you?', 'de': 'Wer sind Sie?'})
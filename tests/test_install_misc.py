@@ -1,11 +1,63 @@
 #! /usr/bin/python3
 
+import errno
+import hashlib
 import os
 import shutil
+import stat
 import tempfile
+import threading
 import unittest
 
-from ubiquity import install_misc
+# These tests require Mock 0.7.0
+import mock
+
+from ubiquity import copy_manifest, install_misc
+
+
+class FakeVersion:
+    def __init__(self, parent_pkg, version_id):
+        self.parent_pkg = parent_pkg
+        self.id = version_id
+        self.depends_list = {}
+
+
+class FakeDependency:
+    def __init__(self, targets):
+        self.targets = targets
+
+    def all_targets(self):
+        return self.targets
+
+
+class FakePackage:
+    def __init__(self, name, version_id):
+        self.name = name
+        self.current_ver = FakeVersion(self, version_id)
+
+    def get_fullname(self, pretty=False):
+        return self.name
+
+
+def fake_apt_cache(depends):
+    """Build a cache of installed packages.
+
+    depends maps each package name to a list of alternative groups, each a
+    list of package names.
+    """
+    packages = {}
+    for i, name in enumerate(sorted(depends)):
+        packages[name] = FakePackage(name, i)
+    for name, groups in depends.items():
+        packages[name].current_ver.depends_list['Depends'] = [
+            [FakeDependency([packages[target].current_ver])
+             for target in group]
+            for group in groups]
+    cache = mock.MagicMock()
+    cache._cache.packages = list(packages.values())
+    cache._depcache.marked_delete.return_value = False
+    cache._depcache.broken_count = 0
+    return cache
 
 
 class InstallMiscTests(unittest.TestCase):
@@ -108,3 +160,453 @@ class InstallMiscTests(unittest.TestCase):
             self.target_path("source-file-target-non-empty-dir.bak")))
         self.assertTrue(os.path.isfile(
             self.target_path("source-file-target-non-empty-dir.bak/file")))
+
+    def test_path_index_contains(self):
+        index = install_misc.PathIndex([
+            "/.", "/usr", "/usr/share/doc/foo/copyright",
+            "/usr/share/doc/bar/copyright", "/vmlinuz",
+            "diverted by baz to: /usr/bin/foo.real",
+        ])
+        self.assertEqual(2, len(index))
+        self.assertTrue(index.contains("usr/share/doc/foo", "copyright"))
+        self.assertTrue(index.contains("usr/share/doc/bar", "copyright"))
+        self.assertFalse(index.contains("usr/share/doc", "bar"))
+        self.assertFalse(index.contains("usr/share/doc/baz", "copyright"))
+        self.assertFalse(index.contains("", "vmlinuz"))
+        self.assertFalse(index.contains("usr/bin", "foo.real"))
+
+    def test_path_index_find_prunable(self):
+        for relpath in ("a/gone/sub", "a/kept"):
+            os.makedirs(self.source_path(relpath))
+        for relpath in ("a/gone/file", "a/gone/sub/file", "a/kept/file",
+                        "a/kept/other"):
+            with open(self.source_path(relpath), "w"):
+                pass
+        index = install_misc.PathIndex([
+            "/a/gone", "/a/gone/file", "/a/gone/sub", "/a/gone/sub/file",
+            "/a/kept", "/a/kept/file",
+        ])
+        self.assertEqual(2, index.find_prunable(self.source))
+        self.assertTrue(index.prunable("a", "gone"))
+        self.assertTrue(index.prunable("a/gone", "sub"))
+        self.assertFalse(index.prunable("a", "kept"))
+        self.assertEqual(["a/gone/sub"],
+                         list(index.pruned_directories("a/gone")))
+
+    def test_walk_tree_creates_pruned_directories(self):
+        for relpath in ("usr/share/foo/a", "usr/share/foo/sub/b",
+                        "usr/share/kept"):
+            os.makedirs(self.source_path(relpath))
+        for relpath in ("usr/share/foo/file", "usr/share/foo/a/file",
+                        "usr/share/foo/sub/b/file", "usr/share/kept/file"):
+            with open(self.source_path(relpath), "w"):
+                pass
+        index = install_misc.PathIndex([
+            "/usr/share/foo", "/usr/share/foo/a", "/usr/share/foo/a/file",
+            "/usr/share/foo/file", "/usr/share/foo/sub",
+            "/usr/share/foo/sub/b", "/usr/share/foo/sub/b/file",
+        ])
+        self.assertEqual(4, index.find_prunable(self.source))
+        directories = {
+            "usr", "usr/share", "usr/share/foo", "usr/share/foo/a",
+            "usr/share/foo/sub", "usr/share/foo/sub/b", "usr/share/kept"}
+        manifest = os.path.join(self.target, "manifest")
+        squashfs = os.path.join(self.target, "filesystem.squashfs")
+        with open(squashfs, "w"):
+            pass
+        copy_manifest.write_manifest(
+            copy_manifest.scan(self.source), manifest, squashfs)
+        for source in (None, copy_manifest.read_manifest(manifest)):
+            walked = list(install_misc.walk_tree(self.source, source, index))
+            relpaths = [relpath for relpath, _ in walked]
+            self.assertEqual(
+                directories,
+                {relpath for relpath, st in walked
+                 if stat.S_ISDIR(st.st_mode)})
+            self.assertEqual(
+                directories | {"usr/share/kept/file"}, set(relpaths))
+            self.assertLess(relpaths.index("usr/share/foo/sub"),
+                            relpaths.index("usr/share/foo/sub/b"))
+
+    def test_removal_planner_only_breaks_when_all_alternatives_go(self):
+        planner = install_misc.RemovalPlanner(fake_apt_cache({
+            'app': [['libfoo'], ['gui-a', 'gui-b']],
+            'libfoo': [],
+            'gui-a': [],
+            'gui-b': [],
+            'tool': [['app']],
+        }))
+        self.assertEqual({'gui-a'}, planner.closure(['gui-a']))
+        self.assertEqual({'gui-a', 'gui-b', 'app', 'tool'},
+                         planner.closure(['gui-a', 'gui-b']))
+        self.assertEqual({'libfoo', 'app', 'tool'},
+                         planner.closure(['libfoo']))
+        # closure doesn't record anything.
+        self.assertEqual(set(), planner.removed)
+        planner.remove(['gui-a'])
+        self.assertEqual({'gui-b', 'app', 'tool'}, planner.closure(['gui-b']))
+        self.assertEqual(set(), planner.closure(['gui-a', 'missing']))
+
+    def test_removal_planner_get_remove_list(self):
+        depends = {
+            'app': [['libfoo']],
+            'libfoo': [],
+            'tool': [],
+        }
+        planner = install_misc.RemovalPlanner(fake_apt_cache(depends))
+        self.assertEqual({'tool'},
+                         planner.get_remove_list(['libfoo', 'tool']))
+        planner = install_misc.RemovalPlanner(fake_apt_cache(depends))
+        self.assertEqual({'app', 'libfoo'},
+                         planner.get_remove_list(['libfoo', 'app']))
+        planner = install_misc.RemovalPlanner(fake_apt_cache(depends))
+        self.assertEqual({'app', 'libfoo'},
+                         planner.get_remove_list(['libfoo'], recursive=True))
+
+    @mock.patch('syslog.syslog')
+    @mock.patch('ubiquity.install_misc.get_remove_list_apt')
+    def test_get_remove_list_falls_back_to_apt(self, get_remove_list_apt,
+                                               mock_syslog):
+        cache = fake_apt_cache({'app': [], 'tool': []})
+        self.assertEqual({'app'}, install_misc.get_remove_list(cache, ['app']))
+        cache['app'].mark_delete.assert_called_once_with(
+            auto_fix=False, purge=True)
+        self.assertFalse(get_remove_list_apt.called)
+
+        cache._depcache.broken_count = 1
+        get_remove_list_apt.return_value = set()
+        self.assertEqual(set(), install_misc.get_remove_list(cache, ['app']))
+        cache['app'].mark_keep.assert_called_once_with()
+        get_remove_list_apt.assert_called_once_with(cache, ['app'], False)
+
+    @mock.patch('syslog.syslog')
+    @mock.patch('subprocess.Popen')
+    def test_chrex_parallel_starts_everything_before_waiting(
+            self, mock_popen, mock_syslog):
+        events = []
+        procs = [mock.Mock(), mock.Mock()]
+        mock_popen.side_effect = procs
+        for i, proc in enumerate(procs):
+            proc.stdin.write.side_effect = (
+                lambda data, i=i: events.append(('write', i)))
+            proc.wait.side_effect = (
+                lambda i=i: events.append(('wait', i)) or i)
+        self.assertFalse(install_misc.chrex_parallel('/target', [
+            (['python3', '-m', 'compileall', '-i', '-'], 'a.py\nb.py\n'),
+            (['py3compile', '/usr/share/python3/'], None),
+        ]))
+        self.assertEqual(2, mock_popen.call_count)
+        self.assertEqual(
+            ['log-output', '-t', 'ubiquity', 'chroot', '/target',
+             'py3compile', '/usr/share/python3/'],
+            mock_popen.call_args[0][0])
+        procs[0].stdin.write.assert_called_once_with('a.py\nb.py\n')
+        self.assertEqual(
+            [('write', 0), ('wait', 0), ('wait', 1)], events)
+
+    def test_stage_scheduler_respects_dependencies(self):
+        scheduler = install_misc.StageScheduler()
+        order = []
+        both_running = threading.Barrier(2, timeout=5)
+
+        def stage(name, wait=False):
+            def func():
+                if wait:
+                    both_running.wait()
+                order.append(name)
+            return func
+
+        Stage = install_misc.Stage
+        scheduler.run_group([
+            Stage('first', stage('first'), main=True),
+            Stage('a', stage('a', wait=True), after=['first']),
+            Stage('b', stage('b', wait=True), after=['first']),
+            Stage('last', stage('last'), after=['a', 'b']),
+        ])
+        self.assertEqual('first', order[0])
+        self.assertEqual({'a', 'b'}, set(order[1:3]))
+        self.assertEqual('last', order[3])
+        self.assertEqual(
+            {('first', 'ok'), ('a', 'ok'), ('b', 'ok'), ('last', 'ok')},
+            {(timing[0], timing[4]) for timing in scheduler.timings})
+        self.assertIn('last', scheduler.report())
+
+    @mock.patch('syslog.syslog')
+    def test_stage_scheduler_failures(self, mock_syslog):
+        def fail():
+            raise IOError('oops')
+
+        Stage = install_misc.Stage
+        on_error = mock.Mock()
+        ran = []
+        install_misc.StageScheduler().run_group([
+            Stage('fail', fail, error_message='Could not fail:',
+                  on_error=on_error),
+            Stage('after', lambda: ran.append('after'), after=['fail']),
+        ])
+        on_error.assert_called_once_with()
+        self.assertEqual(['after'], ran)
+
+        ran = []
+        with self.assertRaises(IOError):
+            install_misc.StageScheduler().run_group([
+                Stage('fail', fail),
+                Stage('after', lambda: ran.append('after'), after=['fail']),
+            ])
+        self.assertEqual([], ran)
+
+        with self.assertRaises(ValueError):
+            install_misc.StageScheduler().run_group([
+                Stage('a', fail, after=['b']),
+                Stage('b', fail, after=['a']),
+            ])
+
+    def test_stage_scheduler_serialises_db_commands(self):
+        class FakeDb:
+            def command(self, *args):
+                return args
+
+        db = FakeDb()
+        scheduler = install_misc.StageScheduler(db)
+        results = []
+        scheduler.run_group([
+            install_misc.Stage(
+                'get', lambda: results.append(db.command('GET', 'q')))])
+        self.assertEqual([('GET', 'q')], results)
+        self.assertNotIn('command', vars(db))
+
+    @mock.patch('time.time')
+    def test_progress_channel_coalesces_updates(self, mock_time):
+        mock_time.return_value = 100.0
+        db = mock.Mock()
+        progress = install_misc.ProgressChannel(db, interval=0.1)
+        progress.set(1)
+        progress.set(2)
+        progress.set(3)
+        progress.info('foo/info', DESCRIPTION='one')
+        progress.info('foo/info', DESCRIPTION='two')
+        # A new INFO template goes out at once, with the latest SET.
+        self.assertEqual([
+            mock.call.progress('SET', 1),
+            mock.call.progress('SET', 3),
+            mock.call.subst('foo/info', 'DESCRIPTION', 'one'),
+            mock.call.progress('INFO', 'foo/info'),
+        ], db.mock_calls)
+        self.assertAlmostEqual(0.1, progress.timeout())
+
+        db.reset_mock()
+        mock_time.return_value = 100.5
+        progress.set(3)
+        progress.set(4)
+        self.assertEqual([
+            mock.call.subst('foo/info', 'DESCRIPTION', 'two'),
+            mock.call.progress('INFO', 'foo/info'),
+        ], db.mock_calls)
+
+        db.reset_mock()
+        progress.set(5)
+        progress.flush()
+        self.assertEqual([mock.call.progress('SET', 5)], db.mock_calls)
+        self.assertIsNone(progress.timeout())
+
+        db.reset_mock()
+        progress.set(5)
+        progress.info('foo/info', DESCRIPTION='two')
+        progress.flush()
+        self.assertEqual([], db.mock_calls)
+        self.assertEqual(13, progress.updates)
+        self.assertEqual(7, progress.round_trips)
+
+    def copy_tree(self, workers, md5_check=True, db=None):
+        copier = install_misc.FileCopier(db, md5_check, workers)
+        try:
+            for name in sorted(os.listdir(self.source)):
+                sourcepath = self.source_path(name)
+                copier.submit(sourcepath, self.target_path(name),
+                              os.lstat(sourcepath))
+            while copier.pending:
+                copier.wait()
+        finally:
+            copier.shutdown()
+        return copier
+
+    def test_file_copier_copies_data_and_metadata(self):
+        for i in range(20):
+            with open(self.source_path("file%d" % i), "w") as f:
+                f.write("contents %d\n" % i * (i + 1))
+            os.chmod(self.source_path("file%d" % i), 0o600 + i % 8)
+            os.utime(self.source_path("file%d" % i), (1000000 + i, 2000000))
+        for workers in (1, 4):
+            copier = self.copy_tree(workers)
+            self.assertEqual(
+                sum(os.path.getsize(self.source_path("file%d" % i))
+                    for i in range(20)),
+                copier.copied_size)
+            for i in range(20):
+                with open(self.target_path("file%d" % i)) as f:
+                    self.assertEqual("contents %d\n" % i * (i + 1), f.read())
+                st = os.lstat(self.target_path("file%d" % i))
+                self.assertEqual(0o600 + i % 8, st.st_mode & 0o7777)
+                self.assertEqual(2000000, st.st_mtime)
+
+    @mock.patch('syslog.syslog')
+    @mock.patch('ubiquity.install_misc.Cache')
+    def test_apt_cache_shared_until_dpkg_changes(self, mock_cache,
+                                                 mock_syslog):
+        base = install_misc.InstallBase()
+        base.target = self.target
+        os.makedirs(self.target_path('var/lib/dpkg'))
+        status = self.target_path('var/lib/dpkg/status')
+        with open(status, 'w') as f:
+            f.write('Package: foo\n')
+        cache = mock_cache.return_value
+        cache._depcache.inst_count = 0
+        cache._depcache.del_count = 0
+        self.assertIs(cache, base.apt_cache())
+        self.assertIs(cache, base.apt_cache())
+        self.assertEqual(1, mock_cache.call_count)
+        cache.open.assert_not_called()
+        cache.clear.assert_not_called()
+
+        # Changes that nobody committed are dropped.
+        cache._depcache.inst_count = 1
+        base.apt_cache()
+        cache.clear.assert_called_once_with()
+        cache._depcache.inst_count = 0
+
+        with open(status, 'a') as f:
+            f.write('\nPackage: bar\n')
+        self.assertIs(cache, base.apt_cache())
+        cache.open.assert_called_once_with(None)
+        self.assertEqual(2, base.apt_cache_opens)
+
+    @mock.patch('ubiquity.install_misc.verify_fd')
+    def test_file_copier_asks_about_mismatch_in_caller(self, verify_fd):
+        with open(self.source_path("file"), "w") as f:
+            f.write("contents\n")
+        verify_fd.side_effect = [(False, 9), (True, 9)]
+        db = mock.Mock()
+        db.get.return_value = 'retry'
+        self.copy_tree(2, db=db)
+        db.input.assert_called_once_with(
+            'critical', 'ubiquity/install/copying_error/md5')
+        self.assertEqual(2, verify_fd.call_count)
+
+    @mock.patch('ubiquity.install_misc.LARGE_FILE_SIZE', 100000)
+    @mock.patch('ubiquity.install_misc.BATCH_MAX_FILES', 3)
+    def test_file_copier_batches_small_files_per_directory(self):
+        for d in range(3):
+            os.mkdir(self.source_path("dir%d" % d))
+            os.mkdir(self.target_path("dir%d" % d))
+            for i in range(5):
+                with open(self.source_path("dir%d/file%d" % (d, i)),
+                          "w") as f:
+                    f.write("%d %d\n" % (d, i))
+        with open(self.source_path("dir1/large"), "wb") as f:
+            f.write(b"z" * 200000)
+        with open(self.source_path("dir2/medium"), "wb") as f:
+            f.write(b"m" * 70000)
+        for workers in (1, 4):
+            copier = install_misc.FileCopier(None, True, workers)
+            try:
+                for d in range(3):
+                    dirname = "dir%d" % d
+                    for name in sorted(os.listdir(self.source_path(dirname))):
+                        relpath = os.path.join(dirname, name)
+                        copier.submit(self.source_path(relpath),
+                                      self.target_path(relpath),
+                                      os.lstat(self.source_path(relpath)))
+                while copier.pending:
+                    copier.wait()
+            finally:
+                copier.shutdown()
+            for d in range(3):
+                for i in range(5):
+                    with open(self.target_path("dir%d/file%d" % (d, i))) as f:
+                        self.assertEqual("%d %d\n" % (d, i), f.read())
+            with open(self.target_path("dir1/large"), "rb") as f:
+                self.assertEqual(b"z" * 200000, f.read())
+            self.assertEqual(15, copier.size_classes['small'][0])
+            self.assertEqual(1, copier.size_classes['medium'][0])
+            self.assertEqual(1, copier.size_classes['large'][0])
+
+    def test_file_copier_batch_error_names_full_path(self):
+        os.mkdir(self.source_path("dir"))
+        with open(self.source_path("dir/file"), "w") as f:
+            f.write("contents\n")
+        st = os.lstat(self.source_path("dir/file"))
+        copier = install_misc.FileCopier(None, False)
+        try:
+            copier.submit(self.source_path("dir/file"),
+                          self.target_path("dir/file"), st)
+            with self.assertRaises(OSError) as cm:
+                copier.wait()
+        finally:
+            copier.shutdown()
+        self.assertEqual(self.target_path("dir"), cm.exception.filename)
+
+    def test_verify_file_sampled_detects_corruption(self):
+        size = install_misc.VERIFY_SAMPLE_SIZE * 10
+        with open(self.source_path("file"), "wb") as f:
+            f.write(b"a" * size)
+        with open(self.target_path("file"), "wb") as f:
+            f.write(b"a" * (size - 1) + b"b")
+        verified, read_back = install_misc.verify_file(
+            self.source_path("file"), self.target_path("file"), 'sampled')
+        self.assertFalse(verified)
+        with open(self.target_path("file"), "wb") as f:
+            f.write(b"a" * size)
+        verified, read_back = install_misc.verify_file(
+            self.source_path("file"), self.target_path("file"), 'sampled')
+        self.assertTrue(verified)
+        self.assertEqual(install_misc.VERIFY_SAMPLE_SIZE * 3, read_back)
+
+    def test_verify_file_manifest_does_not_read_back(self):
+        with open(self.source_path("file"), "w") as f:
+            f.write("contents\n")
+        md5sums_path = os.path.join(self.target, "md5sums")
+        with open(md5sums_path, "w") as f:
+            f.write("%s  ./file\n" % hashlib.md5(b"contents\n").hexdigest())
+        md5sums = install_misc.load_md5sums(md5sums_path, self.source)
+        expected = md5sums[self.source_path("file")]
+        sourcehash, _ = install_misc.copy_file_data(
+            self.source_path("file"), self.target_path("file"), True)
+        self.assertEqual(
+            (True, 0),
+            install_misc.verify_file(
+                self.source_path("file"), self.target_path("file"),
+                'manifest', sourcehash, expected))
+        self.assertEqual(
+            (False, 0),
+            install_misc.verify_file(
+                self.source_path("file"), self.target_path("file"),
+                'manifest', sourcehash, b"0" * 16))
+
+    def test_copy_file_data_uses_kernel_copy(self):
+        with open(self.source_path("file"), "wb") as f:
+            f.write(b"x" * 100000)
+        with mock.patch.object(
+                install_misc, '_kernel_copy_unsupported', set()):
+            sourcehash, backend = install_misc.copy_file_data(
+                self.source_path("file"), self.target_path("file"))
+        self.assertIsNone(sourcehash)
+        self.assertIn(backend, ('copy_file_range', 'sendfile'))
+        with open(self.target_path("file"), "rb") as f:
+            self.assertEqual(b"x" * 100000, f.read())
+
+    @mock.patch('os.copy_file_range', create=True)
+    def test_copy_file_data_falls_back_from_copy_file_range(
+            self, copy_file_range):
+        copy_file_range.side_effect = OSError(errno.EXDEV, 'Cross-device')
+        with open(self.source_path("file"), "wb") as f:
+            f.write(b"y" * 100000)
+        unsupported = set()
+        with mock.patch.object(
+                install_misc, '_kernel_copy_unsupported', unsupported):
+            sourcehash, backend = install_misc.copy_file_data(
+                self.source_path("file"), self.target_path("file"))
+        self.assertIsNone(sourcehash)
+        self.assertNotEqual('copy_file_range', backend)
+        self.assertIn('copy_file_range', unsupported)
+        with open(self.target_path("file"), "rb") as f:
+            self.assertEqual(b"y" * 100000, f.read())
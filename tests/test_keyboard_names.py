@@ -0,0 +1,92 @@
+#! /usr/bin/python3
+
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+
+# These tests require Mock 0.7.0
+import mock
+
+from ubiquity import keyboard_names
+
+
+KBDNAMES = '''\
+C*model*pc105*Generic 105-key PC (intl.)
+C*layout*us*English (US)
+C*layout*fr*French
+C*variant*us*intl*English (US, intl., with dead keys)
+C*variant*fr*oss*French (alt.)
+de*layout*us*Englisch (US)
+de*layout*fr*Französisch
+de*variant*fr*oss*Französisch (alternativ)
+fr*layout*us*Anglais (US)
+fr*layout*fr*Français
+'''
+
+
+class KeyboardNamesTests(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.filename = os.path.join(self.root, 'kbdnames.gz')
+        self.index_filename = os.path.join(self.root, 'kbdnames-index')
+        self.write(KBDNAMES)
+
+    def write(self, text):
+        with gzip.open(self.filename, 'wb') as kbdnames:
+            kbdnames.write(text.encode('UTF-8'))
+
+    def make(self, cache_size=8):
+        return keyboard_names.KeyboardNames(
+            filename=self.filename, index_filename=self.index_filename,
+            cache_size=cache_size)
+
+    def test_lookups(self):
+        kn = self.make()
+        self.assertTrue(kn.has_language('de'))
+        self.assertFalse(kn.has_language('ja'))
+        self.assertEqual(kn.layout_human('C', 'us'), 'English (US)')
+        self.assertEqual(kn.layout_id('de', 'Französisch'), 'fr')
+        self.assertTrue(kn.has_layout('fr', 'fr'))
+        self.assertFalse(kn.has_variants('fr', 'fr'))
+        self.assertTrue(kn.has_variant('de', 'fr', 'oss'))
+        self.assertFalse(kn.has_variant('de', 'us', 'intl'))
+        self.assertEqual(kn.variant_human('C', 'us', 'intl'),
+                         'English (US, intl., with dead keys)')
+        self.assertEqual(kn.variant_id('de', 'fr', 'Französisch (alternativ)'),
+                         'oss')
+
+    def test_cache(self):
+        kn = self.make(cache_size=2)
+        for lang in ('C', 'de', 'C', 'de'):
+            kn.has_language(lang)
+        self.assertEqual(kn.loads, 2)
+        kn.has_language('fr')
+        kn.has_language('de')
+        self.assertEqual(kn.loads, 3)
+        # C was least recently used.
+        kn.has_language('C')
+        self.assertEqual(kn.loads, 4)
+
+    def test_index_reused(self):
+        self.make().has_language('C')
+        self.assertTrue(os.path.exists(self.index_filename))
+        with mock.patch.object(keyboard_names.KeyboardNames, '_build_index',
+                               side_effect=AssertionError):
+            self.assertEqual(self.make().layout_human('fr', 'fr'),
+                             'Français')
+
+    def test_index_rebuilt(self):
+        self.make().has_language('C')
+        self.write(KBDNAMES + 'ja*layout*us*英語 (US)\n')
+        self.assertEqual(self.make().layout_human('ja', 'us'), '英語 (US)')
+
+    def test_index_unwritable(self):
+        self.index_filename = os.path.join(self.root, 'missing', 'dir',
+                                           'kbdnames-index')
+        with mock.patch('os.makedirs', side_effect=OSError):
+            kn = self.make()
+            self.assertEqual(kn.layout_human('de', 'us'), 'Englisch (US)')
+        self.assertFalse(os.path.exists(self.index_filename))
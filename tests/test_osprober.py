@@ -0,0 +1,109 @@
+#! /usr/bin/python3
+
+import os
+import shutil
+import tempfile
+import unittest
+
+# These tests require Mock 0.7.0
+import mock
+
+from ubiquity import osprober
+
+
+class OSProberTests(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.sys_block = os.path.join(self.root, 'sys')
+        self.by_uuid = os.path.join(self.root, 'by-uuid')
+        os.makedirs(self.by_uuid)
+        for name, value in (('SYS_BLOCK', self.sys_block),
+                            ('BY_UUID', self.by_uuid)):
+            patcher = mock.patch('ubiquity.osprober.%s' % name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.add_device('sda1', '1000', 'aaaa')
+        self.add_device('sda2', '2000', 'bbbb')
+
+        self.output = os.path.join(self.root, 'output')
+        self.calls = os.path.join(self.root, 'calls')
+        script = os.path.join(self.root, 'os-prober')
+        with open(script, 'w') as f:
+            f.write('#! /bin/sh\necho >>%s\ncat %s\n' %
+                    (self.calls, self.output))
+        os.chmod(script, 0o755)
+        self.write_output(
+            '/dev/sda1@/efi/Microsoft/Boot/bootmgfw.efi:'
+            'Windows Boot Manager:Windows:efi\n'
+            '/dev/sda2:Ubuntu 20.04 LTS (20.04):Ubuntu:linux\n')
+        self.prober = osprober.OSProber(command=[script])
+
+    def add_device(self, name, size, uuid):
+        os.makedirs(os.path.join(self.sys_block, name), exist_ok=True)
+        with open(os.path.join(self.sys_block, name, 'size'), 'w') as f:
+            f.write('%s\n' % size)
+        link = os.path.join(self.by_uuid, uuid)
+        if os.path.lexists(link):
+            os.unlink(link)
+        os.symlink('/dev/%s' % name, link)
+
+    def write_output(self, text):
+        with open(self.output, 'w') as f:
+            f.write(text)
+
+    def count_calls(self):
+        with open(self.calls) as f:
+            return len(f.readlines())
+
+    def test_results(self):
+        self.prober.start()
+        found = self.prober.results()
+        self.assertEqual(
+            found['/dev/sda1'][1:], ['Windows Boot Manager', 'Windows', 'efi'])
+        self.assertEqual(found['/dev/sda2'][2], 'Ubuntu')
+        self.assertEqual(self.prober.signatures['/dev/sda2'],
+                         ('bbbb', '2000'))
+        self.prober.results()
+        self.assertEqual(self.count_calls(), 1)
+
+    def test_invalidate_unchanged(self):
+        self.prober.results()
+        # A new partition can't hold an operating system yet.
+        self.add_device('sda3', '3000', 'cccc')
+        self.prober.invalidate()
+        self.prober.results()
+        self.assertEqual(self.count_calls(), 1)
+
+    def test_invalidate_resized(self):
+        self.prober.results()
+        self.add_device('sda2', '1500', 'bbbb')
+        self.write_output('/dev/sda2:Ubuntu 20.04 LTS (20.04):Ubuntu:linux\n')
+        self.prober.invalidate()
+        # os-prober isn't run again until somebody asks.
+        self.assertEqual(self.count_calls(), 1)
+        self.assertEqual(list(self.prober.found), ['/dev/sda1'])
+        found = self.prober.results()
+        self.assertEqual(self.count_calls(), 2)
+        self.assertEqual(list(found), ['/dev/sda2'])
+        self.assertEqual(self.prober.signatures['/dev/sda2'],
+                         ('bbbb', '1500'))
+
+    def test_invalidate_while_probing(self):
+        thread = mock.Mock()
+        self.prober.thread = thread
+        self.prober.invalidate()
+        thread.join.assert_not_called()
+        self.assertTrue(self.prober.stale)
+        # The results of the probe already running are thrown away.
+        self.prober.thread = None
+        self.prober.found = {}
+        self.prober.results()
+        self.assertEqual(self.count_calls(), 1)
+        self.assertFalse(self.prober.stale)
+        self.assertEqual(len(self.prober.found), 2)
+
+    def test_missing_command(self):
+        prober = osprober.OSProber(
+            command=[os.path.join(self.root, 'missing')])
+        self.assertEqual(prober.results(), {})
@@ -0,0 +1,204 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; -*-
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import mock
+
+from ubiquity import parted_server
+
+
+class FakePartedServer:
+    """Speak the parted_server side of the FIFO protocol from a thread.
+
+    Like the real thing, this handles one command per dialog and then goes
+    through the same stopfifo rendezvous as PartedServer.close_dialog.
+    disks maps disk identifiers to (label, max_primary, partitions), where
+    partitions is a list of PARTITIONS rows.
+    """
+
+    def __init__(self, directory, disks):
+        self.directory = directory
+        self.disks = disks
+        self.commands = []
+        self.devices = os.path.join(directory, 'devices')
+        self.infifo = os.path.join(directory, 'infifo')
+        self.outfifo = os.path.join(directory, 'outfifo')
+        self.stopfifo = os.path.join(directory, 'stopfifo')
+        self.logfile = os.path.join(directory, 'partman')
+        for fifo in (self.infifo, self.outfifo, self.stopfifo):
+            os.mkfifo(fifo)
+        for disk in disks:
+            os.makedirs(os.path.join(self.devices, disk))
+        self.thread = None
+
+    def patch(self):
+        """Point parted_server at our FIFOs until the returned patch stops."""
+        return mock.patch.multiple(
+            parted_server, devices=self.devices, infifo=self.infifo,
+            outfifo=self.outfifo, stopfifo=self.stopfifo,
+            logfile=self.logfile)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        client = parted_server.PartedServer()
+        client.select_disk('')
+        client.open_dialog('QUIT')
+        client.close_dialog()
+        self.thread.join()
+
+    def synchronise(self):
+        with open(self.stopfifo):
+            pass
+
+    def reply(self, command, disk, args):
+        label, max_primary, partitions = self.disks.get(disk, ('', '', []))
+        if command == 'PARTITIONS':
+            return ['\t'.join(row) for row in partitions]
+        elif command == 'PARTITION_INFO':
+            for row in partitions:
+                if row[1] == args[0]:
+                    return ['\t'.join(row)]
+            return []
+        elif command == 'GET_LABEL_TYPE':
+            return [label]
+        elif command == 'GET_MAX_PRIMARY':
+            return [max_primary]
+        return []
+
+    def serve(self):
+        while True:
+            with open(self.infifo) as inf:
+                words = inf.readline().split() + ['']
+                self.commands.append(tuple(words[:-1]))
+                with open(self.outfifo, 'w') as outf:
+                    outf.write('OK\n')
+                    for line in self.reply(words[0], words[1], words[2:-1]):
+                        outf.write(line + '\n')
+                inf.read()
+            self.synchronise()
+            with open(self.outfifo) as outf:
+                outf.read()
+            self.synchronise()
+            with open(self.infifo, 'w'):
+                pass
+            self.synchronise()
+            if words[0] == 'QUIT':
+                break
+
+
+def make_partitions(disk, count):
+    partitions = []
+    offset = 32256
+    for num in range(1, count + 1):
+        size = 1000000 * num
+        partitions.append((
+            str(num), '%d-%d' % (offset, offset + size - 1), str(size),
+            'primary' if num < 4 else 'logical', 'ext4',
+            '/dev/%s%d' % (disk, num), 'part%d' % num))
+        offset += size
+    return partitions
+
+
+class PartedServerTests(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.server = FakePartedServer(directory, {
+            '=dev=sda': ('gpt', '128', make_partitions('sda', 3)),
+            '=dev=sdb': ('msdos', 'unknown', make_partitions('sdb', 2)),
+        })
+        patcher = self.server.patch()
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.log_buffer = parted_server.LogBuffer()
+        patcher = mock.patch.object(
+            parted_server, 'log_buffer', self.log_buffer)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.server.start()
+        self.addCleanup(self.server.stop)
+
+    def test_queries(self):
+        parted = parted_server.PartedServer()
+        self.assertEqual(['=dev=sda', '=dev=sdb'], parted.disks())
+        parted.select_disk('=dev=sda')
+        self.assertEqual(make_partitions('sda', 3), parted.partitions())
+        second = make_partitions('sda', 3)[1]
+        self.assertEqual(second, parted.partition_info(second[1]))
+        self.assertEqual((), parted.partition_info('0-1'))
+        self.assertEqual('gpt', parted.label_type())
+        self.assertEqual(128, parted.max_primary())
+        parted.select_disk('=dev=sdb')
+        self.assertIsNone(parted.max_primary())
+        self.assertEqual(6, parted.dialogs)
+        self.assertEqual(
+            ('PARTITION_INFO', '=dev=sda', '0-1'), self.server.commands[2])
+
+    def test_session_reuses_replies(self):
+        parted = parted_server.PartedServer()
+        with parted.session():
+            for disk in parted.disks():
+                parted.select_disk(disk)
+                self.assertEqual(
+                    parted.label_type(), parted.label_type())
+                for partition in parted.partitions():
+                    self.assertEqual(
+                        partition, parted.partition_info(partition[1]))
+            parted.select_disk('=dev=sda')
+            self.assertEqual((), parted.partition_info('0-1'))
+        self.assertEqual(4, parted.dialogs)
+        self.assertEqual([
+            ('GET_LABEL_TYPE', '=dev=sda'),
+            ('PARTITIONS', '=dev=sda'),
+            ('GET_LABEL_TYPE', '=dev=sdb'),
+            ('PARTITIONS', '=dev=sdb'),
+        ], self.server.commands)
+
+        # Outside the session, we ask again.
+        parted.select_disk('=dev=sda')
+        parted.label_type()
+        self.assertEqual(5, parted.dialogs)
+
+    def read_log(self):
+        try:
+            with open(self.server.logfile) as log:
+                return log.read().splitlines()
+        except FileNotFoundError:
+            return []
+
+    def test_log_written_per_dialog(self):
+        parted = parted_server.PartedServer()
+        parted.select_disk('=dev=sda')
+        parted.label_type()
+        self.assertEqual(['ubiquity: IN: GET_LABEL_TYPE =dev=sda'],
+                         self.read_log())
+        parted.partitions()
+        self.assertEqual(2, self.log_buffer.calls)
+        self.assertEqual(2, self.log_buffer.flushes)
+
+    def test_log_ring(self):
+        self.log_buffer.set_ring(2)
+        parted = parted_server.PartedServer()
+        parted.select_disk('=dev=sda')
+        with self.assertRaises(ValueError):
+            with parted.session():
+                parted.label_type()
+                parted.partitions()
+                parted.max_primary()
+                raise ValueError
+        self.assertEqual([
+            'ubiquity: last 2 log lines before failure:',
+            'ubiquity: IN: PARTITIONS =dev=sda',
+            'ubiquity: IN: GET_MAX_PRIMARY =dev=sda',
+        ], self.read_log())
+        self.assertEqual(3, self.log_buffer.calls)
+        self.assertEqual(1, self.log_buffer.flushes)
@@ -0,0 +1,79 @@
+#! /usr/bin/python3
+
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+
+# These tests require Mock 0.7.0
+import mock
+
+from ubiquity import removal_cache
+
+
+class RemovalCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.casper = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.casper)
+        self.cache_dir = os.path.join(self.casper, removal_cache.CACHE_NAME)
+        status = os.path.join(self.casper, 'status')
+        with open(status, 'w') as f:
+            f.write('Package: foo\n')
+        patcher = mock.patch('ubiquity.removal_cache.DPKG_STATUS', status)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.write_manifest('filesystem.manifest', 'foo 1.0\nbar 2.0\n')
+        self.write_manifest('filesystem.manifest-remove', 'bar\n')
+        self.inputs = {
+            'minimal_install': False, 'restricted': True, 'keep': [],
+            'arch': 'amd64', 'subarch': 'efi', 'altmeta': '',
+            'oem_config': False,
+        }
+
+    def write_manifest(self, name, contents):
+        with open(os.path.join(self.casper, name), 'w') as f:
+            f.write(contents)
+
+    def test_read_packages(self):
+        self.write_manifest(
+            'filesystem.manifest-desktop',
+            '# comment\n\nfoo 1.0\nlibbaz:amd64 3.0\n')
+        self.assertEqual(
+            {'foo', 'libbaz'},
+            removal_cache.read_packages(
+                os.path.join(self.casper, 'filesystem.manifest-desktop')))
+
+    def test_cache_key_depends_on_inputs_and_manifests(self):
+        key = removal_cache.cache_key(self.casper, self.inputs)
+        self.assertEqual(
+            key, removal_cache.cache_key(self.casper, dict(self.inputs)))
+        self.assertNotEqual(
+            key,
+            removal_cache.cache_key(
+                self.casper, dict(self.inputs, minimal_install=True)))
+        self.write_manifest('filesystem.manifest-remove', 'foo\n')
+        self.assertNotEqual(
+            key, removal_cache.cache_key(self.casper, self.inputs))
+
+    def test_store_and_lookup(self):
+        key = removal_cache.cache_key(self.casper, self.inputs)
+        self.assertIsNone(removal_cache.lookup([self.cache_dir], key))
+        removal_cache.store(self.cache_dir, key, ['bar'], ['/usr/bin/bar'])
+        self.assertEqual(
+            (['bar'], ['/usr/bin/bar']),
+            removal_cache.lookup(
+                [os.path.join(self.casper, 'missing'), self.cache_dir], key))
+
+    @mock.patch('syslog.syslog')
+    def test_lookup_ignores_corrupt_entry(self, mock_syslog):
+        os.mkdir(self.cache_dir)
+        with gzip.open(os.path.join(self.cache_dir, 'key.json.gz'),
+                       'wt') as f:
+            f.write('not json')
+        self.assertIsNone(removal_cache.lookup([self.cache_dir], 'key'))
+        self.assertTrue(mock_syslog.called)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+#! /usr/bin/python3
+
+import calendar
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+
+# These tests require Mock 0.7.0
+import mock
+
+from ubiquity import tz
+
+
+@unittest.skipUnless(os.path.exists(tz.TZ_DATA_FILE) and
+                     os.path.exists(tz.ISO_3166_FILE),
+                     'Need tzdata and iso-codes.')
+class ZoneinfoIndexTests(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.index_file = os.path.join(directory, 'zoneinfo-index.json')
+        patcher = mock.patch('ubiquity.tz.INDEX_FILE', self.index_file)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_matches_zoneinfo(self):
+        plain = tz._Database(use_index=False)
+        tz.save_index()
+        self.assertTrue(os.path.exists(self.index_file))
+        indexed = tz._Database()
+        self.assertEqual(indexed.aliases, tz.load_index()['aliases'])
+        self.assertEqual(len(plain.locations), len(indexed.locations))
+        for old, new in zip(plain.locations, indexed.locations):
+            self.assertEqual(
+                (old.zone, old.md5sum, old.utc_offset, old.raw_utc_offset,
+                 old.zone_letters),
+                (new.zone, new.md5sum, new.utc_offset, new.raw_utc_offset,
+                 new.zone_letters))
+        for name in ('US/Eastern', 'posix/Europe/Paris', 'Europe/Paris'):
+            self.assertEqual(plain.get_loc(name).zone,
+                             indexed.get_loc(name).zone)
+
+    @mock.patch('ubiquity.tz.build_index')
+    def test_out_of_date(self, mock_build_index):
+        mock_build_index.side_effect = lambda now: {
+            'version': tz._INDEX_VERSION, 'tzdata': tz._tzdata_stamp(),
+            'start': 1000, 'end': 2000, 'zones': {}, 'aliases': {}}
+        self.assertIsNone(tz.load_index(now=1500))
+        tz.save_index()
+        self.assertIsNotNone(tz.load_index(now=1500))
+        # The offsets have run out.
+        self.assertIsNone(tz.load_index(now=2000))
+        # tzdata has been upgraded.
+        with mock.patch('ubiquity.tz._tzdata_stamp', return_value=[0, 0]):
+            self.assertIsNone(tz.load_index(now=1500))
+        self.assertEqual(1, mock_build_index.call_count)
+
+    @mock.patch('ubiquity.tz.build_index')
+    def test_no_index(self, mock_build_index):
+        # Without an index, each zone is looked up as before rather than
+        # building the index in the installer.
+        database = tz._Database()
+        mock_build_index.assert_not_called()
+        self.assertFalse(os.path.exists(self.index_file))
+        self.assertEqual({}, database.aliases)
+        self.assertEqual('Europe/Paris',
+                         database.get_loc('posix/Europe/Paris').zone)
+
+
+@unittest.skipUnless(os.path.exists(tz.TZ_DATA_FILE), 'Need tzdata.')
+class TzFileTests(unittest.TestCase):
+    def query(self, info, dt):
+        return (info.utcoffset(dt), info.dst(dt), info.rawutcoffset(dt),
+                info.tzname_letters(dt))
+
+    def test_matches_tzset(self):
+        with open(tz.TZ_DATA_FILE) as zone_tab:
+            zones = [line.split('\t')[2].strip() for line in zone_tab
+                     if not line.startswith('#')]
+        # Noon on the first of the month keeps clear of any transition.
+        dates = [datetime.datetime(year, month, 1, 12)
+                 for year in range(1971, 2051, 6) for month in (1, 4, 7, 10)]
+        for zone in zones:
+            info = tz.SystemTzInfo(zone)
+            self.assertIsNotNone(info._tzfile(), zone)
+            for dt in dates:
+                parsed = self.query(info, dt)
+                with mock.patch('ubiquity.tz._load_tzfile',
+                                return_value=None):
+                    expected = self.query(info, dt)
+                self.assertEqual(parsed, expected, '%s at %s' % (zone, dt))
+
+    def test_posix_rule(self):
+        # Chile changes in the southern hemisphere, at 24:00 local time.
+        rule = tz._PosixRule('<-04>4<-03>,M9.1.6/24,M4.1.6/24')
+        winter = calendar.timegm((2021, 7, 1, 0, 0, 0))
+        summer = calendar.timegm((2021, 12, 1, 0, 0, 0))
+        self.assertEqual(rule.info(winter), (-4 * 3600, False, '-04'))
+        self.assertEqual(rule.info(summer), (-3 * 3600, True, '-03'))
+        rule = tz._PosixRule('EST5EDT,M3.2.0,M11.1.0')
+        # 2021-03-14 02:00 EST, and 2021-11-07 02:00 EDT.
+        start = calendar.timegm((2021, 3, 14, 7, 0, 0))
+        end = calendar.timegm((2021, 11, 7, 6, 0, 0))
+        self.assertEqual(rule.info(start - 1)[2], 'EST')
+        self.assertEqual(rule.info(start)[2], 'EDT')
+        self.assertEqual(rule.info(end - 1)[2], 'EDT')
+        self.assertEqual(rule.info(end)[2], 'EST')
+
+    @mock.patch('time.tzset')
+    def test_no_tzset(self, mock_tzset):
+        info = tz.SystemTzInfo('Europe/Paris')
+        dt = datetime.datetime(2020, 7, 1, 12)
+        self.assertEqual(info.utcoffset(dt), datetime.timedelta(hours=2))
+        self.assertEqual(info.tzname_letters(dt), 'CEST')
+        mock_tzset.assert_not_called()
@@ -2,6 +2,8 @@
 
 from itertools import zip_longest
 import os
+import shutil
+import tempfile
 from test.support import run_unittest
 import unittest
 
@@ -441,6 +443,114 @@ class TestPageGrub(TestPageBase):
         })
 
 
+class TestPartitionSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.devpart = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.devpart)
+        with open(os.path.join(self.devpart, 'method'), 'w') as f:
+            f.write('format\n')
+        self.info = ['1', '32256-1000204853759', '1000204821504', 'primary',
+                     'ext4', '/dev/sda1', '']
+        self.snapshot = ubi_partman.PartitionSnapshot()
+
+    def state(self):
+        return self.snapshot.state(self.devpart, 'sda1 ext4', self.info,
+                                   'msdos')
+
+    def test_unchanged_after_commit(self):
+        self.snapshot.record({self.devpart: self.state()})
+        self.assertFalse(self.snapshot.unchanged(self.devpart, self.state()))
+        self.snapshot.commit()
+        self.assertTrue(self.snapshot.unchanged(self.devpart, self.state()))
+
+    def test_changed(self):
+        self.snapshot.record({self.devpart: self.state()})
+        self.snapshot.commit()
+        with open(os.path.join(self.devpart, 'mountpoint'), 'w') as f:
+            f.write('/\n')
+        self.assertFalse(self.snapshot.unchanged(self.devpart, self.state()))
+        os.unlink(os.path.join(self.devpart, 'mountpoint'))
+        self.info[4] = 'btrfs'
+        self.assertFalse(self.snapshot.unchanged(self.devpart, self.state()))
+
+    def test_prune(self):
+        self.snapshot.record({self.devpart: self.state()})
+        self.snapshot.commit()
+        self.snapshot.prune({})
+        self.assertFalse(self.snapshot.unchanged(self.devpart, self.state()))
+
+
+class TestPartitionCacheReuse(unittest.TestCase):
+    def setUp(self):
+        self.page = ubi_partman.Page(None, ui=mock.Mock())
+        self.page.snapshot = ubi_partman.PartitionSnapshot()
+        self.page.partition_cache = {}
+
+    def devpart(self, dev, part_id):
+        return '%s/=dev=%s//%s' % (
+            ubi_partman.parted_server.devices, dev, part_id)
+
+    def states(self, partitions):
+        return {
+            self.devpart(dev, part_id): self.page.snapshot.state(
+                self.devpart(dev, part_id), option,
+                [num, part_id, '1000', 'primary', fs, path, ''], 'msdos')
+            for dev, part_id, num, fs, path, option in partitions}
+
+    def walk(self, states, candidates=None):
+        if candidates is None:
+            candidates = set(states)
+        changed = self.page.changed_partitions(states, candidates)
+        for devpart in changed:
+            self.page.partition_cache[devpart] = {'parted': {}}
+        self.page.snapshot.record(changed)
+        self.page.snapshot.commit()
+        return set(changed)
+
+    def test_unchanged(self):
+        states = self.states([
+            ('sda', '0-999', '1', 'ext4', '/dev/sda1', 'sda1 ext4'),
+            ('sda', '1000-1999', '2', 'ext4', '/dev/sda2', 'sda2 ext4'),
+        ])
+        self.assertEqual(set(states), self.walk(states))
+        self.assertEqual(set(), self.walk(states))
+
+    def test_neighbour_deleted(self):
+        # Deleting sda2 gives sda1 room to grow, so it must be walked again
+        # to pick up its new maximum size, though its own state is the same.
+        sda1 = ('sda', '0-999', '1', 'ext4', '/dev/sda1', 'sda1 ext4')
+        sdb1 = ('sdb', '0-999', '1', 'ext4', '/dev/sdb1', 'sdb1 ext4')
+        self.walk(self.states([
+            sda1,
+            ('sda', '1000-1999', '2', 'ext4', '/dev/sda2', 'sda2 ext4'),
+            sdb1,
+        ]))
+        states = self.states([
+            sda1,
+            ('sda', '1000-1999', '-1', 'free', '/dev/sda-1', 'FREE SPACE'),
+            sdb1,
+        ])
+        self.assertEqual(
+            {self.devpart('sda', '0-999'), self.devpart('sda', '1000-1999')},
+            self.walk(states))
+
+    def test_neighbour_created(self):
+        sda1 = ('sda', '0-999', '1', 'ext4', '/dev/sda1', 'sda1 ext4')
+        self.walk(self.states([
+            sda1,
+            ('sda', '1000-1999', '-1', 'free', '/dev/sda-1', 'FREE SPACE'),
+        ]))
+        states = self.states([
+            sda1,
+            ('sda', '1000-1499', '2', 'ext4', '/dev/sda2', 'sda2 ext4'),
+            ('sda', '1500-1999', '-1', 'free', '/dev/sda-1', 'FREE SPACE'),
+        ])
+        # Only the partitions partman asked about are walked.
+        self.assertEqual(
+            {self.devpart('sda', '0-999')},
+            self.walk(states, {self.devpart('sda', '0-999')}))
+
+
 @unittest.skipUnless('DEBCONF_SYSTEMRC' in os.environ, 'Need a database.')
 class TestCalculateAutopartitioningOptions(unittest.TestCase):
     '''Test that the each expected autopartitioning option exists and is
@@ -803,5 +913,7 @@ if __name__ == '__main__':
         TestPage,
         TestPageGrub,
         TestPageGtk,
+        TestPartitionCacheReuse,
+        TestPartitionSnapshot,
         PartmanPageDirectoryTests,
     )
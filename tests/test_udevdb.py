@@ -0,0 +1,86 @@
+#! /usr/bin/python3
+
+import os
+import shutil
+import tempfile
+import unittest
+
+# These tests require Mock 0.7.0
+import mock
+
+from ubiquity import misc, udevdb
+
+
+class DeviceTableTests(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.sys = os.path.join(self.root, 'sys')
+        self.udev_data = os.path.join(self.root, 'data')
+        os.makedirs(os.path.join(self.sys, 'class', 'block'))
+        os.makedirs(os.path.join(self.sys, 'block'))
+        os.makedirs(self.udev_data)
+        self.add_device('sda', 8, 0, 'devices/pci0000:00/usb1/block/sda',
+                        'disk', ['E:ID_BUS=usb', 'S:disk/by-id/usb-stick'],
+                        removable='1')
+        self.add_device('sda1', 8, 1,
+                        'devices/pci0000:00/usb1/block/sda/sda1',
+                        'partition', ['E:ID_FS_TYPE=vfat'])
+        self.add_device('loop0', 7, 0, 'devices/virtual/block/loop0', 'disk',
+                        [])
+        self.table = udevdb.DeviceTable(sys_root=self.sys,
+                                        udev_data=self.udev_data)
+        patcher = mock.patch('ubiquity.udevdb._table', self.table)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def add_device(self, name, major, minor, devpath, devtype, data,
+                   removable=None):
+        syspath = os.path.join(self.sys, devpath)
+        os.makedirs(syspath)
+        with open(os.path.join(syspath, 'uevent'), 'w') as f:
+            f.write('MAJOR=%d\nMINOR=%d\nDEVNAME=%s\nDEVTYPE=%s\n' %
+                    (major, minor, name, devtype))
+        if removable is not None:
+            with open(os.path.join(syspath, 'removable'), 'w') as f:
+                f.write('%s\n' % removable)
+        os.symlink(syspath, os.path.join(self.sys, 'class', 'block', name))
+        if devtype == 'disk':
+            os.symlink(syspath, os.path.join(self.sys, 'block', name))
+        with open(os.path.join(self.udev_data,
+                               'b%d:%d' % (major, minor)), 'w') as f:
+            f.write(''.join('%s\n' % line for line in data))
+
+    def test_lookup_name(self):
+        props = self.table.lookup_name('/dev/sda1')
+        self.assertEqual(props['DEVPATH'],
+                         '/devices/pci0000:00/usb1/block/sda/sda1')
+        self.assertEqual(props['DEVTYPE'], 'partition')
+        self.assertEqual(props['ID_FS_TYPE'], 'vfat')
+        self.assertEqual(self.table.lookup_name('/dev/sda')['DEVLINKS'],
+                         '/dev/disk/by-id/usb-stick')
+        self.assertIsNone(self.table.lookup_name('/dev/sdb'))
+
+    def test_lookup_path(self):
+        for devpath in ('/sys/devices/virtual/block/loop0',
+                        '/devices/virtual/block/loop0', '/block/loop0'):
+            props = self.table.lookup_path(devpath)
+            self.assertEqual(props['DEVNAME'], '/dev/loop0')
+
+    def test_refresh(self):
+        self.table.lookup_name('/dev/sda')
+        self.table.lookup_name('/dev/sda1')
+        self.assertEqual(self.table.loads, 1)
+        self.add_device('sdb', 8, 16, 'devices/pci0000:00/ata1/block/sdb',
+                        'disk', ['E:ID_BUS=ata'])
+        self.assertEqual(self.table.lookup_name('/dev/sdb')['ID_BUS'], 'ata')
+        self.assertEqual(self.table.loads, 2)
+
+    @mock.patch('subprocess.Popen')
+    def test_misc_helpers(self, mock_popen):
+        self.assertEqual(misc.partition_to_disk('/dev/sda1'), '/dev/sda')
+        self.assertEqual(misc.partition_to_disk('/dev/loop0'), '/dev/loop0')
+        with mock.patch('ubiquity.misc.open', create=True,
+                        side_effect=lambda path: open(self.sys + path[4:])):
+            self.assertEqual(misc.is_removable('/dev/sda1'), '/dev/sda')
+        mock_popen.assert_not_called()
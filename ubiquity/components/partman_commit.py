@@ -17,6 +17,7 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
+from ubiquity import osprober
 from ubiquity.filteredcommand import FilteredCommand
 
 
@@ -42,6 +43,10 @@ class PartmanCommit(FilteredCommand):
         self.done = True
         return True
 
+    def cleanup(self):
+        FilteredCommand.cleanup(self)
+        osprober.get().invalidate()
+
     def run(self, priority, question):
         if self.done:
             return self.succeeded
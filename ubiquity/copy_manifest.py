@@ -0,0 +1,201 @@
+# -*- coding: utf-8; Mode: Python; indent-tabs-mode: nil; tab-width: 4 -*-
+
+# Copyright (C) 2020 Canonical Ltd.
+#
+# Precomputed listing of the live filesystem, so that the installer can copy
+# it without walking and stat'ing the whole source tree.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+# The manifest consists of a header (magic, number of entries, total size
+# of all entries, and the size and modification time of the squashfs built
+# from the same tree) followed by a zlib-compressed list of entries in the
+# order that os.walk visits them, so that directories always come before
+# their contents.  Each entry is a fixed-size record followed by its path
+# relative to the root of the tree and, for symlinks, the link target.
+# The squashfs details let the installer notice a manifest left over from
+# a different image.
+
+import collections
+import errno
+import os
+import stat
+import struct
+import zlib
+
+
+MANIFEST_NAME = 'filesystem.copy-manifest'
+
+_MAGIC = b'UBQCPMF2'
+_header = struct.Struct('<8sQQQQ')
+# mode, uid, gid, size, atime, mtime, rdev, flags, path length, link length
+_record = struct.Struct('<IIIQddQBHH')
+
+_FLAG_XATTRS = 0x1
+
+
+class ManifestError(Exception):
+    """Raised when a manifest cannot be read."""
+
+
+# The st_* names let entries stand in for os.stat_result when copying
+# metadata.
+ManifestEntry = collections.namedtuple(
+    'ManifestEntry', ['relpath', 'st_mode', 'st_uid', 'st_gid', 'st_size',
+                      'st_atime', 'st_mtime', 'st_rdev', 'has_xattrs',
+                      'linkto'])
+
+
+def _has_xattrs(path):
+    if not hasattr(os, 'listxattr'):
+        return False
+    try:
+        return bool(os.listxattr(path, follow_symlinks=False))
+    except OSError as e:
+        if e.errno in (errno.EPERM, errno.ENOTSUP, errno.ENODATA):
+            return False
+        raise
+
+
+def scan(root):
+    """Walk root as copy_all does and yield a ManifestEntry for each path."""
+    for dirpath, dirnames, filenames in os.walk(root):
+        sp = dirpath[len(root) + 1:]
+        for name in dirnames + filenames:
+            relpath = os.path.join(sp, name)
+            path = os.path.join(root, relpath)
+            st = os.lstat(path)
+            if stat.S_ISLNK(st.st_mode):
+                linkto = os.readlink(path)
+            else:
+                linkto = None
+            yield ManifestEntry(
+                relpath, st.st_mode, st.st_uid, st.st_gid, st.st_size,
+                st.st_atime, st.st_mtime, st.st_rdev, _has_xattrs(path),
+                linkto)
+
+
+def squashfs_signature(squashfs):
+    """Return the (size, mtime) recorded in a manifest for squashfs."""
+    st = os.stat(squashfs)
+    return st.st_size, int(st.st_mtime)
+
+
+def write_manifest(entries, path, squashfs):
+    """Write entries, scanned from the tree in squashfs, to path."""
+    squashfs_size, squashfs_mtime = squashfs_signature(squashfs)
+    body = []
+    count = 0
+    total_size = 0
+    for entry in entries:
+        relpath = os.fsencode(entry.relpath)
+        linkto = os.fsencode(entry.linkto) if entry.linkto else b''
+        flags = _FLAG_XATTRS if entry.has_xattrs else 0
+        body.append(_record.pack(
+            entry.st_mode, entry.st_uid, entry.st_gid, entry.st_size,
+            entry.st_atime, entry.st_mtime, entry.st_rdev, flags,
+            len(relpath), len(linkto)))
+        body.append(relpath)
+        body.append(linkto)
+        count += 1
+        total_size += entry.st_size
+    with open(path, 'wb') as manifest:
+        manifest.write(_header.pack(
+            _MAGIC, count, total_size, squashfs_size, squashfs_mtime))
+        manifest.write(zlib.compress(b''.join(body), 9))
+
+
+class Manifest:
+    """A manifest read from disk.
+
+    The whole manifest is checked when it is read, so iterating over this
+    yields ManifestEntry objects in walk order without any errors.
+    """
+
+    def __init__(self, path):
+        try:
+            with open(path, 'rb') as manifest:
+                header = manifest.read(_header.size)
+                if len(header) != _header.size:
+                    raise ManifestError('%s: truncated header' % path)
+                (magic, self.count, self.total_size, self.squashfs_size,
+                 self.squashfs_mtime) = _header.unpack(header)
+                if magic != _MAGIC:
+                    raise ManifestError('%s: bad magic %r' % (path, magic))
+                self._body = zlib.decompress(manifest.read())
+        except zlib.error as e:
+            raise ManifestError('%s: %s' % (path, e))
+        self._check(path)
+
+    def _check(self, path):
+        body = self._body
+        offset = 0
+        total_size = 0
+        unpack_from = _record.unpack_from
+        record_size = _record.size
+        for i in range(self.count):
+            try:
+                record = unpack_from(body, offset)
+            except struct.error:
+                raise ManifestError('%s: entry %d is truncated' % (path, i))
+            size, pathlen, linklen = record[3], record[8], record[9]
+            offset += record_size + pathlen + linklen
+            if not pathlen or offset > len(body):
+                raise ManifestError('%s: entry %d is corrupt' % (path, i))
+            total_size += size
+        if offset != len(body):
+            raise ManifestError('%s: %d bytes after the last entry' %
+                                (path, len(body) - offset))
+        if total_size != self.total_size:
+            raise ManifestError('%s: entries add up to %d bytes, not %d' %
+                                (path, total_size, self.total_size))
+
+    def matches(self, squashfs):
+        """Return True if this manifest was written for squashfs."""
+        try:
+            signature = squashfs_signature(squashfs)
+        except OSError:
+            return False
+        return signature == (self.squashfs_size, self.squashfs_mtime)
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        body = self._body
+        offset = 0
+        unpack_from = _record.unpack_from
+        record_size = _record.size
+        for _ in range(self.count):
+            (mode, uid, gid, size, atime, mtime, rdev, flags, pathlen,
+             linklen) = unpack_from(body, offset)
+            offset += record_size
+            relpath = os.fsdecode(body[offset:offset + pathlen])
+            offset += pathlen
+            if linklen:
+                linkto = os.fsdecode(body[offset:offset + linklen])
+                offset += linklen
+            else:
+                linkto = None
+            yield ManifestEntry(
+                relpath, mode, uid, gid, size, atime, mtime, rdev,
+                bool(flags & _FLAG_XATTRS), linkto)
+
+
+def read_manifest(path):
+    """Read the manifest at path, or return None if there isn't one."""
+    if not os.path.exists(path):
+        return None
+    return Manifest(path)
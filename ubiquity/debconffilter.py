@@ -21,11 +21,13 @@ from __future__ import print_function
 
 import errno
 import fcntl
+import json
 import os
 import re
 import signal
 import subprocess
 import sys
+import time
 
 import debconf
 
@@ -57,6 +59,18 @@ from ubiquity import misc
 # confmodule asks an otherwise-unhandled question whose template has type
 # error.
 
+# If this is set to a directory, each filter writes a trace of the commands
+# it receives and the replies it sends there; see open_trace.
+TRACE_DIR_ENV = 'UBIQUITY_DEBCONF_TRACE'
+
+# The initial size of the buffer we read confmodule output into, and so the
+# most we read at once unless a longer line comes along.
+READ_SIZE = 64 * 1024
+
+# Matches a widget pattern that refers back to one of its own groups, by
+# number or by name; see compile_widgets.
+_group_reference = re.compile(r'\\[1-9]|\(\?P=|\(\?\(')
+
 # command name => maximum argument count (or None if unlimited)
 valid_commands = {
     'BEGINBLOCK': 0,
@@ -88,7 +102,7 @@ valid_commands = {
 
 
 class DebconfFilter:
-    def __init__(self, db, widgets={}, automatic=False):
+    def __init__(self, db, widgets={}, automatic=False, read_size=READ_SIZE):
         self.db = db
         self.widgets = widgets
         self.automatic = automatic
@@ -99,9 +113,13 @@ class DebconfFilter:
         self.escaping = False
         self.progress_cancel = False
         self.progress_bars = []
-        self.toread = b''
-        self.toreadpos = 0
+        # Unread output from the confmodule is readbuf[readstart:readend].
+        self.readbuf = bytearray(read_size)
+        self.readstart = 0
+        self.readend = 0
+        self.read_blocked = False
         self.question_type_cache = {}
+        self.trace = None
 
     def debug_enabled(self, key):
         if key == 'filter' and os.environ.get('UBIQUITY_DEBUG_CORE') == '1':
@@ -118,35 +136,78 @@ class DebconfFilter:
             print("%s debconf (%s): %s" % (time_str, key, ' '.join(args)),
                   file=sys.stderr)
 
+    # The trace starts with a line holding '# ' and a JSON object describing
+    # the filter.  Each following line is the time in seconds since the
+    # filter started, '<' for a line received from the confmodule or '>' for
+    # a reply sent to it, and the line itself.
+    def open_trace(self, command):
+        trace_dir = os.environ.get(TRACE_DIR_ENV)
+        if not trace_dir:
+            return
+        if isinstance(command, str):
+            name = command
+        else:
+            name = command[-1]
+        path = os.path.join(trace_dir, '%s.%d.%d.trace' % (
+            os.path.basename(name), os.getpid(), int(time.time() * 1000)))
+        try:
+            os.makedirs(trace_dir, exist_ok=True)
+            self.trace = open(path, 'w')
+        except OSError as e:
+            self.debug('filter', 'cannot write trace to', path, str(e))
+            return
+        self.trace_start = time.monotonic()
+        header = {
+            'command': command,
+            'widgets': sorted(self.widgets),
+            'automatic': self.automatic,
+        }
+        self.trace.write('# %s\n' % json.dumps(header))
+
+    def trace_line(self, direction, line):
+        self.trace.write('%.6f %s %s\n' % (
+            time.monotonic() - self.trace_start, direction, line))
+
     # Returns None if non-blocking and can't read a full line right now;
     # returns '' at end of file; otherwise as fileobj.readline().
     def tryreadline(self):
-        ret = b''
+        self.read_blocked = False
         while True:
-            newlinepos = self.toread.find(b'\n', self.toreadpos)
+            newlinepos = self.readbuf.find(
+                b'\n', self.readstart, self.readend)
             if newlinepos != -1:
-                ret = self.toread[self.toreadpos:newlinepos + 1]
-                self.toreadpos = newlinepos + 1
-                if self.toreadpos >= len(self.toread):
-                    self.toread = b''
-                    self.toreadpos = 0
-                break
+                ret = self.readbuf[self.readstart:newlinepos + 1].decode()
+                self.readstart = newlinepos + 1
+                if self.readstart == self.readend:
+                    self.readstart = self.readend = 0
+                return ret
+
+            if self.readend == len(self.readbuf):
+                if self.readstart > 0:
+                    # Move the partial line to the start of the buffer.
+                    length = self.readend - self.readstart
+                    with memoryview(self.readbuf) as view:
+                        view[:length] = view[self.readstart:self.readend]
+                    self.readstart = 0
+                    self.readend = length
+                else:
+                    # A line longer than the buffer; make room for it.
+                    self.readbuf.extend(bytes(len(self.readbuf)))
 
             try:
-                text = os.read(self.subout_fd, 512)
-                if text == b'':
-                    ret = self.toread
-                    self.toread = b''
-                    self.toreadpos = 0
-                    break
-                self.toread += text
+                with memoryview(self.readbuf)[self.readend:] as free:
+                    count = os.readv(self.subout_fd, [free])
             except OSError as e:
                 if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    self.read_blocked = True
                     return None
                 else:
                     raise
-
-        return ret.decode()
+            if count == 0:
+                ret = self.readbuf[self.readstart:self.readend].decode()
+                self.readstart = self.readend = 0
+                return ret
+            self.readend += count
 
     def reply(self, code, text='', log=False):
         if self.escaping and code == 0:
@@ -155,6 +216,8 @@ class DebconfFilter:
         ret = '%d %s' % (code, text)
         if log:
             self.debug('filter', '-->', ret)
+        if self.trace is not None:
+            self.trace_line('>', ret)
         self.subin.write('%s\n' % ret)
         self.subin.flush()
 
@@ -169,27 +232,84 @@ class DebconfFilter:
             self.question_type_cache[question] = qtype
             return qtype
 
+    @property
+    def widgets(self):
+        return self._widgets
+
+    @widgets.setter
+    def widgets(self, widgets):
+        self._widgets = widgets
+        self.compile_widgets()
+
+    def compile_widgets(self):
+        """Build the dispatch table used by find_widgets.
+
+        Call this again if you change the widgets dictionary in place.
+        """
+        # Regular expression patterns are combined into a single matcher
+        # with one optional lookahead per pattern, so that a single search
+        # tells us every pattern that matches a question.  Each lookahead
+        # adds a group of its own, which renumbers the groups inside it, so
+        # patterns that refer back to a group by number are matched one at
+        # a time instead.  'type:' patterns depend on the question's
+        # template, so are checked separately.
+        self.widget_patterns = []
+        self.type_patterns = []
+        alternatives = []
+        for pattern, widget in self._widgets.items():
+            if pattern.startswith('type:'):
+                self.type_patterns.append((pattern[5:], widget))
+                continue
+            group = None
+            if not _group_reference.search(pattern):
+                group = '_w%d' % len(alternatives)
+                alternatives.append(r'(?:(?=[\s\S]*?(?P<%s>%s))?)' %
+                                    (group, pattern))
+            self.widget_patterns.append((re.compile(pattern), widget, group))
+        try:
+            self.widget_matcher = re.compile(''.join(alternatives))
+        except (re.error, OverflowError):
+            # The patterns cannot be combined (e.g. if two of them use the
+            # same group name); match them all one at a time instead.
+            self.widget_matcher = None
+        self.widget_cache = {}
+
+    def match_widgets(self, question):
+        """Return the widgets with a pattern matching question, in order."""
+        match = None
+        if self.widget_matcher is not None:
+            match = self.widget_matcher.match(question)
+        matched = []
+        for regex, widget, group in self.widget_patterns:
+            if match is not None and group is not None:
+                if match.group(group) is not None:
+                    matched.append(widget)
+            elif regex.search(question):
+                matched.append(widget)
+        if self.type_patterns and '/' in question:
+            try:
+                qtype = self.question_type(question)
+            except debconf.DebconfError:
+                qtype = None
+            for pattern_type, widget in self.type_patterns:
+                if qtype == pattern_type:
+                    matched.append(widget)
+        return matched
+
     def find_widgets(self, questions, method=None):
-        found = set()
-        for pattern in self.widgets.keys():
-            widget = self.widgets[pattern]
-            if widget not in found:
-                for question in questions:
-                    matches = False
-                    if pattern.startswith('type:') and '/' in question:
-                        try:
-                            qtype = self.question_type(question)
-                            if qtype == pattern[5:]:
-                                matches = True
-                        except debconf.DebconfError:
-                            pass
-                    elif re.search(pattern, question):
-                        matches = True
-                    if matches:
-                        if method is None or hasattr(widget, method):
-                            found.add(widget)
-                            break
-        return list(found)
+        key = (tuple(questions), method)
+        try:
+            return list(self.widget_cache[key])
+        except KeyError:
+            pass
+        found = []
+        for question in questions:
+            for widget in self.match_widgets(question):
+                if widget not in found and (
+                        method is None or hasattr(widget, method)):
+                    found.append(widget)
+        self.widget_cache[key] = tuple(found)
+        return found
 
     def start(self, command, blocking=True, extra_env={}):
         def subprocess_setup():
@@ -223,6 +343,7 @@ class DebconfFilter:
             fcntl.fcntl(self.subout_fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
         self.next_go_backup = False
         self.waiting = False
+        self.open_trace(command)
 
         # Always use the escape capability for our own communications with
         # the underlying frontend. This does not affect communications
@@ -238,6 +359,8 @@ class DebconfFilter:
 
         # TODO: handle escaped input
         line = line.rstrip('\n')
+        if self.trace is not None:
+            self.trace_line('<', line)
         params = line.split(None, 1)
         if not params:
             return True
@@ -441,6 +564,9 @@ class DebconfFilter:
         return True
 
     def wait(self):
+        if self.trace is not None:
+            self.trace.close()
+            self.trace = None
         if self.subin is not None and self.subout is not None:
             self.subin.close()
             self.subin = None
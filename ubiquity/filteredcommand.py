@@ -253,8 +253,15 @@ class FilteredCommand(UntrustedBase):
         call_again = True
 
         if condition & DEBCONF_IO_IN:
-            if not self.process_line():
-                call_again = False
+            # Handle everything the confmodule has sent so far rather than
+            # going back to the main loop after each line.
+            while True:
+                if not self.process_line():
+                    call_again = False
+                    break
+                if (self.dbfilter is None or self.dbfilter.subout is None or
+                        self.dbfilter.read_blocked):
+                    break
 
         if (condition & DEBCONF_IO_ERR) or (condition & DEBCONF_IO_HUP):
             call_again = False
@@ -42,6 +42,7 @@ import os
 import subprocess
 import sys
 import syslog
+import time
 import traceback
 
 import dbus
@@ -169,46 +170,7 @@ def on_screen_reader_enabled_changed(gsettings, key):
 
 class Wizard(BaseFrontend):
     def __init__(self, distro):
-        def add_subpage(self, steps, name):
-            """Inserts a subpage into the notebook.  This assumes the file
-            shares the same base name as the page you are looking for."""
-            widget = None
-            uifile = UIDIR + '/' + name + '.ui'
-            if os.path.exists(uifile):
-                self.builder.add_from_file(uifile)
-                widget = self.builder.get_object(name)
-                steps.append_page(widget, None)
-            else:
-                print('Could not find ui file %s' % name, file=sys.stderr)
-            return widget
-
-        def add_widget(self, widget):
-            """Make a widget callable by the toplevel."""
-            if not isinstance(widget, Gtk.Widget):
-                return
-            name = Gtk.Buildable.get_name(widget)
-            widget.set_name(name)
-            if 'UBIQUITY_LDTP' in os.environ:
-                atk_desc = widget.get_accessible()
-                atk_desc.set_name(name)
-            self.all_widgets.add(widget)
-            setattr(self, widget.get_name(), widget)
-            # We generally want labels to be selectable so that people can
-            # easily report problems in them
-            # (https://launchpad.net/bugs/41618), but GTK+ likes to put
-            # selectable labels in the focus chain, and I can't seem to turn
-            # this off in glade and have it stick. Accordingly, make sure
-            # labels are unfocusable here.
-            label = None
-            if isinstance(widget, Gtk.Label):
-                label = widget
-            elif isinstance(widget, gtkwidgets.StateBox):
-                label = widget.label
-
-            if label:
-                label.set_selectable(True)
-                label.set_property('can-focus', False)
-
+        self.start_time = time.time()
         BaseFrontend.__init__(self, distro)
         self.previous_excepthook = sys.excepthook
         sys.excepthook = self.excepthook
@@ -229,6 +191,8 @@ class Wizard(BaseFrontend):
         self.stay_on_page = False
         self.progress_position = ubiquity.progressposition.ProgressPosition()
         self.progress_cancelled = False
+        self.progress_fraction = 0.0
+        self.progress_tick_id = None
         self.installing = False
         self.installing_no_return = False
         self.partitioned = False
@@ -245,6 +209,7 @@ class Wizard(BaseFrontend):
         self.screen_reader = False
         self.orca_process = None
         self.a11y_settings = None
+        self.online_state = None
 
         # To get a "busy mouse":
         self.watch = Gdk.Cursor.new(Gdk.CursorType.WATCH)
@@ -311,53 +276,35 @@ class Wizard(BaseFrontend):
         self.builder.add_from_file('%s/ubiquity.ui' % UIDIR)
 
         self.builders = [self.builder]
+        self.toplevels = set()
+        self.add_builder_widgets()
+        self.builder.connect_signals(self)
+
+        # Building every page's UI up front makes the first window wait for
+        # pages the install may never reach, so pages are built when the
+        # wizard first needs them, or while the main loop is idle once the
+        # page before them is showing.
+        self.lazy_pages = 'UBIQUITY_EAGER_PAGES' not in os.environ
         self.pages = []
         self.pagesindex = 0
         self.pageslen = 0
-        steps = self.builder.get_object("steps")
+        self.default_install_page = None
+        self.prebuild_id = None
         found_install = False
         for mod in self.modules:
             if hasattr(mod.module, 'PageGtk'):
                 mod.ui_class = mod.module.PageGtk
                 mod.controller = Controller(self)
-                mod.ui = mod.ui_class(mod.controller)
-                mod.title = mod.ui.get('plugin_title')
-                widgets = mod.ui.get('plugin_widgets')
-                optional_widgets = mod.ui.get('plugin_optional_widgets')
+                mod.ui = None
+                mod.title = None
+                mod.widgets = []
+                mod.optional_widgets = []
+                mod.all_widgets = []
                 if not found_install:
-                    found_install = mod.ui.get('plugin_is_install')
-                if widgets or optional_widgets:
-                    def fill_out(widget_list):
-                        rv = []
-                        if not isinstance(widget_list, list):
-                            widget_list = [widget_list]
-                        for w in widget_list:
-                            if not w:
-                                continue
-                            if isinstance(w, str):
-                                w = add_subpage(self, steps, w)
-                            else:
-                                steps.append_page(w, None)
-                            rv.append(w)
-                        return rv
-                    mod.widgets = fill_out(widgets)
-                    mod.optional_widgets = fill_out(optional_widgets)
-                    mod.all_widgets = mod.widgets + mod.optional_widgets
-                    self.pageslen += 1
-                    self.pages.append(mod)
-
-        # If no plugins declare they are install, then we'll say the last one
-        # is
-        if not found_install:
-            self.pages[self.pageslen - 1].ui.plugin_is_install = True
-
-        self.toplevels = set()
-        for builder in self.builders:
-            for widget in builder.get_objects():
-                add_widget(self, widget)
-                if isinstance(widget, Gtk.Window):
-                    self.toplevels.add(widget)
-        self.builder.connect_signals(self)
+                    found_install = getattr(
+                        mod.ui_class, 'plugin_is_install', False)
+                self.pageslen += 1
+                self.pages.append(mod)
 
         for mod in self.pages:
             progress = Gtk.ProgressBar()
@@ -366,6 +313,21 @@ class Wizard(BaseFrontend):
             progress.set_fraction(0)
             self.dot_grid.add(progress)
 
+        # If no plugins declare they are install, then we'll say the last one
+        # is
+        if not found_install and self.pages:
+            self.default_install_page = self.pages[-1]
+
+        if self.lazy_pages:
+            # The first window needs the first page that has something to
+            # show.
+            while self.pages and not self.build_page(self.pages[0],
+                                                     translate=False):
+                pass
+        else:
+            self.build_all_pages(translate=False)
+        self.live_installer.connect('map-event', self.on_first_map)
+
         next_style = self.next.get_style_context()
         next_style.add_class('ubiquity-next')
 
@@ -396,6 +358,158 @@ class Wizard(BaseFrontend):
                 ['canberra-gtk-play', '--id=system-ready'],
                 preexec_fn=misc.drop_all_privileges)
 
+    def add_subpage(self, name):
+        """Inserts a subpage into the notebook.  This assumes the file
+        shares the same base name as the page you are looking for."""
+        widget = None
+        uifile = UIDIR + '/' + name + '.ui'
+        if os.path.exists(uifile):
+            builder = Gtk.Builder()
+            builder.set_translation_domain(self.distro + '-installer')
+            builder.add_from_file(uifile)
+            builder.connect_signals(self)
+            self.builders.append(builder)
+            widget = builder.get_object(name)
+            self.steps.append_page(widget, None)
+        else:
+            print('Could not find ui file %s' % name, file=sys.stderr)
+        return widget
+
+    def add_widget(self, widget):
+        """Make a widget callable by the toplevel."""
+        if not isinstance(widget, Gtk.Widget):
+            return
+        name = Gtk.Buildable.get_name(widget)
+        widget.set_name(name)
+        if 'UBIQUITY_LDTP' in os.environ:
+            atk_desc = widget.get_accessible()
+            atk_desc.set_name(name)
+        self.all_widgets.add(widget)
+        setattr(self, widget.get_name(), widget)
+        # We generally want labels to be selectable so that people can
+        # easily report problems in them
+        # (https://launchpad.net/bugs/41618), but GTK+ likes to put
+        # selectable labels in the focus chain, and I can't seem to turn
+        # this off in glade and have it stick. Accordingly, make sure
+        # labels are unfocusable here.
+        label = None
+        if isinstance(widget, Gtk.Label):
+            label = widget
+        elif isinstance(widget, gtkwidgets.StateBox):
+            label = widget.label
+
+        if label:
+            label.set_selectable(True)
+            label.set_property('can-focus', False)
+
+    def add_builder_widgets(self, first=0):
+        """Add the objects of self.builders[first:] to the toplevel, and
+        return them."""
+        added = []
+        for builder in self.builders[first:]:
+            for widget in builder.get_objects():
+                self.add_widget(widget)
+                if isinstance(widget, Gtk.Window):
+                    self.toplevels.add(widget)
+                added.append(widget)
+        return added
+
+    def build_page(self, mod, translate=True):
+        """Construct a page's UI if that has not happened yet.
+
+        Returns False if the page turns out to have nothing to show, in
+        which case it is removed from self.pages, as if it had never been
+        there."""
+        if mod.ui is not None:
+            return True
+        start = time.time()
+        first_builder = len(self.builders)
+        mod.ui = mod.ui_class(mod.controller)
+        mod.title = mod.ui.get('plugin_title')
+        if mod is self.default_install_page:
+            mod.ui.plugin_is_install = True
+        widgets = mod.ui.get('plugin_widgets')
+        optional_widgets = mod.ui.get('plugin_optional_widgets')
+        if not (widgets or optional_widgets):
+            index = self.pages.index(mod)
+            self.pages.remove(mod)
+            self.pageslen -= 1
+            self.dot_grid.remove_column(index)
+            if index < self.pagesindex:
+                self.pagesindex -= 1
+            if mod is self.default_install_page and self.pages:
+                self.default_install_page = self.pages[-1]
+                if self.pages[-1].ui is not None:
+                    self.pages[-1].ui.plugin_is_install = True
+            self.add_builder_widgets(first_builder)
+            return False
+
+        def fill_out(widget_list):
+            rv = []
+            if not isinstance(widget_list, list):
+                widget_list = [widget_list]
+            for w in widget_list:
+                if not w:
+                    continue
+                if isinstance(w, str):
+                    w = self.add_subpage(w)
+                else:
+                    self.steps.append_page(w, None)
+                rv.append(w)
+            return rv
+        mod.widgets = fill_out(widgets)
+        mod.optional_widgets = fill_out(optional_widgets)
+        mod.all_widgets = mod.widgets + mod.optional_widgets
+        added = self.add_builder_widgets(first_builder)
+        if (self.online_state is not None and
+                hasattr(mod.ui, 'plugin_set_online_state')):
+            mod.ui.plugin_set_online_state(self.online_state)
+
+        if translate:
+            # Catch up with whatever language has been chosen so far.
+            lang = self.locale
+            prefix = mod.ui.get('plugin_prefix')
+            page_widgets = set()
+            for w in mod.all_widgets:
+                page_widgets.update(self.all_children(w))
+            self.translate_widgets(
+                lang=lang, reget=False,
+                widgets=[(w, None) for w in added
+                         if w not in page_widgets])
+            self.translate_widgets(
+                lang=lang, reget=False,
+                widgets=[(w, prefix) for w in page_widgets])
+            if hasattr(mod.ui, 'plugin_translate'):
+                try:
+                    mod.ui.plugin_translate(lang)
+                except Exception as e:
+                    print('Could not translate page (%s): %s' %
+                          (mod.module.NAME, str(e)), file=sys.stderr)
+        syslog.syslog('Built page %s in %.3fs' %
+                      (mod.module.NAME, time.time() - start))
+        return True
+
+    def build_all_pages(self, translate=True):
+        for mod in list(self.pages):
+            self.build_page(mod, translate=translate)
+
+    def prebuild_pages(self):
+        """Build the pages after the current one while the main loop is
+        idle, one at a time."""
+        for mod in self.pages[self.pagesindex + 1:self.pagesindex + 3]:
+            if mod.ui is None:
+                self.build_page(mod)
+                return True
+        self.prebuild_id = None
+        return False
+
+    def on_first_map(self, widget, unused_event):
+        print('Time to first window: %.3fs (%s page loading)' %
+              (time.time() - self.start_time,
+               'lazy' if self.lazy_pages else 'eager'), file=sys.stderr)
+        widget.disconnect_by_func(self.on_first_map)
+        return False
+
     def all_children(self, parent):
         if isinstance(parent, Gtk.Container):
             def recurse(x, y):
@@ -411,7 +525,9 @@ class Wizard(BaseFrontend):
         if just_current:
             pages = [current_page]
         else:
-            pages = self.pages
+            # Pages that haven't been built yet are translated when they
+            # are.
+            pages = [p for p in self.pages if p.ui is not None]
 
         if reget:
             self.translate_reget(lang)
@@ -506,6 +622,7 @@ class Wizard(BaseFrontend):
         self.timeout_id = GLib.timeout_add(300, self.check_returncode)
 
     def set_online_state(self, state):
+        self.online_state = state
         for p in self.pages:
             if hasattr(p.ui, 'plugin_set_online_state'):
                 p.ui.plugin_set_online_state(state)
@@ -793,6 +910,8 @@ class Wizard(BaseFrontend):
                 return self.returncode
 
             page = self.pages[self.pagesindex]
+            if not self.build_page(page):
+                continue
             skip = False
             if hasattr(page.ui, 'plugin_skip_page'):
                 if page.ui.plugin_skip_page():
@@ -1152,15 +1271,18 @@ class Wizard(BaseFrontend):
             core_names.append('ubiquity/imported/%s' % stock_item)
         prefixes = []
         for p in self.pages:
-            prefix = p.ui.get('plugin_prefix')
+            # Pages that haven't been built yet only have their class
+            # attributes to go on.
+            ui = p.ui if p.ui is not None else p.ui_class
+            prefix = getattr(ui, 'plugin_prefix', None)
             if not prefix:
                 prefix = 'ubiquity/text'
-            if p.ui.get('plugin_is_language'):
+            if getattr(ui, 'plugin_is_language', None):
                 children = reduce(
                     lambda x, y: x + self.all_children(y), p.all_widgets, [])
                 core_names.extend(
                     [prefix + '/' + c.get_name() for c in children])
-                title = p.ui.get('plugin_title')
+                title = getattr(ui, 'plugin_title', None)
                 if title:
                     core_names.extend([title])
             prefixes.append(prefix)
@@ -1334,12 +1456,14 @@ class Wizard(BaseFrontend):
         is_install = False
         if 'UBIQUITY_GREETER' in os.environ:
             for page in self.pages:
-                if page.module.NAME == 'language':
+                if page.module.NAME == 'language' and page.ui is not None:
                     # The greeter page is quite large.  Hide it upon leaving.
                     page.ui.page.hide()
                     break
         for page in self.pages:
             if page.module.NAME == n:
+                if not self.build_page(page):
+                    break
                 # Now ask ui class which page we want to be showing right now
                 if hasattr(page.ui, 'plugin_get_current_page'):
                     cur = page.ui.call('plugin_get_current_page')
@@ -1387,6 +1511,9 @@ class Wizard(BaseFrontend):
         # and only if we are not on the first page.
         if self.oem_user_config:
             self.back.set_visible(self.pagesindex > 0)
+
+        if self.lazy_pages and self.prebuild_id is None:
+            self.prebuild_id = GLib.idle_add(self.prebuild_pages)
         return True
 
     def set_page_title(self, page, lang=None):
@@ -1597,18 +1724,31 @@ class Wizard(BaseFrontend):
         if self.progress_cancelled:
             return False
         self.progress_position.set(progress_val)
-        fraction = self.progress_position.fraction()
-        self.install_progress.set_fraction(fraction)
+        self.queue_progress_fraction()
         return True
 
     def debconf_progress_step(self, progress_inc):
         if self.progress_cancelled:
             return False
         self.progress_position.step(progress_inc)
-        fraction = self.progress_position.fraction()
-        self.install_progress.set_fraction(fraction)
+        self.queue_progress_fraction()
         return True
 
+    def queue_progress_fraction(self):
+        # Only move the progress bar once per frame, however many updates
+        # arrive in between.
+        self.progress_fraction = self.progress_position.fraction()
+        if not self.install_progress.get_mapped():
+            self.install_progress.set_fraction(self.progress_fraction)
+        elif self.progress_tick_id is None:
+            self.progress_tick_id = self.install_progress.add_tick_callback(
+                self.update_progress_fraction)
+
+    def update_progress_fraction(self, widget, unused_frame_clock):
+        self.progress_tick_id = None
+        widget.set_fraction(self.progress_fraction)
+        return False
+
     def debconf_progress_info(self, progress_info):
         if self.progress_cancelled:
             return False
@@ -52,6 +52,7 @@ class Wizard(BaseFrontend):
         self.progress_position = ubiquity.progressposition.ProgressPosition()
         self.progress_val = 0
         self.progress_info = ''
+        self.progress_line = None
         self.mainloop = GLib.MainLoop()
 
         self.pages = []
@@ -189,6 +190,14 @@ class Wizard(BaseFrontend):
 
     # Progress bar handling.
 
+    def print_progress(self):
+        # The console is our only display, so only write a line when what
+        # it would say has changed.
+        line = '%d%%: %s' % (self.progress_val, self.progress_info)
+        if line != self.progress_line:
+            print(line, file=self.console)
+            self.progress_line = line
+
     def debconf_progress_start(self, progress_min, progress_max,
                                progress_title):
         """Start a progress bar. May be nested."""
@@ -197,8 +206,7 @@ class Wizard(BaseFrontend):
     def debconf_progress_set(self, progress_val):
         """Set the current progress bar's position to progress_val."""
         self.progress_val = progress_val
-        print('%d%%: %s' % (self.progress_val, self.progress_info),
-              file=self.console)
+        self.print_progress()
         return True
 
     def debconf_progress_step(self, progress_inc):
@@ -208,8 +216,7 @@ class Wizard(BaseFrontend):
     def debconf_progress_info(self, progress_info):
         """Set the current progress bar's message to progress_info."""
         self.progress_info = progress_info
-        print('%d%%: %s' % (self.progress_val, self.progress_info),
-              file=self.console)
+        self.print_progress()
         return True
 
     def debconf_progress_stop(self):
@@ -20,12 +20,18 @@
 from __future__ import print_function
 
 import codecs
+from collections.abc import Mapping
 from functools import reduce
+import json
 import locale
+import mmap
 import os
 import re
+import struct
 import subprocess
 import sys
+import syslog
+import time
 
 from ubiquity import im_switch, misc
 
@@ -63,9 +69,351 @@ def strip_context(unused_question, string):
     return string
 
 
+# Reading translations through debconf-copydb means forking perl and
+# parsing every matching template in every language each time the language
+# changes.  Instead, we compile the template database once into a catalogue
+# file that can be mapped straight into memory: a table of question names,
+# and for each language a table of (question, text) references into a
+# block of UTF-8 text.  A language's strings are only decoded the first
+# time something asks for that language, and the catalogue is rebuilt when
+# any of debconf's template files changes.
+
+CATALOGUE_FILE = '/var/lib/ubiquity/translations.cat'
+_CATALOGUE_MAGIC = b'UBICAT01'
+_CATALOGUE_HEADER = struct.Struct('>8sIIII')
+
+# Questions whose extended description is needed separately from their
+# description.
+_extended_questions = ('grub-installer/bootdev',
+                       'partman-newworld/no_newworld',
+                       'ubiquity/text/error_updating_installer')
+
+
+def _read_templates(lines, keep):
+    """Yield (question, {language: description}) for each template.
+
+    lines are the lines of a debconf template database in RFC822 form,
+    such as templates.dat or the output of debconf-copydb.  Descriptions
+    are only included if keep(question, language) is true.
+    """
+    question = None
+    descriptions = {}
+    fieldsplitter = re.compile(br':\s*')
+
+    for line in lines:
+        line = line.rstrip(b'\n')
+        if b':' not in line:
+            if question is not None:
+                yield question, descriptions
+                descriptions = {}
+                question = None
+            continue
+
+        (name, value) = fieldsplitter.split(line, 1)
+        if value == b'':
+            continue
+        name = name.lower()
+        if name == b'name':
+            question = value.decode()
+        elif name.startswith(b'description'):
+            namebits = name.split(b'-', 1)
+            if len(namebits) == 1:
+                lang = 'c'
+                decoded_value = value.decode('ASCII', 'replace')
+            else:
+                lang = namebits[1].lower().decode()
+                lang, encoding = lang.split('.', 1)
+                decoded_value = value.decode(encoding, 'replace')
+            if keep(question, lang):
+                decoded_value = strip_context(question, decoded_value)
+                descriptions[lang] = decoded_value.replace('\\n', '\n')
+        elif name.startswith(b'extended_description'):
+            namebits = name.split(b'-', 1)
+            if len(namebits) == 1:
+                lang = 'c'
+                decoded_value = value.decode('ASCII', 'replace')
+            else:
+                lang = namebits[1].lower().decode()
+                lang, encoding = lang.split('.', 1)
+                decoded_value = value.decode(encoding, 'replace')
+            if keep(question, lang):
+                decoded_value = strip_context(question, decoded_value)
+                if lang not in descriptions:
+                    descriptions[lang] = decoded_value.replace('\\n', '\n')
+                # TODO cjwatson 2006-09-04: a bit of a hack to get the
+                # description and extended description separately ...
+                if question in _extended_questions:
+                    descriptions["extended:%s" % lang] = \
+                        decoded_value.replace('\\n', '\n')
+
+    if question is not None:
+        yield question, descriptions
+
+
+def _debconf_database(stanzas, name):
+    """Return the files making up a debconf database, or None."""
+    for stanza in stanzas:
+        if stanza.get('name') != name:
+            continue
+        driver = stanza.get('driver')
+        if driver == 'File' and 'filename' in stanza:
+            return [stanza['filename']]
+        elif driver == 'Stack' and 'stack' in stanza:
+            files = []
+            for member in stanza['stack'].split(','):
+                member_files = _debconf_database(stanzas, member.strip())
+                if member_files is None:
+                    return None
+                files.extend(member_files)
+            return files
+        return None
+    return None
+
+
+def debconf_template_files():
+    """Return the files holding debconf's template database, in order.
+
+    Returns None if the database is not made up of plain files, in which
+    case we can only read it through debconf-copydb.
+    """
+    path = os.environ.get('DEBCONF_SYSTEMRC', '/etc/debconf.conf')
+    stanzas = []
+    stanza = {}
+    try:
+        with open(path) as config:
+            for line in config:
+                line = line.strip()
+                if line.startswith('#'):
+                    continue
+                if not line:
+                    if stanza:
+                        stanzas.append(stanza)
+                        stanza = {}
+                    continue
+                name, sep, value = line.partition(':')
+                if sep:
+                    stanza[name.strip().lower()] = value.strip()
+    except OSError:
+        return None
+    if stanza:
+        stanzas.append(stanza)
+    if not stanzas or 'templates' not in stanzas[0]:
+        return None
+    return _debconf_database(stanzas[1:], stanzas[0]['templates'])
+
+
+def _templates_stamp(files):
+    stamp = []
+    for path in files:
+        try:
+            st = os.stat(path)
+            stamp.append([os.path.abspath(path), st.st_mtime_ns, st.st_size])
+        except OSError:
+            stamp.append([os.path.abspath(path), None, None])
+    return stamp
+
+
+def build_catalogue(files, stamp):
+    """Compile debconf template files into a translation catalogue."""
+    templates = {}
+    for path in files:
+        try:
+            with open(path, 'rb') as lines:
+                for question, descriptions in _read_templates(
+                        lines, lambda question, lang: True):
+                    # As with a debconf stack, the first database wins.
+                    templates.setdefault(question, descriptions)
+        except OSError:
+            continue
+
+    questions = sorted(templates)
+    languages = sorted(set(lang for descriptions in templates.values()
+                           for lang in descriptions))
+    blob = bytearray()
+
+    def add(text):
+        encoded = text.encode('UTF-8')
+        blob.extend(encoded)
+        return len(blob) - len(encoded), len(encoded)
+
+    question_table = []
+    for question in questions:
+        question_table.extend(add(question))
+    entries = {lang: [] for lang in languages}
+    for index, question in enumerate(questions):
+        for lang, text in templates[question].items():
+            entries[lang].append(index)
+            entries[lang].extend(add(text))
+
+    stamp_data = json.dumps(stamp).encode('UTF-8')
+    offset = (_CATALOGUE_HEADER.size + len(stamp_data) +
+              len(question_table) * 4 + len(languages) * 16)
+    language_table = []
+    for lang in languages:
+        language_table.extend(add(lang))
+        language_table.extend((offset, len(entries[lang]) // 3))
+        offset += len(entries[lang]) * 4
+
+    parts = [_CATALOGUE_HEADER.pack(_CATALOGUE_MAGIC, len(stamp_data),
+                                    len(questions), len(languages), offset),
+             stamp_data,
+             struct.pack('>%dI' % len(question_table), *question_table),
+             struct.pack('>%dI' % len(language_table), *language_table)]
+    for lang in languages:
+        parts.append(struct.pack('>%dI' % len(entries[lang]), *entries[lang]))
+    parts.append(bytes(blob))
+    return b''.join(parts)
+
+
+class Catalogue(object):
+    """A compiled translation catalogue, read from bytes or an mmap."""
+
+    def __init__(self, data):
+        magic, stamp_size, question_count, language_count, self.blob = \
+            _CATALOGUE_HEADER.unpack_from(data, 0)
+        if magic != _CATALOGUE_MAGIC:
+            raise ValueError('not a translation catalogue')
+        self.data = data
+        offset = _CATALOGUE_HEADER.size
+        self.stamp = json.loads(
+            bytes(data[offset:offset + stamp_size]).decode('UTF-8'))
+        offset += stamp_size
+        table = struct.unpack_from('>%dI' % (question_count * 2), data,
+                                   offset)
+        offset += question_count * 8
+        self.questions = {}
+        for index in range(question_count):
+            self.questions[self._text(*table[index * 2:index * 2 + 2])] = \
+                index
+        table = struct.unpack_from('>%dI' % (language_count * 4), data,
+                                   offset)
+        self.languages = {}
+        for index in range(language_count):
+            name_offset, name_size, entries, count = \
+                table[index * 4:index * 4 + 4]
+            self.languages[self._text(name_offset, name_size)] = \
+                (entries, count)
+        self.loaded = {}
+
+    def _text(self, offset, size):
+        start = self.blob + offset
+        return self.data[start:start + size].decode('UTF-8')
+
+    def _language(self, lang):
+        texts = self.loaded.get(lang)
+        if texts is None:
+            texts = {}
+            if lang in self.languages:
+                entries, count = self.languages[lang]
+                table = struct.unpack_from('>%dI' % (count * 3), self.data,
+                                           entries)
+                for i in range(0, count * 3, 3):
+                    texts[table[i]] = self._text(table[i + 1], table[i + 2])
+            self.loaded[lang] = texts
+        return texts
+
+    def text(self, question, lang):
+        """Return a question's description in a language, or None."""
+        index = self.questions.get(question)
+        if index is None:
+            return None
+        return self._language(lang).get(index)
+
+
+def load_catalogue(files):
+    """Return the catalogue for files, rebuilding it if it is out of date."""
+    stamp = _templates_stamp(files)
+    try:
+        with open(CATALOGUE_FILE, 'rb') as catalogue_file:
+            data = mmap.mmap(catalogue_file.fileno(), 0,
+                             access=mmap.ACCESS_READ)
+        catalogue = Catalogue(data)
+        if catalogue.stamp == stamp:
+            return catalogue
+    except (OSError, ValueError, struct.error):
+        pass
+    start = time.time()
+    data = build_catalogue(files, stamp)
+    syslog.syslog('Compiled translation catalogue (%d bytes) in %.3fs' %
+                  (len(data), time.time() - start))
+    try:
+        with misc.raised_privileges():
+            os.makedirs(os.path.dirname(CATALOGUE_FILE), exist_ok=True)
+            with open(CATALOGUE_FILE + '.new', 'wb') as catalogue_file:
+                catalogue_file.write(data)
+            os.rename(CATALOGUE_FILE + '.new', CATALOGUE_FILE)
+    except OSError as e:
+        print('Could not save translation catalogue:', e, file=sys.stderr)
+    return Catalogue(data)
+
+
+class _CatalogueDescriptions(Mapping):
+    """One question's descriptions, as get_translations would return them.
+    """
+
+    def __init__(self, translations, question):
+        self.translations = translations
+        self.question = question
+
+    def __getitem__(self, lang):
+        translations = self.translations
+        base = lang.rpartition(':')[2]
+        if (translations.use_langs is None or
+                base in translations.use_langs or
+                self.question in translations.core_names):
+            text = translations.catalogue.text(self.question, lang)
+            if text is not None:
+                return text
+        raise KeyError(lang)
+
+    def __iter__(self):
+        for lang in self.translations.catalogue.languages:
+            if lang in self:
+                yield lang
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+
+class _CatalogueTranslations(Mapping):
+    """A view of a Catalogue filtered as get_translations would filter it.
+    """
+
+    def __init__(self, catalogue, prefixes, use_langs, core_names):
+        self.catalogue = catalogue
+        self.prefixes = re.compile('^(%s)' % prefixes)
+        self.use_langs = use_langs
+        self.core_names = set(core_names)
+
+    def __getitem__(self, question):
+        if (question not in self.catalogue.questions or
+                not self.prefixes.match(question)):
+            raise KeyError(question)
+        return _CatalogueDescriptions(self, question)
+
+    def __iter__(self):
+        for question in self.catalogue.questions:
+            if self.prefixes.match(question):
+                yield question
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+
+_catalogue = None
 _translations = None
 
 
+def _get_catalogue():
+    global _catalogue
+    files = debconf_template_files()
+    if files is None:
+        return None
+    if _catalogue is None or _catalogue.stamp != _templates_stamp(files):
+        _catalogue = load_catalogue(files)
+    return _catalogue
+
+
 def get_translations(languages=None, core_names=[], extra_prefixes=[]):
     """Returns a dictionary {name: {language: description}} of translatable
     strings.
@@ -74,7 +422,11 @@ def get_translations(languages=None, core_names=[], extra_prefixes=[]):
     translated. If core_names is also set to a list, then any names in that
     list will still be translated into all languages. If either is set, then
     the dictionary returned will be built from scratch; otherwise, the last
-    cached version will be returned."""
+    cached version will be returned.
+
+    Where debconf's templates are in plain files, the dictionary is a
+    read-only view of the compiled translation catalogue, and each
+    language is only read when it is first looked up."""
 
     global _translations
     if (_translations is None or languages is not None or core_names or
@@ -106,6 +458,16 @@ def get_translations(languages=None, core_names=[], extra_prefixes=[]):
         ))
         prefixes = reduce(lambda x, y: x + '|' + y, extra_prefixes, prefixes)
 
+        catalogue = _get_catalogue()
+        if catalogue is not None:
+            _translations = _CatalogueTranslations(
+                catalogue, prefixes, use_langs, core_names)
+            return _translations
+
+        def keep(question, lang):
+            return (use_langs is None or lang in use_langs or
+                    question in core_names)
+
         _translations = {}
         devnull = open('/dev/null', 'w')
         db = subprocess.Popen(
@@ -116,59 +478,8 @@ def get_translations(languages=None, core_names=[], extra_prefixes=[]):
             bufsize=8192, stdout=subprocess.PIPE, stderr=devnull,
             # necessary?
             preexec_fn=misc.regain_privileges)
-        question = None
-        descriptions = {}
-        fieldsplitter = re.compile(br':\s*')
-
-        for line in db.stdout:
-            line = line.rstrip(b'\n')
-            if b':' not in line:
-                if question is not None:
-                    _translations[question] = descriptions
-                    descriptions = {}
-                    question = None
-                continue
-
-            (name, value) = fieldsplitter.split(line, 1)
-            if value == b'':
-                continue
-            name = name.lower()
-            if name == b'name':
-                question = value.decode()
-            elif name.startswith(b'description'):
-                namebits = name.split(b'-', 1)
-                if len(namebits) == 1:
-                    lang = 'c'
-                    decoded_value = value.decode('ASCII', 'replace')
-                else:
-                    lang = namebits[1].lower().decode()
-                    lang, encoding = lang.split('.', 1)
-                    decoded_value = value.decode(encoding, 'replace')
-                if (use_langs is None or lang in use_langs or
-                        question in core_names):
-                    decoded_value = strip_context(question, decoded_value)
-                    descriptions[lang] = decoded_value.replace('\\n', '\n')
-            elif name.startswith(b'extended_description'):
-                namebits = name.split(b'-', 1)
-                if len(namebits) == 1:
-                    lang = 'c'
-                    decoded_value = value.decode('ASCII', 'replace')
-                else:
-                    lang = namebits[1].lower().decode()
-                    lang, encoding = lang.split('.', 1)
-                    decoded_value = value.decode(encoding, 'replace')
-                if (use_langs is None or lang in use_langs or
-                        question in core_names):
-                    decoded_value = strip_context(question, decoded_value)
-                    if lang not in descriptions:
-                        descriptions[lang] = decoded_value.replace('\\n', '\n')
-                    # TODO cjwatson 2006-09-04: a bit of a hack to get the
-                    # description and extended description separately ...
-                    if question in ('grub-installer/bootdev',
-                                    'partman-newworld/no_newworld',
-                                    'ubiquity/text/error_updating_installer'):
-                        descriptions["extended:%s" % lang] = \
-                            decoded_value.replace('\\n', '\n')
+        for question, descriptions in _read_templates(db.stdout, keep):
+            _translations[question] = descriptions
 
         db.stdout.close()
         db.wait()
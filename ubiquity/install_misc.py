@@ -22,6 +22,8 @@
 
 from __future__ import print_function
 
+import collections
+from concurrent import futures
 import errno
 import fcntl
 import hashlib
@@ -33,6 +35,8 @@ import stat
 import subprocess
 import sys
 import syslog
+import threading
+import time
 import traceback
 
 from apt.cache import Cache
@@ -79,6 +83,44 @@ def chrex(target, *args):
     return misc.execute('chroot', target, *args)
 
 
+def chrex_parallel(target, commands):
+    """Run several commands on the chroot system at once.
+
+    commands is a list of (args, input) pairs; input, if not None, is fed
+    to the command's standard input.  Returns True if all of them succeeded.
+    """
+    procs = []
+    for args, data in commands:
+        log_args = ['log-output', '-t', 'ubiquity', 'chroot', target]
+        log_args.extend(args)
+        try:
+            proc = subprocess.Popen(
+                log_args, stdin=subprocess.PIPE if data is not None else None,
+                universal_newlines=True)
+        except (IOError, OSError) as e:
+            syslog.syslog(syslog.LOG_ERR, ' '.join(log_args))
+            syslog.syslog(syslog.LOG_ERR,
+                          "OS error(%s): %s" % (e.errno, e.strerror))
+            continue
+        procs.append((proc, log_args, data))
+    # Feed everything before waiting for anything, so that they all run.
+    for proc, _, data in procs:
+        if data is not None:
+            try:
+                proc.stdin.write(data)
+                proc.stdin.close()
+            except BrokenPipeError:
+                pass
+    success = len(procs) == len(commands)
+    for proc, log_args, _ in procs:
+        if proc.wait() != 0:
+            syslog.syslog(syslog.LOG_ERR, ' '.join(log_args))
+            success = False
+        else:
+            syslog.syslog(' '.join(log_args))
+    return success
+
+
 def set_debconf(target, question, value, db=None):
     try:
         if 'UBIQUITY_OEM_USER_CONFIG' in os.environ and db:
@@ -255,6 +297,88 @@ def query_recorded_removed():
     return (apt_removed, apt_removed_recursive)
 
 
+# The shortest time between two progress updates sent to the frontend.
+PROGRESS_INTERVAL = 0.1
+
+
+class ProgressChannel:
+    """Send progress bar updates to the frontend, merging redundant ones.
+
+    Every PROGRESS SET or INFO command is a debconf round trip through the
+    filter to the frontend, which is wasteful when a caller reports
+    progress far more often than anyone can see it change.  set() and
+    info() remember the latest value and send it at most once every
+    interval seconds, skipping values the frontend already shows.  A
+    change of INFO template is sent straight away; a change of its
+    substitutions only replaces any pending one.  Call flush() before
+    anything else talks to the progress bar, so that the last update is
+    never lost.  DebconfError (e.g. the user cancelled) propagates from
+    whichever call sends an update.
+    """
+
+    def __init__(self, db, interval=PROGRESS_INTERVAL):
+        self.db = db
+        self.interval = interval
+        self.last_sent = None
+        self.current_set = None
+        self.current_info = None
+        self.pending_set = None
+        self.pending_info = None
+        self.updates = 0
+        self.round_trips = 0
+
+    def set(self, value):
+        self.updates += 1
+        self.pending_set = value
+        self.deliver()
+
+    def info(self, template, **substitutions):
+        self.updates += 1 + len(substitutions)
+        self.pending_info = (template, tuple(sorted(substitutions.items())))
+        self.deliver(
+            force=(self.current_info is None or
+                   self.current_info[0] != template))
+
+    def flush(self):
+        self.deliver(force=True)
+
+    def timeout(self):
+        """Return how long until a pending update is due, or None."""
+        if self.pending_set is None and self.pending_info is None:
+            return None
+        if self.last_sent is None:
+            return 0
+        return max(0, self.last_sent + self.interval - time.time())
+
+    def deliver(self, force=False):
+        now = time.time()
+        if (not force and self.last_sent is not None and
+                now - self.last_sent < self.interval):
+            return
+        pending_set, self.pending_set = self.pending_set, None
+        pending_info, self.pending_info = self.pending_info, None
+        if pending_set is not None and pending_set != self.current_set:
+            self.last_sent = now
+            self.round_trips += 1
+            self.db.progress('SET', pending_set)
+            self.current_set = pending_set
+        if pending_info is not None and pending_info != self.current_info:
+            self.last_sent = now
+            template, substitutions = pending_info
+            for key, value in substitutions:
+                self.round_trips += 1
+                self.db.subst(template, key, value)
+            self.round_trips += 1
+            self.db.progress('INFO', template)
+            self.current_info = pending_info
+
+    def log_statistics(self, name):
+        """Log how many round trips to the frontend were saved."""
+        syslog.syslog('%s progress: %d updates sent in %d round trips, %d '
+                      'saved' % (name, self.updates, self.round_trips,
+                                 self.updates - self.round_trips))
+
+
 class DebconfAcquireProgress(AcquireProgress):
     """An object that reports apt's fetching progress using debconf."""
 
@@ -266,12 +390,14 @@ class DebconfAcquireProgress(AcquireProgress):
         self.info = info
         self.old_capb = None
         self.eta = 0.0
+        self.progress = ProgressChannel(db)
 
     def start(self):
         if os.environ['UBIQUITY_FRONTEND'] != 'debconf_ui':
             self.db.progress('START', 0, 100, self.title)
+        self.progress = ProgressChannel(self.db)
         if self.info_starting is not None:
-            self.db.progress('INFO', self.info_starting)
+            self.progress.info(self.info_starting)
         self.old_capb = self.db.capb()
         capb_list = self.old_capb.split()
         capb_list.append('progresscancel')
@@ -289,20 +415,21 @@ class DebconfAcquireProgress(AcquireProgress):
 
         try:
             if os.environ['UBIQUITY_FRONTEND'] != 'debconf_ui':
-                self.db.progress('SET', int(self.percent))
+                self.progress.set(int(self.percent))
+            if self.eta != 0.0:
+                time_str = "%d:%02d" % divmod(int(self.eta), 60)
+                self.progress.info(self.info, TIME=time_str)
         except debconf.DebconfError:
             return False
-        if self.eta != 0.0:
-            time_str = "%d:%02d" % divmod(int(self.eta), 60)
-            self.db.subst(self.info, 'TIME', time_str)
-            try:
-                self.db.progress('INFO', self.info)
-            except debconf.DebconfError:
-                return False
         return True
 
     def stop(self):
         if self.old_capb is not None:
+            try:
+                self.progress.flush()
+            except debconf.DebconfError:
+                pass
+            self.progress.log_statistics('apt fetch')
             self.db.capb(self.old_capb)
             self.old_capb = None
             if os.environ['UBIQUITY_FRONTEND'] != 'debconf_ui':
@@ -319,6 +446,7 @@ class DebconfInstallProgress(InstallProgress):
         self.info = info
         self.error_template = error
         self.started = False
+        self.progress = ProgressChannel(db)
         # InstallProgress uses a non-blocking status fd; our run()
         # implementation doesn't need that, and in fact we spin unless the
         # fd is blocking.
@@ -329,6 +457,7 @@ class DebconfInstallProgress(InstallProgress):
     def start_update(self):
         if os.environ['UBIQUITY_FRONTEND'] != 'debconf_ui':
             self.db.progress('START', 0, 100, self.title)
+        self.progress = ProgressChannel(self.db)
         self.started = True
 
     def error(self, pkg, errormsg):
@@ -342,9 +471,8 @@ class DebconfInstallProgress(InstallProgress):
         self.percent = percent
         self.status = status
         if os.environ['UBIQUITY_FRONTEND'] != 'debconf_ui':
-            self.db.progress('SET', int(percent))
-        self.db.subst(self.info, 'DESCRIPTION', status)
-        self.db.progress('INFO', self.info)
+            self.progress.set(int(percent))
+        self.progress.info(self.info, DESCRIPTION=status)
 
     def run(self, pm):
         # Create a subprocess to deal with turning apt status messages into
@@ -357,16 +485,23 @@ class DebconfInstallProgress(InstallProgress):
             os.close(control_write)
             try:
                 while True:
+                    # Wake up in time to send any update that the progress
+                    # channel is holding back, in case dpkg goes quiet.
+                    rlist = []
                     try:
                         rlist, _, _ = select.select(
-                            [self.status_stream, control_read], [], [])
+                            [self.status_stream, control_read], [], [],
+                            self.progress.timeout())
                     except select.error as error:
                         if error[0] != errno.EINTR:
                             raise
                     if self.status_stream in rlist:
                         self.update_interface()
                     if control_read in rlist:
+                        self.progress.flush()
+                        self.progress.log_statistics('apt install')
                         os._exit(0)
+                    self.progress.deliver()
             except (KeyboardInterrupt, SystemExit):
                 pass  # we're going to exit anyway
             except Exception:
@@ -617,7 +752,12 @@ def locale_to_language_pack(locale):
         return lang
 
 
-def get_remove_list(cache, to_remove, recursive=False):
+def get_remove_list_apt(cache, to_remove, recursive=False):
+    """Mark packages for removal one at a time, asking apt as we go.
+
+    This is the original implementation of get_remove_list, used when the
+    RemovalPlanner's answer doesn't satisfy apt.
+    """
     to_remove = set(to_remove)
     all_removed = set()
     while True:
@@ -680,6 +820,327 @@ def get_remove_list(cache, to_remove, recursive=False):
     return all_removed
 
 
+class RemovalPlanner:
+    """Work out the effects of removing installed packages.
+
+    Asking apt to mark each package for deletion and then looking for broken
+    packages costs a walk over the whole cache every time.  Instead, this
+    indexes the dependencies of all installed packages once: each
+    (Pre-)Depends alternative group knows how many installed packages
+    satisfy it, and each package knows which groups it helps to satisfy.
+    Removing a package decrements its groups, and a group reaching zero
+    breaks the package it belongs to.
+
+    Removals are tracked here until confirm() passes the final set to apt.
+    """
+
+    _DEPENDS_KEYS = ('PreDepends', 'Pre-Depends', 'Depends')
+
+    def __init__(self, cache):
+        self.cache = cache
+        depcache = cache._depcache
+        self._installed = set()
+        # group index -> name of the package with the dependency
+        self._groups = []
+        # group index -> installed satisfiers not yet removed
+        self._remaining = []
+        # package name -> indices of groups it satisfies
+        self._rdepends = {}
+        self.removed = set()
+        for pkg in cache._cache.packages:
+            ver = pkg.current_ver
+            if ver is None:
+                continue
+            name = pkg.get_fullname(True)
+            self._installed.add(name)
+            if depcache.marked_delete(pkg):
+                self.removed.add(name)
+            depends_list = ver.depends_list
+            for key in self._DEPENDS_KEYS:
+                for dep_or in depends_list.get(key, ()):
+                    satisfiers = set()
+                    for dep in dep_or:
+                        for target in dep.all_targets():
+                            target_pkg = target.parent_pkg
+                            current = target_pkg.current_ver
+                            if current is not None and current.id == target.id:
+                                satisfiers.add(target_pkg.get_fullname(True))
+                    if not satisfiers:
+                        # Already broken; nothing we do can make it worse.
+                        continue
+                    group = len(self._groups)
+                    self._groups.append(name)
+                    self._remaining.append(len(satisfiers))
+                    for satisfier in satisfiers:
+                        self._rdepends.setdefault(satisfier, []).append(group)
+        # Account for anything that was already marked for removal.
+        self._apply(self.removed, self._remaining)
+
+    def _apply(self, packages, remaining):
+        """Remove packages from remaining; return the packages broken."""
+        broken = set()
+        for pkg in packages:
+            for group in self._rdepends.get(pkg, ()):
+                remaining[group] -= 1
+                if remaining[group] == 0:
+                    broken.add(self._groups[group])
+        return broken
+
+    def closure(self, pkgs):
+        """Return pkgs plus everything that removing them would break.
+
+        Packages that are not installed or already removed are ignored.
+        """
+        result = {pkg for pkg in pkgs
+                  if pkg in self._installed and pkg not in self.removed}
+        # Only the groups we touch are copied.
+        remaining = _CountOverlay(self._remaining)
+        queue = list(result)
+        while queue:
+            for dependent in self._apply([queue.pop()], remaining):
+                if dependent not in result and dependent not in self.removed:
+                    result.add(dependent)
+                    queue.append(dependent)
+        return result
+
+    def remove(self, pkgs):
+        """Record pkgs (which should be a closure) as removed."""
+        pkgs = set(pkgs) - self.removed
+        self._apply(pkgs, self._remaining)
+        self.removed |= pkgs
+
+    def get_remove_list(self, to_remove, recursive=False):
+        """Like get_remove_list, but only recording removals here."""
+        to_remove = set(to_remove)
+        all_removed = set()
+        while True:
+            removed = set()
+            for pkg in to_remove:
+                if pkg not in self._installed:
+                    continue
+                if pkg in self.removed:
+                    removed.add(pkg)
+                    continue
+                closure = self.closure([pkg])
+                broken = closure - {pkg}
+                # If we're recursively removing packages, or if all of the
+                # broken packages are in the set of packages to remove
+                # anyway, then go ahead and remove them too.
+                if broken and not recursive and not broken <= to_remove:
+                    continue
+                self.remove(closure)
+                removed |= closure
+            if not removed:
+                break
+            to_remove -= removed
+            all_removed |= removed
+        return all_removed
+
+    def confirm(self, pkgs):
+        """Mark pkgs for removal in apt; return True if apt agrees.
+
+        If it doesn't, the marks are reverted.
+        """
+        marked = []
+        try:
+            for pkg in sorted(pkgs):
+                cachedpkg = get_cache_pkg(self.cache, pkg)
+                if cachedpkg is None:
+                    continue
+                marked.append(cachedpkg)
+                cachedpkg.mark_delete(auto_fix=False, purge=True)
+            if self.cache._depcache.broken_count == 0:
+                return True
+        except SystemError:
+            pass
+        for cachedpkg in marked:
+            cachedpkg.mark_keep()
+        return False
+
+
+class _CountOverlay(dict):
+    """A copy-on-write view of a list of counts."""
+
+    def __init__(self, counts):
+        super().__init__()
+        self._counts = counts
+
+    def __missing__(self, key):
+        return self._counts[key]
+
+
+def get_remove_list(cache, to_remove, recursive=False):
+    """Mark packages for removal, returning the set actually removed.
+
+    Packages whose removal would break others are only removed if recursive
+    is True or if everything they break is also in to_remove.
+    """
+    planner = RemovalPlanner(cache)
+    removed = planner.get_remove_list(to_remove, recursive)
+    if planner.confirm(removed):
+        return removed
+    syslog.syslog('apt disagreed with planned removal of %s; asking it '
+                  'directly' % ' '.join(sorted(removed)))
+    return get_remove_list_apt(cache, to_remove, recursive)
+
+
+class PathIndex:
+    """A set of absolute paths, such as the output of dpkg -L.
+
+    Paths are stored as a map from each directory (relative to the root,
+    without a leading slash) to the names in it, so that a directory walker
+    can check membership using the directory and name it already has rather
+    than building the full path again for every file.  Leaf names are
+    shared between directories, since the same few (copyright,
+    changelog.Debian.gz, ...) turn up in thousands of them, and directories
+    with only a few names keep them in a tuple rather than a set.
+
+    As with the old dictionary-based blacklist, entries at the top level of
+    the filesystem are never considered blacklisted.
+    """
+
+    # Directories with at most this many names use a tuple.
+    SMALL_DIRECTORY = 8
+
+    def __init__(self, paths=()):
+        names = {}
+        leaves = {}
+        self.count = 0
+        for path in paths:
+            # dpkg -L also prints diversion information, e.g. "diverted by
+            # foo to: /path"; skip that.
+            if not path.startswith('/'):
+                continue
+            dirpath, _, name = path[1:].rpartition('/')
+            if not dirpath or not name or name == '.':
+                continue
+            dirnames = names.get(dirpath)
+            if dirnames is None:
+                dirnames = names[dirpath] = set()
+            if name not in dirnames:
+                dirnames.add(leaves.setdefault(name, name))
+                self.count += 1
+        self._names = {
+            dirpath: (tuple(dirnames)
+                      if len(dirnames) <= self.SMALL_DIRECTORY
+                      else frozenset(dirnames))
+            for dirpath, dirnames in names.items()}
+        # dirpath -> names of subdirectories that can be skipped entirely
+        self._prunable = {}
+        # prunable directory -> names of its subdirectories
+        self._subdirectories = {}
+
+    def __len__(self):
+        return self.count
+
+    def contains(self, dirpath, name):
+        """Is name in dirpath (relative to the root) in the index?"""
+        names = self._names.get(dirpath)
+        return names is not None and name in names
+
+    def prunable(self, dirpath, name):
+        """Can the directory name in dirpath be skipped entirely?"""
+        names = self._prunable.get(dirpath)
+        return names is not None and name in names
+
+    def pruned_directories(self, relpath):
+        """Yield the directories beneath the prunable directory relpath.
+
+        Packages that we keep may own some of them, so they must still be
+        created even though nothing in them is copied.  Parents come before
+        their subdirectories.
+        """
+        for name in self._subdirectories.get(relpath, ()):
+            subdir = os.path.join(relpath, name)
+            yield subdir
+            yield from self.pruned_directories(subdir)
+
+    def find_prunable(self, root):
+        """Find directories under root whose whole contents are indexed.
+
+        Such a directory, and the directories beneath it, still need to be
+        created, but there is no need to walk it: everything else in it would
+        be skipped anyway.  Returns the number of prunable directories found.
+        """
+        self._prunable = {}
+        self._subdirectories = {}
+        found = 0
+        # Deepest first, so that we know about prunable subdirectories
+        # before we look at their parents.
+        for dirpath in sorted(self._names, key=lambda d: d.count('/'),
+                              reverse=True):
+            parent, _, name = dirpath.rpartition('/')
+            if not self.contains(parent, name):
+                continue
+            names = self._names[dirpath]
+            subdirs = []
+            try:
+                with os.scandir(os.path.join(root, dirpath)) as entries:
+                    for entry in entries:
+                        if entry.name not in names:
+                            break
+                        if entry.is_dir(follow_symlinks=False):
+                            if not self.prunable(dirpath, entry.name):
+                                break
+                            subdirs.append(entry.name)
+                    else:
+                        self._prunable.setdefault(parent, set()).add(name)
+                        if subdirs:
+                            self._subdirectories[dirpath] = tuple(subdirs)
+                        found += 1
+            except OSError:
+                continue
+        return found
+
+
+def walk_tree(root, manifest=None, blacklist=None):
+    """Yield (relpath, stat) for each path in the tree at root.
+
+    Directories always come before their contents.  If we have a manifest,
+    the stat objects come from that rather than from the filesystem.  If we
+    have a blacklist (a PathIndex), non-directories in it are skipped, and
+    directories that it says can be pruned are not walked, although they and
+    the directories beneath them are still yielded.
+    """
+    debug = 'UBIQUITY_DEBUG' in os.environ
+    if manifest is not None:
+        # Directories whose contents we're skipping.
+        pruned = set()
+        for entry in manifest:
+            relpath = entry.relpath
+            if blacklist is not None:
+                sp, _, name = relpath.rpartition('/')
+                if stat.S_ISDIR(entry.st_mode):
+                    if sp in pruned or blacklist.prunable(sp, name):
+                        pruned.add(relpath)
+                elif sp in pruned:
+                    continue
+                elif blacklist.contains(sp, name):
+                    if debug:
+                        syslog.syslog('Not copying %s' % relpath)
+                    continue
+            yield relpath, entry
+        return
+    for dirpath, dirnames, filenames in os.walk(root):
+        sp = dirpath[len(root) + 1:]
+        for name in dirnames + filenames:
+            relpath = os.path.join(sp, name)
+            st = os.lstat(os.path.join(root, relpath))
+            if blacklist is not None:
+                if stat.S_ISDIR(st.st_mode):
+                    if blacklist.prunable(sp, name):
+                        dirnames.remove(name)
+                        yield relpath, st
+                        for subdir in blacklist.pruned_directories(relpath):
+                            yield subdir, os.lstat(os.path.join(root, subdir))
+                        continue
+                elif blacklist.contains(sp, name):
+                    if debug:
+                        syslog.syslog('Not copying %s' % relpath)
+                    continue
+            yield relpath, st
+
+
 def remove_target(source_root, target_root, relpath, st_source):
     """Remove a target file if necessary and if we can.
 
@@ -753,48 +1214,765 @@ def remove_target(source_root, target_root, relpath, st_source):
             backuppath = backuppath + '.bak'
 
 
-def copy_file(db, sourcepath, targetpath, md5_check):
-    while 1:
-        if md5_check:
-            sourcehash = hashlib.md5()
+# Errors from copy_file_range and sendfile that mean "not supported for
+# this pair of files" rather than a real I/O problem.
+_kernel_copy_fallback_errnos = (
+    errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP)
 
-        with open(sourcepath, 'rb') as sourcefh:
-            with open(targetpath, 'wb') as targetfh:
-                while True:
-                    buf = sourcefh.read(16 * 1024)
-                    if not buf:
-                        break
-                    targetfh.write(buf)
-                    if md5_check:
-                        sourcehash.update(buf)
+# Kernel copy backends that have failed with one of the errors above.  The
+# source and target filesystems don't change during an install, so there is
+# no point in trying these again for every file.
+_kernel_copy_unsupported = set()
 
-        if not md5_check:
+
+def copy_chunk_size(size):
+    """Return a read size suited to copying a file of the given size.
+
+    Small files are read in one go; large ones in chunks of up to 1 MiB.
+    """
+    return min(max(size, 16 * 1024), 1024 * 1024)
+
+
+def _copy_file_range(sourcefd, targetfd, offset, count):
+    return os.copy_file_range(sourcefd, targetfd, count, offset, offset)
+
+
+def _sendfile(sourcefd, targetfd, offset, count):
+    return os.sendfile(targetfd, sourcefd, offset, count)
+
+
+_kernel_copy_backends = []
+if hasattr(os, 'copy_file_range'):
+    _kernel_copy_backends.append(('copy_file_range', _copy_file_range))
+if hasattr(os, 'sendfile'):
+    _kernel_copy_backends.append(('sendfile', _sendfile))
+
+
+def _kernel_copy(name, func, sourcefd, targetfd, size):
+    """Copy a file without passing its data through user space.
+
+    Return False if this backend cannot handle this pair of files.
+    """
+    chunk = max(copy_chunk_size(size), size)
+    copied = 0
+    while True:
+        try:
+            count = func(sourcefd, targetfd, copied, chunk)
+        except OSError as e:
+            if copied == 0 and e.errno in _kernel_copy_fallback_errnos:
+                if name not in _kernel_copy_unsupported:
+                    _kernel_copy_unsupported.add(name)
+                    syslog.syslog('%s unavailable (%s); falling back' %
+                                  (name, e))
+                return False
+            raise
+        if count == 0:
+            return True
+        copied += count
+
+
+def copy_fd_data(sourcefd, targetfd, hash_source=False, size=None):
+    """Copy the contents of the file open on sourcefd to targetfd.
+
+    Return a tuple of the MD5 digest of the source data (only if
+    hash_source is set, otherwise None) and the name of the backend used to
+    copy it.  Unless we need to hash the data, it is copied in the kernel if
+    possible.  This never talks to debconf, so it is safe to call from copy
+    worker threads.
+    """
+    if size is None:
+        size = os.fstat(sourcefd).st_size
+    if not hash_source:
+        for name, func in _kernel_copy_backends:
+            if name in _kernel_copy_unsupported:
+                continue
+            if _kernel_copy(name, func, sourcefd, targetfd, size):
+                return None, name
+
+    # Either we need to hash the data as it goes past, or the kernel can't
+    # copy it for us.
+    chunk = copy_chunk_size(size)
+    sourcehash = hashlib.md5() if hash_source else None
+    while True:
+        buf = os.read(sourcefd, chunk)
+        if not buf:
+            break
+        view = memoryview(buf)
+        while view:
+            view = view[os.write(targetfd, view):]
+        if hash_source:
+            sourcehash.update(buf)
+
+    if hash_source:
+        return sourcehash.digest(), 'read/write'
+    else:
+        return None, 'read/write'
+
+
+def copy_file_data(sourcepath, targetpath, hash_source=False, size=None):
+    """Copy the contents of sourcepath to targetpath.
+
+    See copy_fd_data for the return value.
+    """
+    with open(sourcepath, 'rb') as sourcefh:
+        with open(targetpath, 'wb') as targetfh:
+            return copy_fd_data(
+                sourcefh.fileno(), targetfh.fileno(), hash_source, size)
+
+
+# Ways of checking that a copied file matches its source.  "full" reads the
+# whole target back and compares its MD5 hash with that of the source data
+# as it was copied; "sampled" compares a few blocks of each file; "manifest"
+# compares the hash of the source data as it was copied with a hash
+# precomputed when the image was built, falling back to "full" for files
+# with no such hash.
+VERIFY_MODES = ('full', 'sampled', 'manifest')
+
+# Files up to four samples long are compared in full in "sampled" mode.
+VERIFY_SAMPLE_SIZE = 64 * 1024
+
+
+def verify_hashes_source(mode):
+    """Does this verification mode need a hash of the source data?"""
+    return mode != 'sampled'
+
+
+def _hash_fd(fd, size):
+    filehash = hashlib.md5()
+    chunk = copy_chunk_size(size)
+    offset = 0
+    while True:
+        buf = os.pread(fd, chunk, offset)
+        if not buf:
             break
+        filehash.update(buf)
+        offset += len(buf)
+    return filehash.digest()
 
+
+def _verify_samples(sourcefd, targetfd, size):
+    block = VERIFY_SAMPLE_SIZE
+    if size <= block * 4:
+        samples = [(0, size)]
+    else:
+        samples = [(0, block), ((size - block) // 2, block),
+                   (size - block, block)]
+    read_back = 0
+    if os.fstat(targetfd).st_size != size:
+        return False, read_back
+    for offset, length in samples:
+        if (os.pread(sourcefd, length, offset) !=
+                os.pread(targetfd, length, offset)):
+            return False, read_back
+        read_back += length
+    return True, read_back
+
+
+def verify_fd(sourcefd, targetfd, mode, sourcehash=None, expected=None,
+              size=None):
+    """Check that the file open on targetfd matches sourcefd after copying.
+
+    See verify_file.  targetfd must be open for reading.
+    """
+    if size is None:
+        size = os.fstat(sourcefd).st_size
+    if mode == 'manifest' and expected is not None:
+        return sourcehash == expected, 0
+    elif mode == 'sampled':
+        return _verify_samples(sourcefd, targetfd, size)
+    else:
+        read_back = size
+        if sourcehash is None:
+            sourcehash = _hash_fd(sourcefd, size)
+            read_back += size
+        return _hash_fd(targetfd, size) == sourcehash, read_back
+
+
+def verify_file(sourcepath, targetpath, mode, sourcehash=None, expected=None,
+                size=None):
+    """Check that targetpath matches sourcepath after copying.
+
+    sourcehash is the MD5 digest of the source data as it was copied, if
+    the mode needs it, and expected is the digest recorded for this file
+    when the image was built, if any.  Return a tuple of whether the target
+    matches and the number of bytes read back from disk to find out.
+    """
+    with open(sourcepath, 'rb') as sourcefh:
         with open(targetpath, 'rb') as targetfh:
-            if md5_check:
-                targethash = hashlib.md5()
-            while True:
-                buf = targetfh.read(16 * 1024)
-                if not buf:
-                    break
-                targethash.update(buf)
-
-        if targethash.digest() != sourcehash.digest():
-            error_template = 'ubiquity/install/copying_error/md5'
-            db.subst(error_template, 'FILE', targetpath)
-            db.input('critical', error_template)
-            db.go()
-            response = db.get(error_template)
-            if response == 'skip':
-                break
-            elif response == 'abort':
-                syslog.syslog(syslog.LOG_ERR, 'MD5 failure on %s' % targetpath)
-                sys.exit(3)
-            elif response == 'retry':
-                pass
-        else:
+            return verify_fd(sourcefh.fileno(), targetfh.fileno(), mode,
+                             sourcehash, expected, size)
+
+
+def load_md5sums(path, root):
+    """Load a list of MD5 sums in md5sum(1) format.
+
+    File names are taken to be relative to root.  Return a dictionary
+    mapping absolute paths under root to binary digests.
+    """
+    md5sums = {}
+    with open(path) as md5sums_file:
+        for line in md5sums_file:
+            try:
+                digest, name = line.rstrip('\n').split(None, 1)
+                digest = bytes.fromhex(digest)
+            except ValueError:
+                continue
+            # md5sum(1) marks binary mode with a '*' before the name.
+            name = name.lstrip('*')
+            if name.startswith('./'):
+                name = name[2:]
+            md5sums[os.path.join(root, name.lstrip('/'))] = digest
+    return md5sums
+
+
+def copy_file_mismatch(db, targetpath):
+    """Ask the user what to do about a file that failed verification.
+
+    Return True if the copy should be retried.
+    """
+    error_template = 'ubiquity/install/copying_error/md5'
+    db.subst(error_template, 'FILE', targetpath)
+    db.input('critical', error_template)
+    db.go()
+    response = db.get(error_template)
+    if response == 'abort':
+        syslog.syslog(syslog.LOG_ERR, 'MD5 failure on %s' % targetpath)
+        sys.exit(3)
+    return response == 'retry'
+
+
+def copy_file(db, sourcepath, targetpath, md5_check, mode='full',
+              expected=None):
+    while 1:
+        sourcehash, _ = copy_file_data(
+            sourcepath, targetpath, md5_check and verify_hashes_source(mode))
+        if not md5_check:
             break
+        if verify_file(sourcepath, targetpath, mode, sourcehash, expected)[0]:
+            break
+        if not copy_file_mismatch(db, targetpath):
+            break
+
+
+def copy_metadata(sourcepath, targetpath, st):
+    """Copy ownership, permissions, timestamps and extended attributes.
+
+    Directory timestamps are left alone, since they will change again as
+    soon as anything is created inside them; callers should apply those
+    once the whole tree has been copied.  st may also be an entry from a
+    copy manifest, in which case we skip looking for extended attributes
+    unless the manifest says there are some.
+    """
+    os.lchown(targetpath, st.st_uid, st.st_gid)
+    if not stat.S_ISLNK(st.st_mode):
+        os.chmod(targetpath, stat.S_IMODE(st.st_mode))
+    # os.utime() sets timestamp of target, not link
+    if not stat.S_ISDIR(st.st_mode) and not stat.S_ISLNK(st.st_mode):
+        try:
+            os.utime(targetpath, (st.st_atime, st.st_mtime))
+        except Exception:
+            # We can live with timestamps being wrong.
+            pass
+    if (getattr(st, "has_xattrs", True) and
+            hasattr(os, "listxattr") and
+            hasattr(os, "supports_follow_symlinks") and
+            os.supports_follow_symlinks):
+        try:
+            attrnames = os.listxattr(sourcepath, follow_symlinks=False)
+            for attrname in attrnames:
+                attrvalue = os.getxattr(
+                    sourcepath, attrname, follow_symlinks=False)
+                os.setxattr(
+                    targetpath, attrname, attrvalue, follow_symlinks=False)
+        except OSError as e:
+            if e.errno not in (errno.EPERM, errno.ENOTSUP, errno.ENODATA):
+                raise
+
+
+def copy_metadata_fd(sourcefd, targetfd, st):
+    """Like copy_metadata, for a regular file open on targetfd."""
+    os.fchown(targetfd, st.st_uid, st.st_gid)
+    os.fchmod(targetfd, stat.S_IMODE(st.st_mode))
+    try:
+        os.utime(targetfd, (st.st_atime, st.st_mtime))
+    except Exception:
+        # We can live with timestamps being wrong.
+        pass
+    if getattr(st, "has_xattrs", True) and hasattr(os, "listxattr"):
+        try:
+            for attrname in os.listxattr(sourcefd):
+                os.setxattr(
+                    targetfd, attrname, os.getxattr(sourcefd, attrname))
+        except OSError as e:
+            if e.errno not in (errno.EPERM, errno.ENOTSUP, errno.ENODATA):
+                raise
+
+
+# Files smaller than this are copied in batches, one directory at a time,
+# so that we can open them relative to directory file descriptors rather
+# than looking up every path from the root.
+BATCH_FILE_SIZE = 64 * 1024
+BATCH_MAX_FILES = 64
+BATCH_MAX_SIZE = 1024 * 1024
+
+# Files at least this big get their own set of workers, so that they start
+# as soon as we find them rather than queueing behind lots of small files.
+LARGE_FILE_SIZE = 4 * 1024 * 1024
+
+
+def copy_size_class(size):
+    """Return the size class used for scheduling a file of this size."""
+    if size < BATCH_FILE_SIZE:
+        return 'small'
+    elif size < LARGE_FILE_SIZE:
+        return 'medium'
+    else:
+        return 'large'
+
+
+_CopyResult = collections.namedtuple(
+    '_CopyResult', ['sourcepath', 'targetpath', 'st', 'verified', 'backend',
+                    'copy_time', 'read_back', 'verify_time', 'total_time'])
+
+
+class FileCopier:
+    """Copy regular files, optionally using a pool of worker threads.
+
+    Workers copy file data and metadata; anything that needs to talk to
+    debconf (verification failures) is handled in the calling thread when
+    results are collected, so the caller remains the only user of db.
+    With a single worker, files are copied inline as they are submitted.
+
+    Small files are batched per directory, and large files are handed to a
+    separate set of workers so that they overlap with the small-file churn.
+    """
+
+    def __init__(self, db, md5_check, workers=1, verify_mode='full',
+                 md5sums=None):
+        self.db = db
+        self.md5_check = md5_check
+        self.verify_mode = verify_mode
+        self.hash_source = md5_check and verify_hashes_source(verify_mode)
+        self.md5sums = md5sums or {}
+        self.workers = max(1, workers)
+        # Bound the number of queued jobs so that we don't run far ahead of
+        # the disk and hold the whole tree in memory.
+        self.max_pending = self.workers * 4
+        self.futures = set()
+        # (source directory, target directory, [(name, st), ...], size)
+        self.batch = None
+        self.copied_size = 0
+        self.start_time = time.time()
+        # backend name -> [files, bytes, seconds spent copying data]
+        self.backends = {}
+        # size class -> [files, bytes, seconds spent in workers]
+        self.size_classes = {}
+        # [bytes verified, bytes read back, seconds spent verifying]
+        self.verified = [0, 0, 0.0]
+        if self.workers > 1:
+            self.executor = futures.ThreadPoolExecutor(
+                max_workers=self.workers)
+            self.large_executor = futures.ThreadPoolExecutor(
+                max_workers=max(1, self.workers // 2))
+        else:
+            self.executor = None
+            self.large_executor = None
+
+    @property
+    def pending(self):
+        """The number of jobs that have not yet been collected."""
+        return len(self.futures) + (1 if self.batch else 0)
+
+    def _copy_fds(self, sourcefd, targetfd, sourcepath, targetpath, st,
+                  start):
+        sourcehash, backend = copy_fd_data(
+            sourcefd, targetfd, self.hash_source, st.st_size)
+        copy_time = time.time() - start
+        verified = True
+        read_back = 0
+        verify_time = 0.0
+        if self.md5_check:
+            verify_start = time.time()
+            verified, read_back = verify_fd(
+                sourcefd, targetfd, self.verify_mode, sourcehash,
+                self.md5sums.get(sourcepath), st.st_size)
+            verify_time = time.time() - verify_start
+        if verified:
+            copy_metadata_fd(sourcefd, targetfd, st)
+        return _CopyResult(sourcepath, targetpath, st, verified, backend,
+                           copy_time, read_back, verify_time,
+                           time.time() - start)
+
+    def _copy(self, sourcepath, targetpath, st):
+        start = time.time()
+        sourcefd = os.open(sourcepath, os.O_RDONLY)
+        try:
+            targetfd = os.open(
+                targetpath, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+            try:
+                return [self._copy_fds(sourcefd, targetfd, sourcepath,
+                                       targetpath, st, start)]
+            finally:
+                os.close(targetfd)
+        finally:
+            os.close(sourcefd)
+
+    def _copy_batch(self, sourcedir, targetdir, entries):
+        results = []
+        sourcedirfd = os.open(sourcedir, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            targetdirfd = os.open(targetdir, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                for name, st in entries:
+                    start = time.time()
+                    sourcepath = os.path.join(sourcedir, name)
+                    targetpath = os.path.join(targetdir, name)
+                    # Errors should name the full path, so that our caller
+                    # can tell whether the source or the target is at fault.
+                    try:
+                        sourcefd = os.open(
+                            name, os.O_RDONLY, dir_fd=sourcedirfd)
+                    except OSError as e:
+                        raise OSError(e.errno, e.strerror, sourcepath)
+                    try:
+                        try:
+                            targetfd = os.open(
+                                name, os.O_RDWR | os.O_CREAT | os.O_TRUNC,
+                                0o600, dir_fd=targetdirfd)
+                        except OSError as e:
+                            raise OSError(e.errno, e.strerror, targetpath)
+                        try:
+                            results.append(self._copy_fds(
+                                sourcefd, targetfd, sourcepath, targetpath,
+                                st, start))
+                        finally:
+                            os.close(targetfd)
+                    finally:
+                        os.close(sourcefd)
+            finally:
+                os.close(targetdirfd)
+        finally:
+            os.close(sourcedirfd)
+        return results
+
+    def _finish(self, results):
+        for result in results:
+            st = result.st
+            if not result.verified:
+                if copy_file_mismatch(self.db, result.targetpath):
+                    copy_file(self.db, result.sourcepath, result.targetpath,
+                              self.md5_check, self.verify_mode,
+                              self.md5sums.get(result.sourcepath))
+                copy_metadata(result.sourcepath, result.targetpath, st)
+            self.copied_size += st.st_size
+            stats = self.backends.setdefault(result.backend, [0, 0, 0.0])
+            stats[0] += 1
+            stats[1] += st.st_size
+            stats[2] += result.copy_time
+            stats = self.size_classes.setdefault(
+                copy_size_class(st.st_size), [0, 0, 0.0])
+            stats[0] += 1
+            stats[1] += st.st_size
+            stats[2] += result.total_time
+            if self.md5_check:
+                self.verified[0] += st.st_size
+                self.verified[1] += result.read_back
+                self.verified[2] += result.verify_time
+
+    def log_statistics(self):
+        """Log how much data each copy backend handled, and how fast."""
+        elapsed = time.time() - self.start_time
+        files = sum(stats[0] for stats in self.size_classes.values())
+        if elapsed > 0:
+            syslog.syslog('Copied %d files (%d bytes) in %.1fs: %.0f files/s, '
+                          '%.1f MiB/s' %
+                          (files, self.copied_size, elapsed, files / elapsed,
+                           self.copied_size / elapsed / 1048576))
+        for size_class in ('small', 'medium', 'large'):
+            if size_class not in self.size_classes:
+                continue
+            files, size, elapsed = self.size_classes[size_class]
+            if elapsed > 0:
+                syslog.syslog(
+                    'Copied %d %s files (%d bytes): %.0f files/s, %.1f MiB/s '
+                    'per worker' %
+                    (files, size_class, size, files / elapsed,
+                     size / elapsed / 1048576))
+        for backend, (files, size, elapsed) in sorted(self.backends.items()):
+            if elapsed > 0:
+                speed = '%.1f MiB/s per worker' % (size / elapsed / 1048576)
+            else:
+                speed = 'unknown speed'
+            syslog.syslog('Copied %d files (%d bytes) using %s, %s' %
+                          (files, size, backend, speed))
+        if self.md5_check:
+            size, read_back, elapsed = self.verified
+            syslog.syslog(
+                'Verified %d bytes (%s mode), reading back %d bytes in '
+                '%.1fs' % (size, self.verify_mode, read_back, elapsed))
+            # A full read-back reads every byte of the target once.
+            # Assume that it would have gone at the rate we managed for
+            # the data we did read back.
+            if read_back and size > read_back:
+                saved = (size - read_back) * elapsed / read_back
+                syslog.syslog(
+                    'Verification saved reading back %d bytes, about %.1fs '
+                    'of worker time' % (size - read_back, saved))
+            elif size > read_back:
+                syslog.syslog(
+                    'Verification saved reading back %d bytes' %
+                    (size - read_back))
+
+    def _run(self, executor, func, *args):
+        if executor is None:
+            self._finish(func(*args))
+            return
+        self.futures.add(executor.submit(func, *args))
+        if len(self.futures) >= self.max_pending:
+            self.wait()
+        else:
+            self.collect()
+
+    def flush(self):
+        """Start copying the current batch of small files."""
+        if self.batch:
+            sourcedir, targetdir, entries, _ = self.batch
+            self.batch = None
+            self._run(self.executor, self._copy_batch,
+                      sourcedir, targetdir, entries)
+
+    def submit(self, sourcepath, targetpath, st):
+        """Copy a regular file, possibly in the background."""
+        size_class = copy_size_class(st.st_size)
+        if size_class == 'small':
+            sourcedir, name = os.path.split(sourcepath)
+            if self.batch and self.batch[0] != sourcedir:
+                self.flush()
+            if not self.batch:
+                self.batch = (sourcedir, os.path.dirname(targetpath), [], 0)
+            entries = self.batch[2]
+            entries.append((name, st))
+            self.batch = self.batch[:3] + (self.batch[3] + st.st_size,)
+            if (len(entries) >= BATCH_MAX_FILES or
+                    self.batch[3] >= BATCH_MAX_SIZE):
+                self.flush()
+        elif size_class == 'large':
+            self._run(self.large_executor, self._copy,
+                      sourcepath, targetpath, st)
+        else:
+            self._run(self.executor, self._copy, sourcepath, targetpath, st)
+
+    def collect(self, done=None):
+        """Process any files that have finished copying."""
+        if done is None:
+            done = [future for future in self.futures if future.done()]
+        for future in done:
+            self.futures.discard(future)
+            # This re-raises any exception from the worker.
+            self._finish(future.result())
+
+    def wait(self):
+        """Block until at least one pending job has finished copying."""
+        self.flush()
+        if self.futures:
+            done, _ = futures.wait(
+                self.futures, return_when=futures.FIRST_COMPLETED)
+            self.collect(done)
+
+    def shutdown(self):
+        """Stop the workers, abandoning any files not yet started."""
+        for executor in (self.executor, self.large_executor):
+            if executor is not None:
+                for future in self.futures:
+                    future.cancel()
+                executor.shutdown(wait=True)
+        self.executor = None
+        self.large_executor = None
+        self.futures = set()
+        self.batch = None
+
+
+class Stage:
+    """A step of the installation, for StageScheduler.run_group.
+
+    The stages named in after must finish first.  If error_message is set,
+    a failure is logged with it and then on_error (if any) is called in
+    the scheduling thread; otherwise the failure is raised once the running
+    stages have finished.  Stages with main set run in the scheduling
+    thread rather than a worker, e.g. because they fork with preexec_fn.
+    """
+
+    def __init__(self, name, func, after=(), error_message=None,
+                 on_error=None, main=False):
+        self.name = name
+        self.func = func
+        self.after = set(after)
+        self.error_message = error_message
+        self.on_error = on_error
+        self.main = main
+
+
+class StageScheduler:
+    """Run installation stages, concurrently where they allow it.
+
+    Everything run through the scheduler is timed, so that we can write a
+    report at the end of the installation.  While a group of stages is
+    running, commands sent to db are serialised, so stages may use it from
+    worker threads.
+    """
+
+    def __init__(self, db=None, workers=4):
+        self.db = db
+        self.workers = workers
+        self.start_time = time.time()
+        # (name, start offset, elapsed, thread name, outcome)
+        self.timings = []
+
+    def _record(self, name, start, end, thread, outcome):
+        self.timings.append(
+            (name, start - self.start_time, end - start, thread, outcome))
+
+    def run(self, name, func, *args, **kwargs):
+        """Run a single stage in this thread."""
+        start = time.time()
+        outcome = 'failed'
+        try:
+            ret = func(*args, **kwargs)
+            outcome = 'ok'
+            return ret
+        finally:
+            self._record(name, start, time.time(),
+                         threading.current_thread().name, outcome)
+
+    def _call(self, stage):
+        start = time.time()
+        try:
+            stage.func()
+            exc_info = None
+        except Exception:
+            exc_info = sys.exc_info()
+        return start, time.time(), threading.current_thread().name, exc_info
+
+    def _finish(self, stage, result):
+        """Record a finished stage; return exc_info if it must be raised."""
+        start, end, thread, exc_info = result
+        self._record(stage.name, start, end, thread,
+                     'ok' if exc_info is None else 'failed')
+        if exc_info is None:
+            return None
+        if stage.error_message is None:
+            return exc_info
+        syslog.syslog(syslog.LOG_WARNING, stage.error_message)
+        formatted = ''.join(traceback.format_exception(*exc_info))
+        for line in formatted.split('\n'):
+            syslog.syslog(syslog.LOG_WARNING, line)
+        if stage.on_error is not None:
+            stage.on_error()
+        return None
+
+    def _lock_db(self):
+        if self.db is None:
+            return lambda: None
+        lock = threading.RLock()
+        command = self.db.command
+
+        def locked_command(*args, **kwargs):
+            with lock:
+                return command(*args, **kwargs)
+
+        self.db.command = locked_command
+
+        def restore():
+            del self.db.command
+
+        return restore
+
+    def run_group(self, stages):
+        """Run stages, each as soon as the stages it comes after are done."""
+        names = {stage.name for stage in stages}
+        for stage in stages:
+            if not stage.after <= names:
+                raise ValueError('%s comes after unknown stages: %s' %
+                                 (stage.name,
+                                  ', '.join(sorted(stage.after - names))))
+        pending = list(stages)
+        done = set()
+        running = {}
+        failure = None
+        restore_db = self._lock_db()
+        executor = futures.ThreadPoolExecutor(max_workers=self.workers)
+        try:
+            while pending or running:
+                ready = [stage for stage in pending if stage.after <= done]
+                for stage in ready:
+                    pending.remove(stage)
+                    if not stage.main:
+                        running[executor.submit(self._call, stage)] = stage
+                inline = [stage for stage in ready if stage.main]
+                for stage in inline:
+                    failure = failure or self._finish(
+                        stage, self._call(stage))
+                    done.add(stage.name)
+                if failure is not None:
+                    # Don't start anything else.
+                    pending = []
+                if inline:
+                    continue
+                if not running:
+                    raise ValueError(
+                        'dependency cycle among stages: %s' %
+                        ', '.join(stage.name for stage in pending))
+                finished, _ = futures.wait(
+                    running, return_when=futures.FIRST_COMPLETED)
+                for future in finished:
+                    stage = running.pop(future)
+                    failure = failure or self._finish(
+                        stage, future.result())
+                    done.add(stage.name)
+                if failure is not None:
+                    pending = []
+        finally:
+            executor.shutdown(wait=True)
+            restore_db()
+        if failure is not None:
+            raise failure[1].with_traceback(failure[2])
+
+    def report(self):
+        """Return a report of how long each stage took, as a string."""
+        lines = ['%-32s %9s %9s  %-24s %s' %
+                 ('stage', 'start', 'elapsed', 'thread', 'outcome')]
+        for name, start, elapsed, thread, outcome in sorted(
+                self.timings, key=lambda timing: timing[1]):
+            lines.append('%-32s %8.2fs %8.2fs  %-24s %s' %
+                         (name, start, elapsed, thread, outcome))
+        lines.append('total: %.2fs' % (time.time() - self.start_time))
+        return '\n'.join(lines) + '\n'
+
+    def write_report(self, path):
+        """Write the report to path, and to syslog."""
+        report = self.report()
+        for line in report.splitlines():
+            syslog.syslog(line)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as report_file:
+                report_file.write(report)
+        except (IOError, OSError) as e:
+            syslog.syslog(syslog.LOG_WARNING,
+                          'Failed to write %s: %s' % (path, e))
+
+
+# Files in the target that an apt cache is built from.  If none of these
+# has changed, a cache opened earlier is still up to date.
+APT_CACHE_INPUTS = (
+    'var/lib/dpkg/status',
+    'var/lib/apt/extended_states',
+    'var/lib/apt/lists',
+    'etc/apt/sources.list',
+    'etc/apt/sources.list.d',
+    'etc/apt/preferences',
+    'etc/apt/preferences.d',
+)
 
 
 class InstallBase:
@@ -802,10 +1980,56 @@ class InstallBase:
         self.target = '/target'
         self.casper_path = os.path.join(
             '/cdrom', get_casper('LIVE_MEDIA_PATH', 'casper').lstrip('/'))
+        self._apt_cache = None
+        self._apt_cache_stamp = None
+        self.apt_cache_opens = 0
+        self.apt_cache_open_time = 0.0
 
     def target_file(self, *args):
         return os.path.join(self.target, *args)
 
+    def apt_cache_stamp(self):
+        stamp = []
+        for name in APT_CACHE_INPUTS:
+            try:
+                st = os.stat(self.target_file(name))
+                stamp.append((st.st_ino, st.st_size, st.st_mtime_ns))
+            except OSError:
+                stamp.append(None)
+        return tuple(stamp)
+
+    def apt_cache(self):
+        """Return the apt cache for the target.
+
+        One cache is shared by every step.  It is reopened only if the
+        dpkg status or the apt configuration in the target has changed
+        since it was last opened.  Changes that an earlier user marked but
+        never committed are cleared.
+        """
+        if (self._apt_cache is None or
+                self.apt_cache_stamp() != self._apt_cache_stamp):
+            return self.reopen_apt_cache()
+        depcache = self._apt_cache._depcache
+        if depcache.inst_count or depcache.del_count:
+            self._apt_cache.clear()
+        return self._apt_cache
+
+    def reopen_apt_cache(self):
+        """Read the apt cache for the target again, e.g. after a commit."""
+        start = time.time()
+        self._apt_cache_stamp = self.apt_cache_stamp()
+        if self._apt_cache is None:
+            self._apt_cache = Cache()
+        else:
+            self._apt_cache.open(None)
+        elapsed = time.time() - start
+        self.apt_cache_opens += 1
+        self.apt_cache_open_time += elapsed
+        syslog.syslog('Opened apt cache in %.3fs (%d opens, %.3fs in total)' %
+                      (elapsed, self.apt_cache_opens,
+                       self.apt_cache_open_time))
+        return self._apt_cache
+
     def warn_broken_packages(self, pkgs, err):
         pkgs = ', '.join(pkgs)
         syslog.syslog('broken packages after installation: %s' % pkgs)
@@ -923,74 +2147,74 @@ class InstallBase:
             'ubiquity/install/apt_indices_starting',
             'ubiquity/install/apt_indices')
 
-        with Cache() as cache:
+        cache = self.apt_cache()
 
-            if cache._depcache.broken_count > 0:
-                syslog.syslog(
-                    'not installing additional packages, since there are'
-                    ' broken packages: %s' % ', '.join(broken_packages(cache)))
-                self.db.progress('STOP')
-                self.nested_progress_end()
-                return
+        if cache._depcache.broken_count > 0:
+            syslog.syslog(
+                'not installing additional packages, since there are'
+                ' broken packages: %s' % ', '.join(broken_packages(cache)))
+            self.db.progress('STOP')
+            self.nested_progress_end()
+            return
 
-            with cache.actiongroup():
-                for pkg in to_install:
-                    mark_install(cache, pkg)
-
-            self.db.progress('SET', 1)
-            self.progress_region(1, 10)
-            if langpacks:
-                fetchprogress = DebconfAcquireProgress(
-                    self.db, 'ubiquity/langpacks/title', None,
-                    'ubiquity/langpacks/packages')
-                installprogress = DebconfInstallProgress(
-                    self.db, 'ubiquity/langpacks/title',
-                    'ubiquity/install/apt_info')
-            else:
-                fetchprogress = DebconfAcquireProgress(
-                    self.db, 'ubiquity/install/title', None,
-                    'ubiquity/install/fetch_remove')
-                installprogress = DebconfInstallProgress(
-                    self.db, 'ubiquity/install/title',
-                    'ubiquity/install/apt_info',
-                    'ubiquity/install/apt_error_install')
-            chroot_setup(self.target)
-            commit_error = None
+        with cache.actiongroup():
+            for pkg in to_install:
+                mark_install(cache, pkg)
+
+        self.db.progress('SET', 1)
+        self.progress_region(1, 10)
+        if langpacks:
+            fetchprogress = DebconfAcquireProgress(
+                self.db, 'ubiquity/langpacks/title', None,
+                'ubiquity/langpacks/packages')
+            installprogress = DebconfInstallProgress(
+                self.db, 'ubiquity/langpacks/title',
+                'ubiquity/install/apt_info')
+        else:
+            fetchprogress = DebconfAcquireProgress(
+                self.db, 'ubiquity/install/title', None,
+                'ubiquity/install/fetch_remove')
+            installprogress = DebconfInstallProgress(
+                self.db, 'ubiquity/install/title',
+                'ubiquity/install/apt_info',
+                'ubiquity/install/apt_error_install')
+        chroot_setup(self.target)
+        commit_error = None
+        try:
             try:
-                try:
-                    if not self.commit_with_verify(
-                            cache, fetchprogress, installprogress):
-                        fetchprogress.stop()
-                        installprogress.finish_update()
-                        self.db.progress('STOP')
-                        self.nested_progress_end()
-                        return
-                except IOError:
-                    for line in traceback.format_exc().split('\n'):
-                        syslog.syslog(syslog.LOG_ERR, line)
+                if not self.commit_with_verify(
+                        cache, fetchprogress, installprogress):
                     fetchprogress.stop()
                     installprogress.finish_update()
                     self.db.progress('STOP')
                     self.nested_progress_end()
                     return
-                except SystemError as e:
-                    for line in traceback.format_exc().split('\n'):
-                        syslog.syslog(syslog.LOG_ERR, line)
-                    commit_error = str(e)
-            finally:
-                chroot_cleanup(self.target)
-            self.db.progress('SET', 10)
+            except IOError:
+                for line in traceback.format_exc().split('\n'):
+                    syslog.syslog(syslog.LOG_ERR, line)
+                fetchprogress.stop()
+                installprogress.finish_update()
+                self.db.progress('STOP')
+                self.nested_progress_end()
+                return
+            except SystemError as e:
+                for line in traceback.format_exc().split('\n'):
+                    syslog.syslog(syslog.LOG_ERR, line)
+                commit_error = str(e)
+        finally:
+            chroot_cleanup(self.target)
+        self.db.progress('SET', 10)
 
-            cache.open(None)
-            if commit_error or cache._depcache.broken_count > 0:
-                if commit_error is None:
-                    commit_error = ''
-                brokenpkgs = broken_packages(cache)
-                self.warn_broken_packages(brokenpkgs, commit_error)
+        cache = self.reopen_apt_cache()
+        if commit_error or cache._depcache.broken_count > 0:
+            if commit_error is None:
+                commit_error = ''
+            brokenpkgs = broken_packages(cache)
+            self.warn_broken_packages(brokenpkgs, commit_error)
 
-            self.db.progress('STOP')
+        self.db.progress('STOP')
 
-            self.nested_progress_end()
+        self.nested_progress_end()
 
     def select_language_packs(self, save=False):
         try:
@@ -1044,7 +2268,7 @@ class InstallBase:
         except debconf.DebconfError:
             return
 
-        cache = Cache()
+        cache = self.apt_cache()
 
         to_install = []
         checker = osextras.find_on_path('check-language-support')
@@ -17,27 +17,60 @@
 
 """Parse the output of kbdnames-maker."""
 
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
 import gzip
 import io
+import json
+import os
+import sys
+
+from ubiquity import misc
 
 
 _default_filename = "/usr/lib/ubiquity/console-setup/kbdnames.gz"
+_default_index_filename = "/var/lib/ubiquity/kbdnames-index"
 
+_INDEX_VERSION = 1
 
-class KeyboardNames:
-    def __init__(self, filename=_default_filename):
-        self._current_lang = None
-        self._filename = filename
-        self._clear()
+# kbdnames-maker's output is a few megabytes once decompressed, and the
+# console-setup page asks about both the current language and C in turn,
+# so parsing the whole of it for each language is expensive.  We copy it
+# once into an uncompressed index, with lines grouped by language and a
+# JSON header recording where each language's lines start, so that one
+# language can be read by seeking straight to it.  The tables for the
+# most recently used languages are kept in memory.
+
+
+def _source_stamp(filename):
+    try:
+        st = os.stat(filename)
+        return [st.st_mtime_ns, st.st_size]
+    except OSError:
+        return None
+
+
+class _Tables:
+    """The layout and variant names for one language."""
+
+    def __init__(self):
+        self.layout_by_id = {}
+        self.layout_by_human = {}
+        self.variant_by_id = defaultdict(dict)
+        self.variant_by_human = defaultdict(dict)
 
-    def _clear(self):
-        self._layout_by_id = {}
-        self._layout_by_human = {}
-        self._variant_by_id = defaultdict(dict)
-        self._variant_by_human = defaultdict(dict)
 
-    def _load_file(self, lang, kbdnames):
+class KeyboardNames:
+    def __init__(self, filename=_default_filename,
+                 index_filename=_default_index_filename, cache_size=8):
+        self._filename = filename
+        self._index_filename = index_filename
+        self._cache_size = cache_size
+        self._index = None
+        self._data = None
+        self._cache = OrderedDict()
+        self.loads = 0
+
+    def _load_file(self, lang, kbdnames, tables):
         # TODO cjwatson 2012-07-19: Work around
         # http://bugs.python.org/issue10791 in Python 3.2.  When we can rely
         # on 3.3, this should be:
@@ -49,62 +82,117 @@ class KeyboardNames:
                 continue
 
             if element == "layout":
-                self._layout_by_id[name] = value
-                self._layout_by_human[value] = name
+                tables.layout_by_id[name] = value
+                tables.layout_by_human[value] = name
             elif element == "variant":
                 variantname, variantdesc = value.split("*", 1)
-                self._variant_by_id[name][variantname] = variantdesc
-                self._variant_by_human[name][variantdesc] = variantname
-
-    def _load(self, lang):
-        if lang == self._current_lang:
-            return
-
-        # Saving memory is more important than parsing time in the
-        # relatively rare case of changing languages, so we only keep data
-        # around for a single language.
-        self._clear()
+                tables.variant_by_id[name][variantname] = variantdesc
+                tables.variant_by_human[name][variantdesc] = variantname
 
+    def _build_index(self, stamp):
+        lines = OrderedDict()
         raw = gzip.open(self._filename)
         try:
-            with io.TextIOWrapper(raw) as kbdnames:
-                self._load_file(lang, kbdnames)
+            for line in raw:
+                lang = line.split(b"*", 1)[0]
+                lines.setdefault(lang, []).append(line.rstrip(b"\n"))
         finally:
             raw.close()
-        self._current_lang = lang
+        languages = {}
+        data = []
+        offset = 0
+        for lang, lang_lines in lines.items():
+            chunk = b"\n".join(lang_lines) + b"\n"
+            languages[lang.decode("UTF-8")] = [offset, len(chunk)]
+            data.append(chunk)
+            offset += len(chunk)
+        header = {"version": _INDEX_VERSION, "source": stamp,
+                  "languages": languages}
+        return json.dumps(header).encode("UTF-8") + b"\n", b"".join(data)
+
+    def _load_index(self):
+        if self._index is not None:
+            return
+        stamp = _source_stamp(self._filename)
+        try:
+            with open(self._index_filename, "rb") as index_file:
+                header = json.loads(index_file.readline().decode("UTF-8"))
+                if (header["version"] == _INDEX_VERSION and
+                        header["source"] == stamp):
+                    self._index = header["languages"]
+                    self._data = None
+                    self._base = index_file.tell()
+                    return
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        header, data = self._build_index(stamp)
+        self._index = json.loads(header.decode("UTF-8"))["languages"]
+        try:
+            with misc.raised_privileges():
+                os.makedirs(os.path.dirname(self._index_filename),
+                            exist_ok=True)
+                with open(self._index_filename + ".new", "wb") as new:
+                    new.write(header)
+                    new.write(data)
+                os.rename(self._index_filename + ".new",
+                          self._index_filename)
+            self._data = None
+            self._base = len(header)
+        except OSError as e:
+            print("Could not save keyboard names index:", e,
+                  file=sys.stderr)
+            self._data = data
+            self._base = 0
+
+    def _read(self, offset, length):
+        if self._data is not None:
+            return self._data[offset:offset + length]
+        with open(self._index_filename, "rb") as index_file:
+            index_file.seek(self._base + offset)
+            return index_file.read(length)
+
+    def _tables(self, lang):
+        tables = self._cache.get(lang)
+        if tables is not None:
+            self._cache.move_to_end(lang)
+            return tables
+
+        self._load_index()
+        tables = _Tables()
+        if lang in self._index:
+            offset, length = self._index[lang]
+            chunk = self._read(offset, length).decode("UTF-8")
+            self._load_file(lang, io.StringIO(chunk), tables)
+        self.loads += 1
+        self._cache[lang] = tables
+        if len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
+        return tables
 
     def has_language(self, lang):
-        self._load(lang)
-        return bool(self._layout_by_id)
+        return bool(self._tables(lang).layout_by_id)
 
     def has_layout(self, lang, name):
-        self._load(lang)
-        return name in self._layout_by_id
+        return name in self._tables(lang).layout_by_id
 
     def layout_human(self, lang, name):
-        self._load(lang)
-        return self._layout_by_id[name]
+        return self._tables(lang).layout_by_id[name]
 
     def layout_id(self, lang, value):
-        self._load(lang)
-        return self._layout_by_human[value]
+        return self._tables(lang).layout_by_human[value]
 
     def has_variants(self, lang, layout):
-        self._load(lang)
-        return layout in self._variant_by_id
+        return layout in self._tables(lang).variant_by_id
 
     def has_variant(self, lang, layout, name):
-        self._load(lang)
-        return (layout in self._variant_by_id and
-                name in self._variant_by_id[layout])
+        variant_by_id = self._tables(lang).variant_by_id
+        return layout in variant_by_id and name in variant_by_id[layout]
 
     def variant_human(self, lang, layout, name):
-        self._load(lang)
-        return self._variant_by_id[layout][name]
+        return self._tables(lang).variant_by_id[layout][name]
 
     def variant_id(self, lang, layout, value):
-        self._load(lang)
-        return self._variant_by_human[layout][value]
+        return self._tables(lang).variant_by_human[layout][value]
 
 
 _keyboard_names = None
@@ -10,7 +10,7 @@ import shutil
 import subprocess
 import syslog
 
-from ubiquity import osextras
+from ubiquity import osextras, osprober, udevdb
 
 
 def utf8(s, errors="strict"):
@@ -157,15 +157,8 @@ def grub_options():
 
     ret = []
     try:
-        oslist = {}
-        subp = subprocess.Popen(
-            ['os-prober'], stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-            universal_newlines=True)
-        result = subp.communicate()[0].splitlines()
-        for res in result:
-            res = res.split(':')
-            res[0] = re.match(r'[/\w\d]+', res[0]).group()
-            oslist[res[0]] = res[1]
+        oslist = {device: fields[1]
+                  for device, fields in osprober.get().results().items()}
         p = PartedServer()
         for disk in p.disks():
             p.select_disk(disk)
@@ -231,20 +224,10 @@ def is_removable(device):
     if device is None:
         return None
     device = os.path.realpath(device)
-    devpath = None
-    is_partition = False
-    removable_bus = False
-    subp = subprocess.Popen(['udevadm', 'info', '-q', 'property',
-                             '-n', device],
-                            stdout=subprocess.PIPE, universal_newlines=True)
-    for line in subp.communicate()[0].splitlines():
-        line = line.strip()
-        if line.startswith('DEVPATH='):
-            devpath = line[8:]
-        elif line == 'DEVTYPE=partition':
-            is_partition = True
-        elif line == 'ID_BUS=usb' or line == 'ID_BUS=ieee1394':
-            removable_bus = True
+    udevadm = udevadm_info(['-n', device])
+    devpath = udevadm.get('DEVPATH')
+    is_partition = udevadm.get('DEVTYPE') == 'partition'
+    removable_bus = udevadm.get('ID_BUS') in ('usb', 'ieee1394')
 
     if devpath is not None:
         if is_partition:
@@ -257,15 +240,9 @@ def is_removable(device):
         except IOError:
             pass
         if is_removable:
-            try:
-                subp = subprocess.Popen(['udevadm', 'info', '-q', 'name',
-                                         '-p', devpath],
-                                        stdout=subprocess.PIPE,
-                                        universal_newlines=True)
-                return ('/dev/%s' %
-                        subp.communicate()[0].splitlines()[0].strip())
-            except Exception:
-                pass
+            name = udevadm_info(['-p', devpath]).get('DEVNAME')
+            if name:
+                return name
 
     return None
 
@@ -286,11 +263,28 @@ def mount_info(path):
 
 
 def udevadm_info(args):
+    """Return the udev properties of the device named by args.
+
+    args is ['-n', device node] or ['-p', device path], as for udevadm
+    info.  These are answered from udevdb's table; anything else, or any
+    device that it doesn't know about, is passed to udevadm.
+    """
+    if len(args) == 2 and args[0] in ('-n', '-p'):
+        table = udevdb.get()
+        if args[0] == '-n':
+            props = table.lookup_name(args[1])
+        else:
+            props = table.lookup_path(args[1])
+        if props is not None:
+            return dict(props)
     fullargs = ['udevadm', 'info', '-q', 'property']
     fullargs.extend(args)
     udevadm = {}
-    subp = subprocess.Popen(
-        fullargs, stdout=subprocess.PIPE, universal_newlines=True)
+    try:
+        subp = subprocess.Popen(
+            fullargs, stdout=subprocess.PIPE, universal_newlines=True)
+    except OSError:
+        return udevadm
     for line in subp.communicate()[0].splitlines():
         line = line.strip()
         if '=' not in line:
@@ -393,11 +387,6 @@ def grub_default(boot=None):
     return target
 
 
-_os_prober_oslist = {}
-_os_prober_osvers = {}
-_os_prober_called = False
-
-
 def find_in_os_prober(device, with_version=False):
     """Look for the device name in the output of os-prober.
 
@@ -428,32 +417,20 @@ def find_in_os_prober(device, with_version=False):
     return ''
 
 
-@raise_privileges
 def os_prober():
-    global _os_prober_oslist
-    global _os_prober_osvers
-    global _os_prober_called
-
-    if not _os_prober_called:
-        _os_prober_called = True
-        subp = subprocess.Popen(
-            ['os-prober'], stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-            universal_newlines=True)
-        result = subp.communicate()[0].splitlines()
-        for res in result:
-            res = res.split(':')
-            # launchpad bug #1265192, fix os-prober Windows EFI path
-            res[0] = re.match(r'[/\w\d]+', res[0]).group()
-            if res[2] == 'Ubuntu':
-                version = [v for v in re.findall('[0-9.]*', res[1]) if v][0]
-                # Get rid of the superfluous (development version) (11.04)
-                text = re.sub(r'\s*\(.*\).*', '', res[1])
-                _os_prober_oslist[res[0]] = text
-                _os_prober_osvers[res[0]] = version
-            else:
-                # Get rid of the bootloader indication. It's not relevant here.
-                _os_prober_oslist[res[0]] = res[1].replace(' (loader)', '')
-    return _os_prober_oslist, _os_prober_osvers
+    """Return the operating systems os-prober found, and their versions."""
+    oslist = {}
+    osvers = {}
+    for device, fields in osprober.get().results().items():
+        if fields[2] == 'Ubuntu':
+            version = [v for v in re.findall('[0-9.]*', fields[1]) if v][0]
+            # Get rid of the superfluous (development version) (11.04)
+            oslist[device] = re.sub(r'\s*\(.*\).*', '', fields[1])
+            osvers[device] = version
+        else:
+            # Get rid of the bootloader indication. It's not relevant here.
+            oslist[device] = fields[1].replace(' (loader)', '')
+    return oslist, osvers
 
 
 @raise_privileges
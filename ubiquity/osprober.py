@@ -0,0 +1,195 @@
+# -*- coding: utf-8; Mode: Python; indent-tabs-mode: nil; tab-width: 4 -*-
+
+# Copyright (C) 2020 Canonical Ltd.
+#
+# Run os-prober in the background and remember what it found on each
+# device.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+# os-prober takes several seconds on a machine with a few operating systems
+# installed, as it mounts each partition in turn, and it has no way to ask
+# about a single device.  We therefore start it once in a background thread
+# as soon as the installer launches, and answer every later question from
+# its output.  Each device's result is tagged with the device's filesystem
+# UUID and size; when partman commits changes, devices whose tag changed
+# lose their result.  If one of them had an operating system on it (for
+# instance because it was resized), os-prober is run again, but only when
+# somebody next asks for its results, so that it doesn't hold up the
+# installer or compete with the files being copied.
+
+import os
+import re
+import subprocess
+import syslog
+import threading
+import time
+
+
+SYS_BLOCK = '/sys/class/block'
+BY_UUID = '/dev/disk/by-uuid'
+
+
+def device_signatures():
+    """Return {device: (uuid, size)} for every block device."""
+    uuids = {}
+    try:
+        for uuid in os.listdir(BY_UUID):
+            target = os.path.realpath(os.path.join(BY_UUID, uuid))
+            uuids[target] = uuid
+    except OSError:
+        pass
+    signatures = {}
+    try:
+        names = os.listdir(SYS_BLOCK)
+    except OSError:
+        names = []
+    for name in names:
+        try:
+            with open(os.path.join(SYS_BLOCK, name, 'size')) as size_file:
+                size = size_file.read().strip()
+        except OSError:
+            size = None
+        device = '/dev/%s' % name.replace('!', '/')
+        signatures[device] = (uuids.get(device), size)
+    return signatures
+
+
+def _signature(signatures, device):
+    # os-prober names device-mapper devices by their /dev/mapper links.
+    return signatures.get(os.path.realpath(device))
+
+
+def parse(output):
+    """Return {device: fields} for os-prober's output."""
+    found = {}
+    for line in output.splitlines():
+        fields = line.split(':')
+        # launchpad bug #1265192, fix os-prober Windows EFI path
+        match = re.match(r'[/\w\d]+', fields[0])
+        if len(fields) < 3 or match is None:
+            continue
+        fields[0] = match.group()
+        found[fields[0]] = fields
+    return found
+
+
+def _raise_privileges():
+    # Privileges are process-wide, so the probing thread can't borrow them
+    # with misc.raised_privileges while the main thread may be dropping
+    # them; raise them in the child instead.
+    try:
+        os.setresuid(0, 0, 0)
+        os.setresgid(0, 0, 0)
+        os.setgroups([])
+    except OSError:
+        pass
+
+
+class OSProber:
+    """os-prober's results, gathered in the background."""
+
+    def __init__(self, command=('os-prober',)):
+        self.command = list(command)
+        self.lock = threading.Lock()
+        self.thread = None
+        self.found = None
+        self.signatures = {}
+        self.stale = False
+        self.probes = 0
+
+    def probe(self):
+        start = time.time()
+        signatures = device_signatures()
+        found = {}
+        try:
+            subp = subprocess.Popen(
+                self.command, stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE, universal_newlines=True,
+                preexec_fn=_raise_privileges)
+            found = parse(subp.communicate()[0])
+        except OSError as e:
+            syslog.syslog(syslog.LOG_ERR, 'Failed to run os-prober: %s' % e)
+        finally:
+            with self.lock:
+                self.found = found
+                self.signatures = signatures
+                self.probes += 1
+                self.thread = None
+        syslog.syslog('os-prober found %d operating systems in %.3fs' %
+                      (len(found), time.time() - start))
+
+    def start(self):
+        """Start probing in the background unless we already know."""
+        with self.lock:
+            if self.found is not None or self.thread is not None:
+                return
+            self.thread = threading.Thread(
+                target=self.probe, name='os-prober', daemon=True)
+            self.thread.start()
+
+    def results(self):
+        """Return {device: fields}, waiting for os-prober if need be."""
+        self.start()
+        with self.lock:
+            thread = self.thread
+        if thread is not None:
+            thread.join()
+        with self.lock:
+            stale = self.stale
+            if stale:
+                self.stale = False
+                self.found = None
+        if stale:
+            return self.results()
+        return self.found
+
+    def invalidate(self):
+        """Forget results for devices that partman has changed.
+
+        This never waits for os-prober; if it needs to be run again, the
+        next call to results() does so.
+        """
+        signatures = device_signatures()
+        with self.lock:
+            if self.found is None:
+                # os-prober is still running and may have seen the disks
+                # before partman changed them.
+                if self.thread is not None:
+                    self.stale = True
+                return
+            changed = [device for device in self.found
+                       if _signature(signatures, device) !=
+                       _signature(self.signatures, device)]
+            if changed:
+                syslog.syslog('os-prober results out of date for %s' %
+                              ' '.join(sorted(changed)))
+                self.found = {device: fields
+                              for device, fields in self.found.items()
+                              if device not in changed}
+                self.stale = True
+            else:
+                self.signatures = signatures
+
+
+_prober = None
+
+
+def get():
+    """Return the OSProber shared by the whole installer."""
+    global _prober
+    if _prober is None:
+        _prober = OSProber()
+    return _prober
@@ -22,9 +22,13 @@
 
 from __future__ import print_function
 
+import atexit
+import collections
+import contextlib
 import fcntl
 import os
 import shutil
+import time
 
 
 devices = '/var/lib/partman/devices'
@@ -34,6 +38,77 @@ stopfifo = '/var/lib/partman/stopfifo'
 logfile = '/var/log/partman'
 
 
+class LogBuffer(object):
+    """Collect lines for the partman log and write them out in batches.
+
+    Lines are written when a dialog closes, when parted_server reports an
+    error and at exit, through a file that stays open.  In ring mode
+    (ring > 0), only the last ring lines are kept, and they are written
+    only when something goes wrong.  calls, flushes and elapsed (seconds
+    spent writing) show what logging costs.
+    """
+
+    def __init__(self, ring=0):
+        self.ring = ring
+        self.lines = collections.deque(maxlen=ring or None)
+        self.file = None
+        self.path = None
+        self.calls = 0
+        self.flushes = 0
+        self.elapsed = 0.0
+
+    def write(self, line):
+        self.calls += 1
+        self.lines.append(line)
+
+    def write_out(self, lines):
+        start = time.time()
+        try:
+            if self.file is None or self.path != logfile:
+                if self.file is not None:
+                    self.file.close()
+                self.path = logfile
+                self.file = open(logfile, 'a')
+            self.file.write(''.join('%s\n' % line for line in lines))
+            self.file.flush()
+        except (IOError, OSError):
+            pass
+        self.flushes += 1
+        self.elapsed += time.time() - start
+
+    def flush(self):
+        if self.ring or not self.lines:
+            return
+        self.write_out(self.lines)
+        self.lines.clear()
+
+    def dump(self):
+        """Write out whatever we have, even in ring mode."""
+        if not self.lines:
+            return
+        lines = list(self.lines)
+        if self.ring:
+            lines.insert(0, 'ubiquity: last %d log lines before failure:' %
+                         len(lines))
+        self.write_out(lines)
+        self.lines.clear()
+
+    def set_ring(self, ring):
+        self.flush()
+        self.ring = ring
+        self.lines = collections.deque(self.lines, maxlen=ring or None)
+
+
+# Set UBIQUITY_PARTMAN_LOG_RING to a number of lines to only log the lines
+# leading up to a failure.
+try:
+    log_buffer = LogBuffer(
+        int(os.environ.get('UBIQUITY_PARTMAN_LOG_RING', '0')))
+except ValueError:
+    log_buffer = LogBuffer()
+atexit.register(log_buffer.flush)
+
+
 class PartedServerError(Exception):
     """Raised when parted_server throws an exception.
 
@@ -56,14 +131,16 @@ class PartedServer(object):
         self.inf = None
         self.outf = None
         self.current_disk = None
+        # (disk, command, args) => reply, while a session is open.
+        self.replies = None
+        self.dialogs = 0
 
     def __del__(self):
         if self.inf is not None or self.outf is not None:
             self.close_dialog()
 
     def log(self, *args):
-        with open(logfile, 'a') as f:
-            print('ubiquity:', ' '.join(args), file=f)
+        log_buffer.write('ubiquity: %s' % ' '.join(args))
 
     def write_line(self, *args):
         self.log('IN:', *args)
@@ -126,6 +203,7 @@ class PartedServer(object):
                 if exception_type in ('Information', 'Warning'):
                     pass
                 else:
+                    log_buffer.dump()
                     raise PartedServerError(exception_type, message, options)
 
     def sync_server(self):
@@ -133,6 +211,7 @@ class PartedServer(object):
             pass
 
     def open_dialog(self, command, *args):
+        self.dialogs += 1
         self.inf = open(infifo, 'w')
         fcntl.fcntl(self.inf.fileno(), fcntl.F_SETFD, fcntl.FD_CLOEXEC)
         self.write_line(command, self.current_disk, *args)
@@ -155,6 +234,42 @@ class PartedServer(object):
         self.sync_server()
         self.outf = None
         self.inf = None
+        log_buffer.flush()
+
+    # parted_server handles exactly one command per dialog, and every
+    # dialog costs three rendezvous on stopfifo, so we avoid asking the same
+    # thing twice.  Inside a session, replies to the queries below are
+    # remembered for each disk, and partition_info is answered from the
+    # disk's PARTITIONS reply.  Only use a session while nothing else can
+    # change the partition tables (e.g. while partman waits for a debconf
+    # reply).
+    @contextlib.contextmanager
+    def session(self):
+        if self.replies is not None:
+            yield self
+            return
+        self.replies = {}
+        try:
+            yield self
+        except Exception:
+            log_buffer.dump()
+            raise
+        finally:
+            self.replies = None
+
+    def query(self, reader, command, *args):
+        """Run command in its own dialog and return reader()'s result."""
+        key = (self.current_disk, command, args)
+        if self.replies is not None and key in self.replies:
+            return self.replies[key]
+        self.open_dialog(command, *args)
+        try:
+            reply = reader()
+        finally:
+            self.close_dialog()
+        if self.replies is not None:
+            self.replies[key] = reply
+        return reply
 
     # Get all disk identifiers (subdirectories of /var/lib/partman/devices).
     def disks(self):
@@ -201,22 +316,26 @@ class PartedServer(object):
         if not os.path.isdir(entry):
             os.mkdir(entry)
 
-    def partitions(self):
+    def read_partitions(self):
         partitions = []
-        self.open_dialog('PARTITIONS')
-        try:
-            while True:
-                (p_num, p_id, p_size, p_type,
-                 p_fs, p_path, p_name) = self.read_line(7)
-                if p_id == '':
-                    break
-                partitions.append((p_num, p_id, p_size, p_type,
-                                   p_fs, p_path, p_name))
-        finally:
-            self.close_dialog()
+        while True:
+            (p_num, p_id, p_size, p_type,
+             p_fs, p_path, p_name) = self.read_line(7)
+            if p_id == '':
+                break
+            partitions.append((p_num, p_id, p_size, p_type,
+                               p_fs, p_path, p_name))
         return partitions
 
+    def partitions(self):
+        return list(self.query(self.read_partitions, 'PARTITIONS'))
+
     def partition_info(self, partition):
+        if self.replies is not None:
+            for info in self.query(self.read_partitions, 'PARTITIONS'):
+                if info[1] == partition:
+                    return info
+            return ()
         self.open_dialog('PARTITION_INFO', partition)
         try:
             (p_num, p_id, p_size, p_type,
@@ -226,3 +345,13 @@ class PartedServer(object):
         if p_id == '':
             return ()
         return (p_num, p_id, p_size, p_type, p_fs, p_path, p_name)
+
+    def label_type(self):
+        return self.query(lambda: self.read_line()[0], 'GET_LABEL_TYPE')
+
+    def max_primary(self):
+        try:
+            return int(self.query(
+                lambda: self.read_line()[0], 'GET_MAX_PRIMARY'))
+        except ValueError:
+            return None
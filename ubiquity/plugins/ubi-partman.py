@@ -22,10 +22,11 @@ import os
 import re
 import shutil
 import signal
+import time
 
 import debconf
 
-from ubiquity import (misc, osextras, parted_server, plugin,
+from ubiquity import (misc, osextras, osprober, parted_server, plugin,
                       telemetry, validation)
 from ubiquity.install_misc import archdetect
 
@@ -1651,6 +1652,64 @@ class PartmanOptionError(LookupError):
     pass
 
 
+class PartitionSnapshot:
+    """What partman told us about each partition when we last cached it.
+
+    Walking a partition through choose_partition and active_partition to
+    fill in its partition_cache entry costs several debconf round trips, so
+    when partman asks us to rebuild the cache we only walk the partitions
+    whose state has changed since we last did so.  How far a partition can
+    be resized depends on the free space around it, so a partition's state
+    includes that of everything else on its disk.
+    """
+
+    def __init__(self):
+        self.states = {}
+        self.pending = {}
+
+    @staticmethod
+    def state(devpart, option, info, label):
+        """Return a comparable summary of devpart's state in partman."""
+        files = []
+        try:
+            names = sorted(os.listdir(devpart))
+        except OSError:
+            names = []
+        for name in names:
+            try:
+                with open(os.path.join(devpart, name), 'rb') as f:
+                    files.append((name, f.read()))
+            except OSError:
+                files.append((name, None))
+        return (option, tuple(info or ()), label, tuple(files))
+
+    @staticmethod
+    def with_disk(states, disk_of):
+        """Add the states of the rest of its disk to each partition's."""
+        disks = {}
+        for devpart, state in states.items():
+            disks.setdefault(disk_of(devpart), []).append((devpart, state))
+        return {devpart: (state, tuple(disks[disk_of(devpart)]))
+                for devpart, state in states.items()}
+
+    def unchanged(self, devpart, state):
+        return devpart in self.states and self.states[devpart] == state
+
+    def record(self, states):
+        """Remember states once the partitions have been walked."""
+        self.pending = states
+
+    def commit(self):
+        self.states.update(self.pending)
+        self.pending = {}
+
+    def prune(self, devparts):
+        """Forget partitions that partman no longer lists."""
+        self.states = {devpart: state
+                       for devpart, state in self.states.items()
+                       if devpart in devparts}
+
+
 class Page(plugin.Plugin):
     def prepare(self):
         self.some_device_desc = ''
@@ -1685,6 +1744,8 @@ class Page(plugin.Plugin):
         self.disk_cache = {}
         self.partition_cache = {}
         self.cache_order = []
+        self.snapshot = PartitionSnapshot()
+        self.cache_start = None
         self.creating_label = None
         self.creating_partition = None
         self.editing_partition = None
@@ -1818,6 +1879,21 @@ class Page(plugin.Plugin):
         else:
             return None
 
+    def changed_partitions(self, states, candidates):
+        """Return {devpart: snapshot} for the candidates we must walk again.
+
+        states maps every partition partman lists to its
+        PartitionSnapshot.state; the other candidates keep their cache
+        entries.
+        """
+        snapshots = self.snapshot.with_disk(
+            states, lambda devpart: self.split_devpart(devpart)[0])
+        return {devpart: snapshot
+                for devpart, snapshot in snapshots.items()
+                if devpart in candidates and not (
+                    self.snapshot.unchanged(devpart, snapshot) and
+                    'parted' in self.partition_cache.get(devpart, {}))}
+
     def subdirectories(self, directory):
         for name in sorted(os.listdir(directory)):
             if os.path.isdir(os.path.join(directory, name)):
@@ -2390,23 +2466,17 @@ class Page(plugin.Plugin):
             partition_table_full = True
             ntfs_partitions = []
 
-            with misc.raised_privileges():
+            parted = parted_server.PartedServer()
+            with misc.raised_privileges(), parted.session():
                 # {'/dev/sda' : ('/dev/sda1', 24973242, '32256-2352430079'),
                 # ...
-                parted = parted_server.PartedServer()
                 layout = {}
                 for disk in parted.disks():
                     parted.select_disk(disk)
                     if try_for_wubi and partition_table_full:
                         primary_count = 0
                         ntfs_count = 0
-                        parted.open_dialog('GET_MAX_PRIMARY')
-                        try:
-                            max_primary = int(parted.read_line()[0])
-                        except ValueError:
-                            max_primary = None
-                        finally:
-                            parted.close_dialog()
+                        max_primary = parted.max_primary()
 
                     ret = []
                     for partition in parted.partitions():
@@ -2589,7 +2659,10 @@ class Page(plugin.Plugin):
                         return True
                     else:
                         # Finished building the cache.
-                        self.debug('Partman: Finished building cache')
+                        self.snapshot.commit()
+                        self.debug('Partman: Finished building cache '
+                                   '(%.3fs)',
+                                   time.time() - self.cache_start)
                         self.thaw_choices('choose_partition')
                         self.__state.pop()
                         self.update_partitions = None
@@ -2603,26 +2676,51 @@ class Page(plugin.Plugin):
                             self.cache_order)
                 else:
                     self.debug('Partman: Building cache')
+                    self.cache_start = time.time()
                     misc.regain_privileges()
                     parted = parted_server.PartedServer()
                     matches = self.find_script(menu_options, 'partition_tree')
 
                     # If we're only updating our cache for certain
                     # partitions, then self.update_partitions will be a list
-                    # of the partitions to update; otherwise, we build the
-                    # cache from scratch.
+                    # of the partitions to update; otherwise, we look at all
+                    # of them.  Either way, partitions whose state in partman,
+                    # and that of the rest of their disk, hasn't changed since
+                    # we last cached them keep their cache entries.
                     rebuild_all = self.update_partitions is None
+                    if rebuild_all:
+                        candidates = set(arg for _, arg, _ in matches)
+                    else:
+                        candidates = set(self.update_partitions)
+                    states = {}
+                    with parted.session():
+                        for script, arg, option in matches:
+                            dev, part_id = self.split_devpart(arg)
+                            if not dev or not part_id:
+                                continue
+                            parted.select_disk(dev)
+                            states[arg] = self.snapshot.state(
+                                arg, option, parted.partition_info(part_id),
+                                parted.label_type())
+                    changed = self.changed_partitions(states, candidates)
+                    unchanged = set(
+                        devpart for devpart in states
+                        if devpart in candidates and devpart not in changed)
 
                     if rebuild_all:
                         self.disk_cache = {}
-                        self.partition_cache = {}
+                        self.partition_cache = {
+                            devpart: self.partition_cache[devpart]
+                            for devpart in unchanged}
+                        self.snapshot.prune(states)
                     self.cache_order = []
 
                     # Clear out the partitions we're updating to make sure
                     # stale keys are removed.
-                    if self.update_partitions is not None:
-                        for devpart in self.update_partitions:
-                            if devpart in self.partition_cache:
+                    if not rebuild_all:
+                        for devpart in candidates:
+                            if (devpart in self.partition_cache and
+                                    devpart not in unchanged):
                                 del self.partition_cache[devpart]
                             # We don't get a separate notification when a
                             # disk label is changed, only a notification
@@ -2642,33 +2740,24 @@ class Page(plugin.Plugin):
                         parted.select_disk(dev)
                         self.cache_order.append(arg)
                         if part_id:
-                            if rebuild_all or arg not in self.partition_cache:
+                            if arg not in self.partition_cache:
                                 self.partition_cache[arg] = {
                                     'dev': dev,
                                     'id': part_id,
                                     'parent': dev.replace('=', '/')
                                 }
                         else:
-                            if rebuild_all or arg not in self.disk_cache:
+                            if arg not in self.disk_cache:
                                 device = parted.readline_device_entry('device')
-                                parted.open_dialog('GET_LABEL_TYPE')
-                                try:
-                                    label = parted.read_line()[0]
-                                finally:
-                                    parted.close_dialog()
                                 self.disk_cache[arg] = {
                                     'dev': dev,
                                     'device': device,
-                                    'label': label
+                                    'label': parted.label_type()
                                 }
 
-                    if self.update_partitions is None:
-                        self.update_partitions = list(
-                            self.partition_cache.keys())
-                    else:
-                        self.update_partitions = [
-                            devpart for devpart in self.update_partitions
-                            if devpart in self.partition_cache]
+                    self.update_partitions = [
+                        devpart for devpart in self.cache_order
+                        if devpart in changed]
 
                     # Update the display names of all disks and partitions.
                     for script, arg, option in matches:
@@ -2683,22 +2772,12 @@ class Page(plugin.Plugin):
                             self.disk_cache[arg]['display'] = (
                                 '%s__________%s' % (script, arg))
 
-                    # Get basic information from parted_server for each
-                    # partition being updated.
-                    partition_info_cache = {}
+                    # Record the basic information parted_server gave us
+                    # for each partition being updated.
                     for devpart in self.update_partitions:
-                        dev, part_id = self.split_devpart(devpart)
-                        if not dev:
+                        info = states[devpart][1]
+                        if not info:
                             continue
-                        if dev not in partition_info_cache:
-                            parted.select_disk(dev)
-                            partition_info_cache[dev] = {}
-                            for partition in parted.partitions():
-                                partition_info_cache[dev][partition[1]] = \
-                                    partition
-                        if part_id not in partition_info_cache[dev]:
-                            continue
-                        info = partition_info_cache[dev][part_id]
                         self.partition_cache[devpart]['parted'] = {
                             'num': info[0],
                             'id': info[1],
@@ -2708,6 +2787,11 @@ class Page(plugin.Plugin):
                             'path': info[5],
                             'name': info[6]
                         }
+                    self.snapshot.record(changed)
+                    self.debug('Partman: %d of %d partitions changed '
+                               '(%.3fs)', len(self.update_partitions),
+                               len(unchanged) + len(changed),
+                               time.time() - self.cache_start)
 
                     misc.drop_privileges()
                     # We want to immediately show the UI.
@@ -2735,8 +2819,10 @@ class Page(plugin.Plugin):
                         self.freeze_choices('choose_partition')
                         return True
                     else:
+                        self.snapshot.commit()
                         self.debug('Partman: Finished building cache '
-                                   '(no partitions to update)')
+                                   '(no partitions to update, %.3fs)',
+                                   time.time() - self.cache_start)
                         self.thaw_choices('choose_partition')
                         self.update_partitions = None
                         self.building_cache = False
@@ -3363,6 +3449,11 @@ class Page(plugin.Plugin):
         return (self.is_automatic and
                 self.db.fget('grub-installer/bootdev', 'seen') == 'true')
 
+    def cleanup(self):
+        plugin.Plugin.cleanup(self)
+        # partman may have committed changes to disk.
+        osprober.get().invalidate()
+
     # TODO cjwatson 2006-11-01: Do we still need this?
     def rebuild_cache(self):
         assert self.current_question == 'partman/choose_partition'
@@ -0,0 +1,262 @@
+# -*- coding: utf-8; Mode: Python; indent-tabs-mode: nil; tab-width: 4 -*-
+
+# Copyright (C) 2020 Canonical Ltd.
+#
+# Work out which packages on the live filesystem need not be copied to the
+# target, and cache the answer so that we only ask apt once per image.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+# The removal set depends only on the image (its manifests and dpkg
+# database) and on a handful of answers (see Install.blacklist_inputs), so
+# cache entries are keyed by a hash of exactly those.  Each entry is a
+# gzip-compressed JSON file holding the removal set and its dpkg -L output.
+# Entries can be shipped on the live medium in a directory next to the
+# manifests (see make-removal-cache), and are also saved in
+# /var/lib/ubiquity so that a repeat install in the same session is quick.
+
+import gzip
+import hashlib
+import json
+import os
+import subprocess
+import syslog
+
+from apt.cache import Cache
+
+from ubiquity import install_misc
+
+
+CACHE_NAME = 'filesystem.removal-cache'
+RUNTIME_CACHE = '/var/lib/ubiquity/removal-cache'
+
+# Bump this if the way we compute the removal set changes.
+_VERSION = 2
+
+DPKG_STATUS = '/var/lib/dpkg/status'
+APT_LISTS = '/var/lib/apt/lists'
+
+
+def read_packages(path):
+    """Read the package names from a filesystem.manifest* file."""
+    packages = set()
+    with open(path) as manifest_file:
+        for line in manifest_file:
+            if line.strip() != '' and not line.startswith('#'):
+                pkg = line.split(':')[0]
+                packages.add(pkg.split()[0])
+    return packages
+
+
+def _manifest_paths(casper_path):
+    return [
+        os.path.join(casper_path, name)
+        for name in ('filesystem.manifest', 'filesystem.manifest-remove',
+                     'filesystem.manifest-desktop',
+                     os.path.basename(
+                         install_misc.minimal_install_rlist_path))]
+
+
+def _hash_file(digest, path):
+    try:
+        with open(path, 'rb') as f:
+            while True:
+                buf = f.read(1024 * 1024)
+                if not buf:
+                    break
+                digest.update(buf)
+    except FileNotFoundError:
+        digest.update(b'\0missing')
+
+
+def cache_key(casper_path, inputs):
+    """Return the cache key for these inputs on this image."""
+    digest = hashlib.sha256()
+    digest.update(json.dumps([_VERSION, inputs], sort_keys=True).encode())
+    for path in _manifest_paths(casper_path) + [DPKG_STATUS]:
+        # Only the name, so that build-time entries match at install time.
+        digest.update(b'\0' + os.path.basename(path).encode() + b'\0')
+        _hash_file(digest, path)
+    if not inputs['restricted']:
+        # We look at candidate sections, which come from the apt lists.
+        try:
+            for name in sorted(os.listdir(APT_LISTS)):
+                st = os.stat(os.path.join(APT_LISTS, name))
+                digest.update(('\0%s %d %d' % (
+                    name, st.st_size, st.st_mtime)).encode())
+        except OSError:
+            pass
+    return digest.hexdigest()
+
+
+def compute_removals(casper_path, inputs):
+    """Ask apt which packages can be left off the target.
+
+    This is the slow part of generating the file copy blacklist.  inputs is
+    a dictionary as returned by Install.blacklist_inputs.
+    """
+    cache = Cache()
+    difference = removal_candidates(casper_path, inputs, cache)
+    with cache.actiongroup():
+        confirmed_remove = plan_removals(cache, difference)
+    del cache
+    return sorted(confirmed_remove)
+
+
+def removal_candidates(casper_path, inputs, cache):
+    """Return the packages we would like to leave off the target."""
+    manifest, manifest_remove, manifest_desktop, minimal_remove = (
+        _manifest_paths(casper_path))
+    if os.path.exists(manifest_remove) and os.path.exists(manifest):
+        difference = read_packages(manifest_remove)
+    elif os.path.exists(manifest_desktop) and os.path.exists(manifest):
+        difference = read_packages(manifest) - read_packages(manifest_desktop)
+    else:
+        difference = set()
+
+    # Add minimal installation package list if selected
+    if inputs['minimal_install']:
+        if os.path.exists(minimal_remove):
+            with open(minimal_remove) as m_file:
+                difference |= {line.strip().split(':')[0] for line in m_file}
+
+    if not inputs['restricted']:
+        for pkg in cache.keys():
+            if (cache[pkg].is_installed and
+                    cache[pkg].candidate.section.startswith('restricted/')):
+                difference.add(pkg)
+
+    # Keep packages we explicitly installed.
+    keep = set(inputs['keep'])
+    arch = inputs['arch']
+    subarch = inputs['subarch']
+
+    # Less than ideal.  Since we cannot know which bootloader we'll need
+    # at file copy time, we should figure out why grub still fails when
+    # apt-install-direct is present during configure_bootloader (code
+    # removed).
+    if arch in ('amd64', 'arm64', 'i386'):
+        # We now want grub-pc to be left installed for both EFI and legacy
+        # since it makes sure that the right maintainer scripts are run.
+        keep.add('grub-pc')
+        if subarch == 'efi':
+            keep.add('grub-efi')
+            keep.add('grub-efi-amd64')
+            keep.add('grub-efi-arm64')
+            keep.add('grub-efi-amd64-signed')
+            keep.add('grub-efi-arm64-signed')
+            keep.add('flash-kernel')
+            keep.add('aarch64-laptops-support')
+            keep.add('shim-signed')
+            keep.add('mokutil')
+            keep.add('linux-signed-generic%s' % inputs['altmeta'])
+        else:
+            keep.add('grub')
+
+    # Even adding ubiquity as a depends to oem-config-{gtk,kde} doesn't
+    # appear to force ubiquity and libdebian-installer4 to copy all of
+    # their files, so this does the trick.
+    if inputs['oem_config']:
+        keep.add('ubiquity')
+
+    difference -= install_misc.expand_dependencies_simple(
+        cache, keep, difference)
+
+    # Consider only packages that don't have a prerm, and which can
+    # therefore have their files removed without any preliminary work.
+    difference = {
+        x for x in difference
+        if not os.path.exists('/var/lib/dpkg/info/%s.prerm' % x)}
+    return difference
+
+
+def plan_removals(cache, difference):
+    """Return the packages in difference that can be removed together.
+
+    A package only counts if everything its removal breaks is also in
+    difference.  The result is left marked for removal in cache.
+    """
+    planner = install_misc.RemovalPlanner(cache)
+    confirmed_remove = set()
+    for pkg in sorted(difference):
+        if pkg in confirmed_remove:
+            continue
+        would_remove = planner.closure([pkg])
+        if would_remove <= difference:
+            planner.remove(would_remove)
+            confirmed_remove |= would_remove
+    if not planner.confirm(confirmed_remove):
+        syslog.syslog('apt disagreed with planned removals; asking it '
+                      'about each package')
+        confirmed_remove = plan_removals_apt(cache, difference)
+    return confirmed_remove
+
+
+def plan_removals_apt(cache, difference):
+    """Like plan_removals, but asking apt about each package in turn."""
+    confirmed_remove = set()
+    for pkg in sorted(difference):
+        if pkg in confirmed_remove:
+            continue
+        would_remove = install_misc.get_remove_list_apt(
+            cache, [pkg], recursive=True)
+        if would_remove <= difference:
+            confirmed_remove |= would_remove
+            # Leave these marked for removal in the apt cache to
+            # speed up further calculations.
+        else:
+            for removedpkg in would_remove:
+                cachedpkg = install_misc.get_cache_pkg(cache, removedpkg)
+                cachedpkg.mark_keep()
+    return confirmed_remove
+
+
+def list_files(packages):
+    """Return the dpkg -L output for packages, one line per item."""
+    if not packages:
+        return []
+    cmd = ['dpkg', '-L']
+    cmd.extend(packages)
+    subp = subprocess.Popen(
+        cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        universal_newlines=True)
+    return subp.communicate()[0].splitlines()
+
+
+def lookup(cache_dirs, key):
+    """Return (removals, files) cached under key, or None."""
+    for cache_dir in cache_dirs:
+        path = os.path.join(cache_dir, '%s.json.gz' % key)
+        if not os.path.exists(path):
+            continue
+        try:
+            with gzip.open(path, 'rt') as entry_file:
+                entry = json.load(entry_file)
+            return entry['removals'], entry['files']
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            syslog.syslog(syslog.LOG_WARNING,
+                          'Ignoring unreadable removal cache entry %s: %s' %
+                          (path, e))
+    return None
+
+
+def store(cache_dir, key, removals, files):
+    """Cache (removals, files) under key in cache_dir, returning the path."""
+    path = os.path.join(cache_dir, '%s.json.gz' % key)
+    os.makedirs(cache_dir, exist_ok=True)
+    with gzip.open(path + '.new', 'wt') as entry_file:
+        json.dump({'removals': removals, 'files': files}, entry_file)
+    os.rename(path + '.new', path)
+    return path
@@ -19,23 +19,250 @@
 
 from __future__ import print_function
 
+import bisect
+import calendar
 import datetime
 import hashlib
+import json
 import os
+import re
+import struct
 import sys
 import time
 import xml.dom.minidom
 
+from ubiquity import misc
 
+
+ZONEINFO_DIR = '/usr/share/zoneinfo'
 TZ_DATA_FILE = '/usr/share/zoneinfo/zone.tab'
 ISO_3166_FILE = '/usr/share/xml/iso-codes/iso_3166.xml'
 
+# Working out each zone's hash and current offsets means reading its
+# zoneinfo file and calling tzset several times, for every entry in
+# zone.tab.  make-zoneinfo-index keeps the results in an index, together
+# with the offsets each zone will have over the next year or so and the
+# aliases of each zone; the package runs it when it is installed and
+# whenever tzdata changes.  Building the index takes far longer than doing
+# without it, so the installer never builds it itself: if it is missing or
+# out of date, each zone is looked up separately as before.
+INDEX_FILE = '/var/lib/ubiquity/zoneinfo-index.json'
+_INDEX_VERSION = 1
+_INDEX_SPAN = 370 * 24 * 60 * 60
+
 
 def _seconds_since_epoch(dt):
     # TODO cjwatson 2006-02-23: %s escape is not portable
     return int(dt.replace(tzinfo=None).strftime('%s'))
 
 
+# Setting TZ and calling tzset is slow, changes the whole process, and
+# races with any other thread doing the same, so SystemTzInfo reads the
+# zone's TZif file (see tzfile(5)) itself and works out what the C
+# library would have said.  Anything it can't read falls back to tzset.
+
+_EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+# As in Python's time module, which takes the standard and daylight
+# offsets from the middle of January and July of roughly this year.
+_YEAR = (365 * 24 + 6) * 3600
+
+_TZ_NAME = r'(?:<[^>]*>|[A-Za-z]{3,})'
+_TZ_TIME = r'[+-]?\d{1,3}(?::\d{1,2}){0,2}'
+_TZ_DATE = r'(?:J\d{1,3}|\d{1,3}|M\d{1,2}\.\d\.\d)'
+_TZ_STRING = re.compile(
+    r'(?P<std>%(name)s)(?P<stdoff>%(time)s)'
+    r'(?:(?P<dst>%(name)s)(?P<dstoff>%(time)s)?'
+    r'(?:,(?P<start>%(date)s)(?:/(?P<starttime>%(time)s))?'
+    r',(?P<end>%(date)s)(?:/(?P<endtime>%(time)s))?)?)?$' %
+    {'name': _TZ_NAME, 'time': _TZ_TIME, 'date': _TZ_DATE})
+
+
+def _tz_seconds(text):
+    sign = -1 if text.startswith('-') else 1
+    fields = [int(field) for field in text.lstrip('+-').split(':')]
+    fields += [0] * (3 - len(fields))
+    return sign * (fields[0] * 3600 + fields[1] * 60 + fields[2])
+
+
+def _tz_rule(date, when):
+    if date.startswith('J'):
+        rule = ('J', int(date[1:]))
+    elif date.startswith('M'):
+        rule = ('M',) + tuple(int(field) for field in date[1:].split('.'))
+    else:
+        rule = ('n', int(date))
+    return rule, 7200 if when is None else _tz_seconds(when)
+
+
+def _rule_day(rule, year):
+    """Return the day (since the epoch) on which a TZ string rule falls."""
+    jan1 = datetime.date(year, 1, 1).toordinal() - _EPOCH_ORDINAL
+    if rule[0] == 'J':
+        # 1-365, never counting 29 February.
+        if calendar.isleap(year) and rule[1] >= 60:
+            return jan1 + rule[1]
+        return jan1 + rule[1] - 1
+    elif rule[0] == 'n':
+        return jan1 + rule[1]
+    _, month, week, weekday = rule
+    first = datetime.date(year, month, 1)
+    day = 1 + (weekday - (first.weekday() + 1)) % 7 + 7 * (week - 1)
+    while day > calendar.monthrange(year, month)[1]:
+        day -= 7
+    return first.toordinal() - _EPOCH_ORDINAL + day - 1
+
+
+class _PosixRule(object):
+    """The POSIX TZ string that covers times after a zone's transitions."""
+
+    def __init__(self, text):
+        match = _TZ_STRING.match(text)
+        if match is None:
+            raise ValueError('unsupported TZ string %r' % text)
+        self.std = (-_tz_seconds(match.group('stdoff')), False,
+                    match.group('std').strip('<>'))
+        self.dst = None
+        if match.group('dst'):
+            if match.group('dstoff'):
+                utoff = -_tz_seconds(match.group('dstoff'))
+            else:
+                utoff = self.std[0] + 3600
+            self.dst = (utoff, True, match.group('dst').strip('<>'))
+            self.start = _tz_rule(match.group('start') or 'M3.2.0',
+                                  match.group('starttime'))
+            self.end = _tz_rule(match.group('end') or 'M11.1.0',
+                                match.group('endtime'))
+
+    def info(self, when):
+        if self.dst is None:
+            return self.std
+        year = datetime.date.fromordinal(
+            _EPOCH_ORDINAL + (when + self.std[0]) // 86400).year
+        # The change to DST is given in standard time and the change back
+        # in DST.
+        start = (_rule_day(self.start[0], year) * 86400 + self.start[1] -
+                 self.std[0])
+        end = _rule_day(self.end[0], year) * 86400 + self.end[1] - self.dst[0]
+        if start < end:
+            in_dst = start <= when < end
+        else:
+            in_dst = not end <= when < start
+        return self.dst if in_dst else self.std
+
+
+class _TzFile(object):
+    """The local time types in a TZif file, by when they take effect.
+
+    Each type is a (UTC offset in seconds, is DST, abbreviation) tuple.
+    """
+
+    def __init__(self, data):
+        if data[:4] != b'TZif':
+            raise ValueError('not a TZif file')
+        version = data[4:5]
+        counts = struct.unpack_from('>6l', data, 20)
+        offset = 44
+        time_format = 'l'
+        if version >= b'2':
+            # Skip the version 1 data, which only has 32-bit times.
+            isutcnt, isstdcnt, leapcnt, timecnt, typecnt, charcnt = counts
+            offset += (timecnt * 5 + typecnt * 6 + charcnt + leapcnt * 8 +
+                       isstdcnt + isutcnt)
+            if data[offset:offset + 4] != b'TZif':
+                raise ValueError('bad TZif version 2 header')
+            counts = struct.unpack_from('>6l', data, offset + 20)
+            offset += 44
+            time_format = 'q'
+        isutcnt, isstdcnt, leapcnt, timecnt, typecnt, charcnt = counts
+        time_size = struct.calcsize('>' + time_format)
+
+        self.transitions = list(struct.unpack_from(
+            '>%d%s' % (timecnt, time_format), data, offset))
+        offset += timecnt * time_size
+        indices = data[offset:offset + timecnt]
+        offset += timecnt
+        ttinfos = [struct.unpack_from('>lBB', data, offset + i * 6)
+                   for i in range(typecnt)]
+        offset += typecnt * 6
+        chars = data[offset:offset + charcnt]
+        offset += charcnt + leapcnt * (time_size + 4) + isstdcnt + isutcnt
+        types = []
+        for utoff, isdst, abbrind in ttinfos:
+            abbr = chars[abbrind:chars.find(b'\0', abbrind)]
+            types.append((utoff, bool(isdst), abbr.decode('ascii')))
+        self.types = [types[i] for i in indices]
+        # Before the first transition, the C library uses the first
+        # standard time type.
+        self.initial = next((t for t in types if not t[1]), types[0])
+
+        self.rule = None
+        footer = data[offset:].strip(b'\n')
+        if version >= b'2' and footer:
+            self.rule = _PosixRule(footer.decode('ascii'))
+
+    def info(self, when):
+        """Return the type in effect at a time since the epoch."""
+        i = bisect.bisect_right(self.transitions, when)
+        if i == len(self.transitions) and self.rule is not None:
+            return self.rule.info(when)
+        elif i == 0:
+            return self.initial
+        return self.types[i - 1]
+
+    def local_info(self, wall):
+        """Return the type in effect at a local wall-clock time.
+
+        wall is the local time as seconds since the epoch, as if it were
+        UTC.  Times that occur twice resolve to the first of them.
+        """
+        before = self.info(wall - 86400)
+        after = self.info(wall + 86400)
+        for guess in (before, after):
+            found = self.info(wall - guess[0])
+            if found[0] == guess[0]:
+                return found
+        return self.info(wall - before[0])
+
+    def zones(self, now):
+        """Return what time.timezone, time.altzone and time.daylight would be.
+        """
+        when = (int(now) // _YEAR) * _YEAR
+        janzone = -self.info(when)[0]
+        julyzone = -self.info(when + _YEAR // 2)[0]
+        if janzone < julyzone:
+            # DST is reversed in the southern hemisphere.
+            return julyzone, janzone, True
+        return janzone, julyzone, janzone != julyzone
+
+
+_tzfiles = {}
+
+
+def _load_tzfile(name):
+    """Return the _TzFile for a zone name or TZ value, or None."""
+    if name is None:
+        name = os.environ.get('TZ', '/etc/localtime')
+    name = name.lstrip(':')
+    if not name:
+        return None
+    try:
+        return _tzfiles[name]
+    except KeyError:
+        pass
+    tzfile = None
+    try:
+        with open(os.path.join(ZONEINFO_DIR, name), 'rb') as f:
+            tzfile = _TzFile(f.read())
+    except (OSError, ValueError, struct.error, UnicodeError):
+        pass
+    _tzfiles[name] = tzfile
+    return tzfile
+
+
+def _local_seconds(dt):
+    return calendar.timegm(dt.replace(tzinfo=None).timetuple())
+
+
 class SystemTzInfo(datetime.tzinfo):
     def __init__(self, tz=None):
         self.tz = tz
@@ -57,7 +284,18 @@ class SystemTzInfo(datetime.tzinfo):
             os.environ['TZ'] = tzbackup
         time.tzset()
 
+    def _tzfile(self):
+        return _load_tzfile(self.tz)
+
     def utcoffset(self, dt):
+        tzfile = self._tzfile()
+        if tzfile is not None:
+            timezone, altzone, daylight = tzfile.zones(time.time())
+            if daylight and tzfile.local_info(_local_seconds(dt))[1]:
+                dstminutes = -altzone / 60
+            else:
+                dstminutes = -timezone / 60
+            return datetime.timedelta(minutes=int(dstminutes))
         tzbackup = self._select_tz()
         try:
             if time.daylight == 0:
@@ -76,6 +314,10 @@ class SystemTzInfo(datetime.tzinfo):
             self._restore_tz(tzbackup)
 
     def rawutcoffset(self, unused_dt):
+        tzfile = self._tzfile()
+        if tzfile is not None:
+            timezone = tzfile.zones(time.time())[0]
+            return datetime.timedelta(minutes=int(-timezone / 60))
         tzbackup = self._select_tz()
         try:
             dstminutes = -time.timezone / 60
@@ -84,6 +326,13 @@ class SystemTzInfo(datetime.tzinfo):
             self._restore_tz(tzbackup)
 
     def dst(self, dt):
+        tzfile = self._tzfile()
+        if tzfile is not None:
+            timezone, altzone, daylight = tzfile.zones(time.time())
+            if daylight and tzfile.local_info(_local_seconds(dt))[1]:
+                return datetime.timedelta(
+                    minutes=int((timezone - altzone) / 60))
+            return datetime.timedelta(0)
         tzbackup = self._select_tz()
         try:
             if time.daylight == 0:
@@ -105,6 +354,9 @@ class SystemTzInfo(datetime.tzinfo):
         return self.tz
 
     def tzname_letters(self, dt):
+        tzfile = self._tzfile()
+        if tzfile is not None:
+            return tzfile.local_info(_local_seconds(dt))[2]
         tzbackup = self._select_tz()
         try:
             localtime = time.localtime(_seconds_since_epoch(dt))
@@ -153,8 +405,16 @@ def _parse_position(position, wholedigits):
         return whole - fraction / pow(10.0, len(fractionstr))
 
 
+def _md5sum(zone):
+    try:
+        with open(os.path.join(ZONEINFO_DIR, zone), 'rb') as tz_file:
+            return hashlib.md5(tz_file.read()).digest()
+    except IOError:
+        return None
+
+
 class Location(object):
-    def __init__(self, zonetab_line, iso3166):
+    def __init__(self, zonetab_line, iso3166, entry=None):
         bits = zonetab_line.rstrip().split('\t', 3)
         latlong = bits[1]
         latlongsplit = latlong.find('-', 1)
@@ -181,13 +441,17 @@ class Location(object):
         self.latitude = _parse_position(latitude, 2)
         self.longitude = _parse_position(longitude, 3)
 
+        self.info = SystemTzInfo(self.zone)
+        if entry is not None:
+            self.md5sum = bytes.fromhex(entry['md5'])
+            utc_offset, self.zone_letters = _current_offsets(
+                entry, time.time())
+            self.utc_offset = datetime.timedelta(minutes=utc_offset)
+            self.raw_utc_offset = datetime.timedelta(minutes=entry['raw'])
+            return
+
         # Grab md5sum of the timezone file for later comparison
-        try:
-            zone_path = os.path.join('/usr/share/zoneinfo', self.zone)
-            with open(zone_path, 'rb') as tz_file:
-                self.md5sum = hashlib.md5(tz_file.read()).digest()
-        except IOError:
-            self.md5sum = None
+        self.md5sum = _md5sum(self.zone)
 
         try:
             today = datetime.datetime.today()
@@ -197,27 +461,154 @@ class Location(object):
             # time is set to the epoch will at least let us avoid crashing,
             # although the UTC offset and zone letters may be wrong.
             today = datetime.datetime.fromtimestamp(0)
-        self.info = SystemTzInfo(self.zone)
         self.utc_offset = self.info.utcoffset(today)
         self.raw_utc_offset = self.info.rawutcoffset(today)
         self.zone_letters = self.info.tzname_letters(today)
 
 
+def _tzdata_stamp():
+    stamp = []
+    for path in (ZONEINFO_DIR, TZ_DATA_FILE):
+        try:
+            stamp.append(os.stat(path).st_mtime)
+        except OSError:
+            stamp.append(None)
+    return stamp
+
+
+def _zone_offsets(zone, start, end, step=24 * 60 * 60):
+    """Return a zone's raw offset and its offsets from start to end.
+
+    Offsets are in minutes.  The second item is a list of [time, UTC
+    offset, zone letters] entries, one for each change.
+    """
+    info = SystemTzInfo(zone)
+    tzbackup = info._select_tz()
+    try:
+        def offsets(when):
+            localtime = time.localtime(when)
+            if time.daylight == 0 or localtime.tm_isdst != 1:
+                minutes = int(-time.timezone / 60)
+            else:
+                minutes = int(-time.altzone / 60)
+            return [minutes, time.strftime('%Z', localtime)]
+
+        periods = [[start] + offsets(start)]
+        when = start
+        while when < end:
+            after = min(when + step, end)
+            if offsets(after) != periods[-1][1:]:
+                # Find the second at which the offsets change.
+                low, high = when, after
+                while high - low > 1:
+                    middle = (low + high) // 2
+                    if offsets(middle) == periods[-1][1:]:
+                        low = middle
+                    else:
+                        high = middle
+                periods.append([high] + offsets(high))
+            when = after
+        return int(-time.timezone / 60), periods
+    finally:
+        info._restore_tz(tzbackup)
+
+
+def _current_offsets(entry, now):
+    current = entry['periods'][0]
+    for period in entry['periods']:
+        if period[0] > now:
+            break
+        current = period
+    return current[1], current[2]
+
+
+def build_index(now=None):
+    """Work out the zoneinfo index from the installed tzdata."""
+    if now is None:
+        now = int(time.time())
+    stamp = _tzdata_stamp()
+    zones = {}
+    by_md5 = {}
+    with open(TZ_DATA_FILE) as tzdata:
+        for line in tzdata:
+            if line.startswith('#'):
+                continue
+            zone = line.rstrip().split('\t', 3)[2]
+            md5sum = _md5sum(zone)
+            if md5sum is None:
+                continue
+            raw, periods = _zone_offsets(zone, now, now + _INDEX_SPAN)
+            zones[zone] = {'md5': md5sum.hex(), 'raw': raw,
+                           'periods': periods}
+            by_md5.setdefault(md5sum, zone)
+    aliases = {}
+    for dirpath, dirnames, filenames in os.walk(ZONEINFO_DIR):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            alias = os.path.relpath(path, ZONEINFO_DIR)
+            if alias in zones:
+                continue
+            zone = by_md5.get(_md5sum(alias))
+            if zone is not None:
+                aliases[alias] = zone
+    return {'version': _INDEX_VERSION, 'tzdata': stamp, 'start': now,
+            'end': now + _INDEX_SPAN, 'zones': zones, 'aliases': aliases}
+
+
+def load_index(now=None):
+    """Return the zoneinfo index, or None if it is missing or out of date."""
+    if now is None:
+        now = time.time()
+    try:
+        with open(INDEX_FILE) as index_file:
+            index = json.load(index_file)
+        if (index['version'] == _INDEX_VERSION and
+                index['tzdata'] == _tzdata_stamp() and
+                index['start'] <= now < index['end']):
+            return index
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    return None
+
+
+def save_index(now=None):
+    """Build the zoneinfo index and write it to INDEX_FILE."""
+    index = build_index(now)
+    with misc.raised_privileges():
+        os.makedirs(os.path.dirname(INDEX_FILE), exist_ok=True)
+        with open(INDEX_FILE + '.new', 'w') as index_file:
+            json.dump(index, index_file, separators=(',', ':'))
+        os.rename(INDEX_FILE + '.new', INDEX_FILE)
+    return index
+
+
 class _Database(object):
-    def __init__(self):
+    def __init__(self, use_index=True):
         self.locations = []
         iso3166 = Iso3166()
+        index = load_index() if use_index else None
+        if index is not None:
+            zones = index['zones']
+            self.aliases = index['aliases']
+        else:
+            zones = {}
+            self.aliases = {}
         with open(TZ_DATA_FILE) as tzdata:
             for line in tzdata:
                 if line.startswith('#'):
                     continue
-                self.locations.append(Location(line, iso3166))
+                entry = zones.get(line.rstrip().split('\t', 3)[2])
+                self.locations.append(Location(line, iso3166, entry))
 
-        # Build mappings from timezone->location and country->locations
+        # Build mappings from timezone->location, md5sum->location and
+        # country->locations
         self.cc_to_locs = {}
         self.tz_to_loc = {}
+        self.md5_to_loc = {}
         for loc in self.locations:
             self.tz_to_loc[loc.zone] = loc
+            if loc.md5sum is not None:
+                self.md5_to_loc.setdefault(loc.md5sum, loc)
             if loc.country in self.cc_to_locs:
                 self.cc_to_locs[loc.country] += [loc]
             else:
@@ -226,22 +617,17 @@ class _Database(object):
     def get_loc(self, tz):
         # Sometimes we'll encounter timezones that aren't really
         # city-zones, like "US/Eastern" or "Mexico/General".  So first,
-        # we check if the timezone is known.  If it isn't, we search for
+        # we check if the timezone is known.  If it isn't, we look for
         # one with the same md5sum and make a reference to it
         try:
             return self.tz_to_loc[tz]
         except Exception:
-            try:
-                zone_path = os.path.join('/usr/share/zoneinfo', tz)
-                with open(zone_path, 'rb') as tz_file:
-                    md5sum = hashlib.md5(tz_file.read()).digest()
-
-                for loc in self.locations:
-                    if md5sum == loc.md5sum:
-                        self.tz_to_loc[tz] = loc
-                        return loc
-            except IOError:
-                pass
+            loc = self.tz_to_loc.get(self.aliases.get(tz))
+            if loc is None:
+                loc = self.md5_to_loc.get(_md5sum(tz))
+            if loc is not None:
+                self.tz_to_loc[tz] = loc
+                return loc
 
             # If not found, oh well, just warn and move on.
             print('Could not understand timezone', tz, file=sys.stderr)
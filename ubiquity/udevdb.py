@@ -0,0 +1,155 @@
+# -*- coding: utf-8; Mode: Python; indent-tabs-mode: nil; tab-width: 4 -*-
+
+# Copyright (C) 2020 Canonical Ltd.
+#
+# Read block device properties straight from sysfs and the udev database.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+# "udevadm info -q property" prints the kernel's uevent variables for a
+# device together with whatever udev stored about it in /run/udev/data.
+# We read the same files for every block device at once, and read them
+# again only when the set of block devices or the udev database changes
+# (udev replaces a device's database file on every event), rather than
+# forking udevadm for each question.
+
+import os
+import syslog
+import time
+
+
+SYS = '/sys'
+UDEV_DATA = '/run/udev/data'
+
+
+def read_uevent(path):
+    """Return the variables in a sysfs uevent file."""
+    props = {}
+    try:
+        with open(path) as uevent:
+            for line in uevent:
+                name, sep, value = line.rstrip('\n').partition('=')
+                if sep:
+                    props[name] = value
+    except OSError:
+        pass
+    return props
+
+
+def read_udev_data(path):
+    """Return the properties and symlinks in a udev database file."""
+    props = {}
+    links = []
+    try:
+        with open(path) as data:
+            for line in data:
+                line = line.rstrip('\n')
+                if line.startswith('E:'):
+                    name, sep, value = line[2:].partition('=')
+                    if sep:
+                        props[name] = value
+                elif line.startswith('S:'):
+                    links.append('/dev/%s' % line[2:])
+    except OSError:
+        pass
+    return props, links
+
+
+class DeviceTable:
+    """Properties of every block device, as udevadm would report them."""
+
+    def __init__(self, sys_root=SYS, udev_data=UDEV_DATA):
+        self.sys_root = sys_root
+        self.udev_data = udev_data
+        self.stamp = None
+        self.by_devname = {}
+        self.by_devpath = {}
+        self.loads = 0
+
+    def current_stamp(self):
+        try:
+            names = tuple(sorted(
+                os.listdir(os.path.join(self.sys_root, 'class', 'block'))))
+        except OSError:
+            names = ()
+        try:
+            mtime = os.stat(self.udev_data).st_mtime_ns
+        except OSError:
+            mtime = None
+        return names, mtime
+
+    def refresh(self):
+        """Reload the table if a udev event may have changed it."""
+        stamp = self.current_stamp()
+        if stamp == self.stamp:
+            return
+        start = time.time()
+        class_block = os.path.join(self.sys_root, 'class', 'block')
+        by_devname = {}
+        by_devpath = {}
+        for name in stamp[0]:
+            syspath = os.path.realpath(os.path.join(class_block, name))
+            props = read_uevent(os.path.join(syspath, 'uevent'))
+            props['DEVPATH'] = syspath[len(self.sys_root):]
+            props['SUBSYSTEM'] = 'block'
+            if 'DEVNAME' in props:
+                props['DEVNAME'] = '/dev/%s' % props['DEVNAME']
+            if 'MAJOR' in props and 'MINOR' in props:
+                data, links = read_udev_data(os.path.join(
+                    self.udev_data,
+                    'b%s:%s' % (props['MAJOR'], props['MINOR'])))
+                props.update(data)
+                if links:
+                    props['DEVLINKS'] = ' '.join(links)
+            by_devpath[props['DEVPATH']] = props
+            if 'DEVNAME' in props:
+                by_devname[props['DEVNAME']] = props
+        self.by_devname = by_devname
+        self.by_devpath = by_devpath
+        self.stamp = stamp
+        self.loads += 1
+        syslog.syslog('Read properties of %d block devices in %.3fs' %
+                      (len(by_devpath), time.time() - start))
+
+    def lookup_name(self, device):
+        """Return the properties of a /dev node, or None."""
+        self.refresh()
+        return self.by_devname.get(os.path.realpath(device))
+
+    def lookup_path(self, devpath):
+        """Return the properties of a device path, or None.
+
+        As with udevadm, devpath may or may not start with /sys, and may
+        go through symlinks such as /block/loop0.
+        """
+        self.refresh()
+        if devpath.startswith(SYS + '/'):
+            devpath = devpath[len(SYS):]
+        props = self.by_devpath.get(devpath)
+        if props is None:
+            syspath = os.path.realpath(self.sys_root + devpath)
+            props = self.by_devpath.get(syspath[len(self.sys_root):])
+        return props
+
+
+_table = None
+
+
+def get():
+    """Return the DeviceTable shared by the whole installer."""
+    global _table
+    if _table is None:
+        _table = DeviceTable()
+    return _table